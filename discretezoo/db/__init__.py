@@ -11,6 +11,18 @@ This module contains the following submodules:
 
 - ``sqlitedb``: A SQLite database interface
 
+- ``sharded``: A SQLite database interface sharded by graph order
+
 - ``postgresql``: A PostgreSQL database interface
+
+- ``instrument``: Statement instrumentation hooks
+
+- ``advisor``: An index advisor
+
+- ``cache``: A query result cache
+
+- ``aio``: An asynchronous cursor wrapper
+
+- ``codec``: A compressing codec for graph data
 """
 __all__ = ["query", "sqlite"]
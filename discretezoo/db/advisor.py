@@ -0,0 +1,278 @@
+r"""
+Index advisor
+
+This module provides a class recording the columns used by the conditions,
+groupings and orderings of performed queries, and proposing indexes for the
+ones not covered by existing indexes.
+"""
+
+import threading
+from . import query
+
+
+class IndexAdvisor(object):
+    r"""
+    A class proposing indexes based on the observed queries.
+
+    For each table referenced by a query, the advisor records a candidate
+    index consisting of the columns compared for equality in the conjunctive
+    part of the condition (or used to join tables), followed by the first
+    column compared by range or used for grouping or ordering. Additionally,
+    each column used in any of these ways is recorded as a single-column
+    candidate. The estimated benefit of a candidate index is the total time
+    spent in the queries which could use it.
+    """
+    db = None
+    candidates = None
+
+    def __init__(self, db):
+        r"""
+        Object constructor.
+
+        The advisor is attached to the database, so that it observes all
+        subsequent queries (see ``SQLDB.query``).
+
+        INPUT:
+
+        - ``db`` - the database to observe.
+        """
+        self.db = db
+        self.candidates = {}
+        self.lock = threading.Lock()
+        db.advisor = self
+
+    def detach(self):
+        r"""
+        Stop observing queries.
+        """
+        if self.db.advisor is self:
+            self.db.advisor = None
+
+    def clear(self):
+        r"""
+        Discard all recorded candidates.
+        """
+        with self.lock:
+            self.candidates.clear()
+
+    @staticmethod
+    def tableName(table):
+        r"""
+        Return the name of the first table represented by ``table``.
+
+        INPUT:
+
+        - ``table`` - a ``Table`` object or a table name.
+        """
+        while isinstance(table, query.Table):
+            table = table.tables[0]["table"]
+        return table
+
+    def resolve(self, col, default):
+        r"""
+        Return a pair containing the table name and column name for a column,
+        or ``None`` if the column cannot be determined.
+
+        INPUT:
+
+        - ``col`` - the expression to resolve.
+
+        - ``default`` - the name of the table to be used for columns without
+          table information, or ``None`` if unknown.
+        """
+        if not isinstance(col, query.Column) or \
+                not isinstance(col.column, str):
+            return None
+        if col.table is None:
+            return None if default is None else (default, col.column)
+        return (self.tableName(col.table), col.column)
+
+    def walk(self, exp, default, uses, conj=True):
+        r"""
+        Record the columns used by a condition.
+
+        INPUT:
+
+        - ``exp`` - the condition.
+
+        - ``default`` - the name of the table to be used for columns without
+          table information, or ``None`` if unknown.
+
+        - ``uses`` - a dictionary mapping table names to dictionaries with
+          keys ``"eq"``, ``"range"`` and ``"other"`` mapping to lists of
+          columns to be updated.
+
+        - ``conj`` - whether the condition is a part of the top-level
+          conjunction (default: ``True``).
+        """
+        if isinstance(exp, query.And) and conj:
+            for t in exp.terms:
+                self.walk(t, default, uses)
+        elif isinstance(exp, query.LogicalExpression):
+            for t in exp.terms:
+                self.walk(t, default, uses, conj=False)
+        elif isinstance(exp, query.Subquery):
+            self.observeQuery(exp.table, exp.cond, exp.groupby, exp.orderby,
+                              uses)
+        elif isinstance(exp, (query.Equal, query.In, query.LessThan,
+                              query.LessEqual, query.GreaterThan,
+                              query.GreaterEqual, query.Like)):
+            kind = "eq" if isinstance(exp, (query.Equal, query.In)) \
+                else "range"
+            if not conj:
+                kind = "other"
+            for side in [exp.left, exp.right]:
+                c = self.resolve(side, default)
+                if c is not None:
+                    uses.setdefault(c[0], {"eq": [], "range": [],
+                                           "other": []})[kind].append(c[1])
+                else:
+                    self.walk(side, default, uses, conj=False)
+        elif isinstance(exp, query.IsNull):
+            c = self.resolve(exp.exp, default)
+            if c is not None:
+                uses.setdefault(c[0], {"eq": [], "range": [], "other": []}) \
+                    ["eq" if conj else "other"].append(c[1])
+        elif isinstance(exp, query.UnaryOp):
+            self.walk(exp.exp, default, uses, conj=False)
+        elif isinstance(exp, query.BinaryOp):
+            self.walk(exp.left, default, uses, conj=False)
+            self.walk(exp.right, default, uses, conj=False)
+
+    def observeQuery(self, table, cond, groupby, orderby, uses):
+        r"""
+        Record the columns used by a query.
+
+        INPUT:
+
+        - ``table`` - the ``Table`` queried.
+
+        - ``cond`` - the condition of the query.
+
+        - ``groupby`` - the expressions to group by.
+
+        - ``orderby`` - the expressions to order by.
+
+        - ``uses`` - a dictionary to be updated (see ``walk``).
+        """
+        default = None
+        if isinstance(table, query.Table):
+            names = table.getTables()
+            if len(names) == 1:
+                default, = names
+            for t in table.tables:
+                if isinstance(t["by"], frozenset):
+                    name = self.tableName(t["table"])
+                    uses.setdefault(name, {"eq": [], "range": [],
+                                           "other": []})["eq"] += \
+                        sorted(t["by"])
+                elif isinstance(t["by"], tuple):
+                    name = self.tableName(t["table"])
+                    for k, v in t["by"]:
+                        if isinstance(k, str):
+                            uses.setdefault(name, {"eq": [], "range": [],
+                                                   "other": []})["eq"] \
+                                .append(k)
+                        self.walk(v, None, uses, conj=False)
+        elif table is not None:
+            default = table
+        if cond is not None:
+            self.walk(query.makeExpression(cond), default, uses)
+        for x in query.enlist(groupby or []) + \
+                [query.Order(o).exp for o in query.enlist(orderby or [])]:
+            c = self.resolve(x, default)
+            if c is not None:
+                uses.setdefault(c[0], {"eq": [], "range": [], "other": []}) \
+                    ["range"].append(c[1])
+
+    def observe(self, table, cond=None, groupby=None, orderby=None,
+                latency=0.0):
+        r"""
+        Record a performed query.
+
+        INPUT:
+
+        - ``table`` - the ``Table`` queried.
+
+        - ``cond`` - the condition of the query (default: ``None``).
+
+        - ``groupby`` - the expressions to group by (default: ``None``).
+
+        - ``orderby`` - the expressions to order by (default: ``None``).
+
+        - ``latency`` - the time spent executing the query in seconds
+          (default: ``0.0``).
+        """
+        uses = {}
+        self.observeQuery(table, cond, groupby, orderby, uses)
+        keys = set()
+        for t, u in uses.items():
+            eq = sorted(set(u["eq"]))
+            rest = [c for c in u["range"] if c not in eq]
+            cols = tuple(eq + rest[:1])
+            if len(cols) > 0:
+                keys.add((t, cols))
+            for c in set(u["eq"] + u["range"] + u["other"]):
+                keys.add((t, (c, )))
+        with self.lock:
+            for k in keys:
+                n, s = self.candidates.get(k, (0, 0.0))
+                self.candidates[k] = (n + 1, s + latency)
+
+    def proposals(self):
+        r"""
+        Return a list of proposed indexes.
+
+        Each proposal is a dictionary with keys ``"table"``, ``"columns"``,
+        ``"queries"`` (the number of queries which could use the index) and
+        ``"benefit"`` (the total time spent in these queries). Candidates
+        whose columns form a prefix of the columns of an existing index or a
+        better ranked proposal are omitted. The list is sorted by the
+        estimated benefit in decreasing order.
+        """
+        with self.lock:
+            cands = sorted(self.candidates.items(),
+                           key=lambda kv: (-kv[1][1], -kv[1][0],
+                                           -len(kv[0][1])))
+        existing = {}
+        cur = self.db.cursor()
+        for t in {t for (t, cols), v in cands}:
+            existing[t] = [tuple(idx) for idx in self.db.tableIndexes(cur, t)]
+        cur.close()
+        out = []
+        for (t, cols), (n, s) in cands:
+            if any(idx[:len(cols)] == cols for idx in existing[t]):
+                continue
+            existing[t].append(cols)
+            out.append({"table": t, "columns": cols, "queries": n,
+                        "benefit": s})
+        return out
+
+    def create(self, limit=None, commit=True):
+        r"""
+        Create the proposed indexes.
+
+        Returns the list of proposals for which indexes were created.
+
+        INPUT:
+
+        - ``limit`` - the maximal number of indexes to create
+          (default: ``None``).
+
+        - ``commit`` - whether to commit after the indexes are created
+          (default: ``True``).
+        """
+        props = self.proposals()[:limit]
+        cur = self.db.cursor()
+        for p in props:
+            self.db.createIndex(cur, p["table"], list(p["columns"]))
+        cur.close()
+        if commit:
+            self.db.commit()
+        return props
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Index advisor for %s" % self.db
@@ -0,0 +1,131 @@
+r"""
+Asynchronous interface
+
+This module provides a cursor wrapper for use with ``asyncio``. The
+operations on the wrapped cursor are performed by the database's executor
+(see ``SQLDB.run_async``), so they do not block the event loop.
+"""
+
+
+class AsyncCursor(object):
+    r"""
+    A cursor wrapper with asynchronous fetching and iteration.
+
+    Asynchronous iteration fetches the rows in chunks. A function may be
+    applied to the fetched rows; it is also called by the executor.
+    """
+
+    def __init__(self, db, cur, fun=None, chunk=None):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``db`` - the database the cursor belongs to.
+
+        - ``cur`` - the cursor to wrap.
+
+        - ``fun`` - the function to apply to each row (default: ``None``).
+
+        - ``chunk`` - the number of rows to fetch at once when iterating
+          (default: ``None``, meaning that the database's ``itersize`` is
+          used).
+        """
+        self.db = db
+        self.cur = cur
+        self.fun = fun
+        self.chunk = db.itersize if chunk is None else chunk
+        self.rows = []
+        self.pos = 0
+
+    def convert(self, rows):
+        r"""
+        Apply the function to a list of rows.
+
+        INPUT:
+
+        - ``rows`` - the list of rows.
+        """
+        if self.fun is None:
+            return rows
+        return [self.fun(r) for r in rows]
+
+    def buffered(self, size=None):
+        r"""
+        Return at most ``size`` rows from the buffer of fetched rows.
+
+        INPUT:
+
+        - ``size`` - the maximal number of rows to return (default: ``None``,
+          meaning all rows).
+        """
+        end = len(self.rows) if size is None \
+            else min(len(self.rows), self.pos + size)
+        out = self.rows[self.pos:end]
+        self.pos = end
+        return out
+
+    async def fetchone(self):
+        r"""
+        Return the next row, or ``None`` if there are no more rows.
+        """
+        rows = await self.fetchmany(1)
+        return rows[0] if rows else None
+
+    async def fetchmany(self, size=None):
+        r"""
+        Return a list of at most ``size`` next rows.
+
+        INPUT:
+
+        - ``size`` - the maximal number of rows to return (default: ``None``,
+          meaning that ``chunk`` is used).
+        """
+        if size is None:
+            size = self.chunk
+        out = self.buffered(size)
+        if len(out) < size:
+            out += await self.db.run_async(
+                lambda: self.convert(self.cur.fetchmany(size - len(out))))
+        return out
+
+    async def fetchall(self):
+        r"""
+        Return a list of all remaining rows.
+        """
+        out = self.buffered()
+        out += await self.db.run_async(
+            lambda: self.convert(self.cur.fetchall()))
+        return out
+
+    async def close(self):
+        r"""
+        Close the wrapped cursor.
+        """
+        await self.db.run_async(self.cur.close)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.pos == len(self.rows):
+            self.rows = await self.db.run_async(
+                lambda: self.convert(self.cur.fetchmany(self.chunk)))
+            self.pos = 0
+            if not self.rows:
+                await self.close()
+                raise StopAsyncIteration
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Asynchronous cursor for %s" % self.db
@@ -0,0 +1,367 @@
+r"""
+Query result cache
+
+This module provides a cache of query results keyed by the SQL string and its
+parameters. Each entry records the tables the query depends on, and is
+discarded whenever one of these tables is written to or such a write is
+committed (see ``SQLDB.cache_results``).
+"""
+
+import threading
+from collections import OrderedDict
+from . import query
+
+
+def dependencies(table, cond=None):
+    r"""
+    Return the set of names of tables a query depends on.
+
+    If the tables cannot be determined, ``None`` is returned.
+
+    INPUT:
+
+    - ``table`` - the ``Table`` queried or a table name.
+
+    - ``cond`` - the condition of the query (default: ``None``).
+    """
+    out = set()
+    if isinstance(table, query.Table):
+        for t in table.getTables():
+            if not isinstance(t, str):
+                return None
+            out.add(t)
+    elif isinstance(table, str):
+        out.add(table)
+    else:
+        return None
+    if cond is not None and not expressionDependencies(
+            query.makeExpression(cond), out):
+        return None
+    return out
+
+
+def expressionDependencies(exp, out):
+    r"""
+    Add the names of tables referenced by an expression to a set.
+
+    Returns ``False`` if the tables cannot be determined, and ``True``
+    otherwise.
+
+    INPUT:
+
+    - ``exp`` - the expression.
+
+    - ``out`` - the set to be updated.
+    """
+    if isinstance(exp, query.Subquery):
+        d = dependencies(exp.table, exp.cond)
+        if d is None:
+            return False
+        out.update(d)
+        return True
+    elif isinstance(exp, query.LogicalExpression):
+        return all(expressionDependencies(t, out) for t in exp.terms)
+    elif isinstance(exp, query.BinaryOp):
+        return expressionDependencies(exp.left, out) and \
+            expressionDependencies(exp.right, out)
+    elif isinstance(exp, query.UnaryOp):
+        return expressionDependencies(exp.exp, out)
+    for t, j, b in exp.getTables():
+        d = dependencies(t)
+        if d is None:
+            return False
+        out.update(d)
+    return True
+
+
+class CachedCursor(object):
+    r"""
+    A cursor-like object returning a list of rows, optionally followed by the
+    remaining rows of a cursor.
+    """
+
+    def __init__(self, rows, cur=None):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``rows`` - the list of rows.
+
+        - ``cur`` - the cursor providing further rows (default: ``None``).
+        """
+        self.rows = rows
+        self.pos = 0
+        self.cur = cur
+        self.rowcount = len(rows) if cur is None else cur.rowcount
+
+    def fetchone(self):
+        r"""
+        Return the next row, or ``None`` if there are no more rows.
+        """
+        if self.pos < len(self.rows):
+            self.pos += 1
+            return self.rows[self.pos - 1]
+        elif self.cur is not None:
+            return self.cur.fetchone()
+        return None
+
+    def fetchmany(self, size=1):
+        r"""
+        Return a list of at most ``size`` next rows.
+
+        INPUT:
+
+        - ``size`` - the maximal number of rows to return (default: 1).
+        """
+        out = self.rows[self.pos:self.pos + size]
+        self.pos += len(out)
+        if len(out) < size and self.cur is not None:
+            out += self.cur.fetchmany(size - len(out))
+        return out
+
+    def fetchall(self):
+        r"""
+        Return a list of all remaining rows.
+        """
+        out = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        if self.cur is not None:
+            out += self.cur.fetchall()
+        return out
+
+    def __iter__(self):
+        r"""
+        Iterate over the remaining rows.
+        """
+        while self.pos < len(self.rows):
+            self.pos += 1
+            yield self.rows[self.pos - 1]
+        if self.cur is not None:
+            for r in self.cur:
+                yield r
+
+    def close(self):
+        r"""
+        Close the underlying cursor, if any.
+        """
+        if self.cur is not None:
+            self.cur.close()
+
+
+class ResultCache(object):
+    r"""
+    A least recently used cache of query results.
+
+    Entries are evicted when the number of entries or the total number of
+    cached rows exceeds the set limits. Results having more rows than the
+    limit for a single entry are not cached.
+
+    Each entry is stored together with the set of tables the query depends
+    on, or ``None`` if they could not be determined, in which case the entry
+    is discarded on any write. Tables which have been written to are
+    recorded until the transaction is committed (see ``commit``) or rolled
+    back (see ``rollback``), and results depending on them are not cached
+    in the meantime, so that only committed data is cached.
+    """
+
+    def __init__(self, size=1024, max_rows=10000, max_entry_rows=1000):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``size`` - the maximal number of entries (default: 1024).
+
+        - ``max_rows`` - the maximal total number of cached rows
+          (default: 10000).
+
+        - ``max_entry_rows`` - the maximal number of rows of a single entry
+          (default: 1000).
+        """
+        self.size = size
+        self.max_rows = max_rows
+        self.max_entry_rows = max_entry_rows
+        self.entries = OrderedDict()
+        self.tables = {}
+        self.global_keys = set()
+        self.dirty = set()
+        self.rows = 0
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        r"""
+        Return a cursor over the cached rows for a key, or ``None`` on a miss.
+
+        INPUT:
+
+        - ``key`` - the key, i.e., a pair containing the SQL string with
+          wildcards and a tuple of parameters.
+        """
+        with self.lock:
+            e = self.entries.get(key)
+            if e is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return CachedCursor(e[0])
+
+    def store(self, key, deps, cur, version):
+        r"""
+        Cache the results of a query and return a cursor over them.
+
+        The rows are fetched from ``cur``. If there are too many of them, the
+        results are not cached, and the returned cursor continues reading
+        from ``cur``.
+
+        INPUT:
+
+        - ``key`` - the key (see ``get``).
+
+        - ``deps`` - the set of names of tables the query depends on, or
+          ``None`` if unknown.
+
+        - ``cur`` - the cursor holding the results.
+
+        - ``version`` - the value of ``version`` before the query was
+          executed. If any table has been invalidated since, or the query
+          depends on tables with uncommitted writes, the results are not
+          cached.
+        """
+        rows = cur.fetchmany(self.max_entry_rows + 1)
+        if len(rows) > self.max_entry_rows:
+            return CachedCursor(rows, cur)
+        cur.close()
+        with self.lock:
+            if version != self.version or key in self.entries or \
+                    (self.dirty and (deps is None or None in self.dirty or
+                                     not self.dirty.isdisjoint(deps))):
+                return CachedCursor(rows)
+            self.entries[key] = (rows, deps)
+            self.rows += len(rows)
+            if deps is None:
+                self.global_keys.add(key)
+            else:
+                for t in deps:
+                    self.tables.setdefault(t, set()).add(key)
+            while len(self.entries) > self.size or self.rows > self.max_rows:
+                self.discard(next(iter(self.entries)))
+        return CachedCursor(rows)
+
+    def discard(self, key):
+        r"""
+        Remove an entry. Should be called with the lock held.
+
+        INPUT:
+
+        - ``key`` - the key of the entry.
+        """
+        rows, deps = self.entries.pop(key)
+        self.rows -= len(rows)
+        if deps is None:
+            self.global_keys.discard(key)
+        else:
+            for t in deps:
+                keys = self.tables[t]
+                keys.discard(key)
+                if not keys:
+                    del self.tables[t]
+
+    def invalidate(self, *tables):
+        r"""
+        Remove the entries depending on the given tables, and record that
+        they have been written to.
+
+        INPUT:
+
+        - any unnamed parameter is a table name, or a ``Table`` object.
+          If none are given, or the tables cannot be determined, all entries
+          are removed.
+        """
+        names = set()
+        for t in tables:
+            d = dependencies(t)
+            if d is None:
+                names = None
+                break
+            names.update(d)
+        with self.lock:
+            if not names:
+                self.dirty.add(None)
+            else:
+                self.dirty.update(names)
+            self.discardTables(names)
+
+    def discardTables(self, names):
+        r"""
+        Remove the entries depending on the given tables. Should be called
+        with the lock held.
+
+        INPUT:
+
+        - ``names`` - a set of table names. If empty or ``None``, all entries
+          are removed.
+        """
+        self.version += 1
+        if not names:
+            self.entries.clear()
+            self.tables.clear()
+            self.global_keys.clear()
+            self.rows = 0
+            return
+        keys = set(self.global_keys)
+        for t in names:
+            keys.update(self.tables.get(t, ()))
+        for k in keys:
+            self.discard(k)
+
+    def commit(self):
+        r"""
+        Remove the entries depending on the tables written to in the
+        committed transaction.
+        """
+        with self.lock:
+            if self.dirty:
+                self.discardTables(None if None in self.dirty
+                                   else self.dirty)
+                self.dirty = set()
+
+    def rollback(self):
+        r"""
+        Remove all entries after a transaction is rolled back.
+        """
+        with self.lock:
+            self.discardTables(None)
+            self.dirty = set()
+
+    def clear(self):
+        r"""
+        Remove all entries and reset the counters.
+        """
+        self.rollback()
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        r"""
+        Return a dictionary describing the state of the cache.
+
+        The dictionary contains the numbers of cache hits and misses, the
+        current and maximal number of entries, and the current and maximal
+        number of cached rows.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries), "maxsize": self.size,
+                    "rows": self.rows, "maxrows": self.max_rows}
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Result cache with %d entries" % len(self.entries)
@@ -0,0 +1,356 @@
+r"""
+Graph data codec
+
+This module provides a codec storing graph data strings as compressed binary
+values (see ``SQLDB.use_codec``). Each value starts with a header specifying
+the compression method and the dictionary used, so values compressed with
+different settings, as well as uncompressed strings, may coexist in a table.
+Dictionaries are stored in the database, identified by their hashes.
+"""
+
+import lzma
+import zlib
+from collections import Counter
+from hashlib import sha256
+from .query import Column
+from .query import IsNotNull
+from .query import Value
+
+# The prefix of compressed values
+MAGIC = b"ZC"
+
+# Identifiers of compression methods
+METHODS = {"zlib": b"z", "lzma": b"x"}
+
+# The hash length and the identifier of the absence of a dictionary
+KEY_LENGTH = 8
+NO_DICTIONARY = bytes(KEY_LENGTH)
+
+# The maximal size of a zlib dictionary
+MAX_DICTIONARY = 32768
+
+
+def dictionaryKey(dictionary):
+    r"""
+    Return the identifier of a dictionary.
+
+    INPUT:
+
+    - ``dictionary`` - the dictionary as a ``bytes`` object.
+    """
+    return sha256(dictionary).digest()[:KEY_LENGTH]
+
+
+def isEncoded(x):
+    r"""
+    Return whether a value is a binary value stored by a codec.
+
+    INPUT:
+
+    - ``x`` - the value to check.
+    """
+    return isinstance(x, (bytes, bytearray, memoryview))
+
+
+def train(samples, size=MAX_DICTIONARY, length=16):
+    r"""
+    Return a compression dictionary trained on sample strings.
+
+    The dictionary consists of the substrings occurring most often in the
+    samples, with the most frequent ones at the end, where zlib references
+    them most cheaply.
+
+    INPUT:
+
+    - ``samples`` - an iterable of strings.
+
+    - ``size`` - the maximal size of the dictionary
+      (default: ``MAX_DICTIONARY``).
+
+    - ``length`` - the length of the substrings considered (default: 16).
+    """
+    counts = Counter()
+    for s in samples:
+        b = s.encode()
+        counts.update(b[i:i+length] for i in range(len(b) - length + 1))
+    pieces = []
+    total = 0
+    for p, n in counts.most_common():
+        if n < 2 or total + len(p) > size:
+            break
+        pieces.append(p)
+        total += len(p)
+    return b"".join(reversed(pieces))
+
+
+class DataCodec(object):
+    r"""
+    A codec compressing graph data strings.
+
+    A codec without a compression method only decodes values. Values to be
+    written are encoded in the columns given by ``columns``, which default to
+    the ``data`` column of the table of ``ZooGraph``.
+    """
+
+    # The table storing the dictionaries
+    table = "_codec_dictionaries"
+
+    def __init__(self, db, method=None, level=9, dictionary=None,
+                 columns=None):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``db`` - the database using the codec.
+
+        - ``method`` - the compression method, either ``"zlib"`` or
+          ``"lzma"`` (default: ``None``, meaning that values are not
+          encoded).
+
+        - ``level`` - the compression level, or the preset in the case of
+          ``"lzma"`` (default: 9).
+
+        - ``dictionary`` - a ``bytes`` object to be used as a preset
+          dictionary (default: ``None``). Only supported by ``"zlib"``. The
+          dictionary is stored in the database.
+
+        - ``columns`` - a dictionary mapping table names to lists of columns
+          to encode (default: ``None``).
+        """
+        if method is not None and method not in METHODS:
+            raise ValueError("unknown compression method: %s" % method)
+        if dictionary is not None and method != "zlib":
+            raise ValueError("dictionaries are only supported by zlib")
+        self.db = db
+        self.method = method
+        self.level = level
+        self.columns = columns
+        self.dictionaries = {}
+        self.dictionary = dictionary
+        self.key = NO_DICTIONARY
+        if dictionary is not None:
+            self.key = dictionaryKey(dictionary)
+            self.storeDictionary(dictionary)
+
+    def targetColumns(self):
+        r"""
+        Return the dictionary mapping table names to lists of columns to be
+        encoded.
+        """
+        if self.columns is None:
+            from ..entities.zoograph import ZooGraph
+            self.columns = {ZooGraph._spec["name"]: ["data"]}
+        return self.columns
+
+    def initTable(self):
+        r"""
+        Create the table storing the dictionaries if it does not exist.
+        """
+        cur = self.db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS %s (%s TEXT PRIMARY KEY, '
+                    '%s BLOB NOT NULL)' %
+                    (self.db.quoteIdent(self.table),
+                     self.db.quoteIdent("hash"),
+                     self.db.quoteIdent("dictionary")))
+        cur.close()
+
+    def storeDictionary(self, dictionary):
+        r"""
+        Store a dictionary in the database unless it is already present.
+
+        INPUT:
+
+        - ``dictionary`` - the dictionary as a ``bytes`` object.
+        """
+        key = dictionaryKey(dictionary)
+        self.dictionaries[key] = dictionary
+        self.initTable()
+        cur = self.db.query([Column("hash")], self.table,
+                            Column("hash") == Value(key.hex()))
+        found = cur.fetchone() is not None
+        cur.close()
+        if not found:
+            self.db.insert_row(self.table, {"hash": key.hex(),
+                                            "dictionary": dictionary},
+                               cur=False)
+
+    def getDictionary(self, key):
+        r"""
+        Return the dictionary with the given identifier.
+
+        INPUT:
+
+        - ``key`` - the identifier of the dictionary.
+        """
+        if key == NO_DICTIONARY:
+            return None
+        dictionary = self.dictionaries.get(key)
+        if dictionary is None:
+            cur = self.db.query([Column("dictionary")], self.table,
+                                Column("hash") == Value(key.hex()))
+            r = cur.fetchone()
+            cur.close()
+            if r is None:
+                raise KeyError("unknown dictionary: %s" % key.hex())
+            dictionary = self.dictionaries[key] = bytes(r[0])
+        return dictionary
+
+    def encode(self, s):
+        r"""
+        Return a compressed binary value representing a string.
+
+        INPUT:
+
+        - ``s`` - the string to encode.
+        """
+        b = s.encode()
+        if self.method == "zlib":
+            if self.dictionary is None:
+                c = zlib.compressobj(self.level)
+            else:
+                c = zlib.compressobj(self.level, zdict=self.dictionary)
+            body = c.compress(b) + c.flush()
+        else:
+            body = lzma.compress(b, preset=self.level)
+        return MAGIC + METHODS[self.method] + self.key + body
+
+    def decode(self, x):
+        r"""
+        Return the string represented by a stored value.
+
+        Strings are returned unchanged.
+
+        INPUT:
+
+        - ``x`` - the stored value.
+        """
+        if not isEncoded(x):
+            return x
+        x = bytes(x)
+        if x[:len(MAGIC)] != MAGIC:
+            raise ValueError("not an encoded value")
+        start = len(MAGIC)
+        method = x[start:start+1]
+        key = x[start+1:start+1+KEY_LENGTH]
+        body = x[start+1+KEY_LENGTH:]
+        if method == METHODS["zlib"]:
+            dictionary = self.getDictionary(key)
+            if dictionary is None:
+                d = zlib.decompressobj()
+            else:
+                d = zlib.decompressobj(zdict=dictionary)
+            b = d.decompress(body) + d.flush()
+        elif method == METHODS["lzma"]:
+            b = lzma.decompress(body)
+        else:
+            raise ValueError("unknown compression method")
+        return b.decode()
+
+    def encodeRow(self, table, row):
+        r"""
+        Return a row with the string values in the encoded columns replaced
+        by their compressed representations.
+
+        INPUT:
+
+        - ``table`` - the table the row belongs to.
+
+        - ``row`` - a dictionary mapping columns to values.
+        """
+        if self.method is None or not isinstance(table, str):
+            return row
+        cols = [c for c in self.targetColumns().get(table, [])
+                if isinstance(row.get(c), str)]
+        if not cols:
+            return row
+        return {**row, **{c: self.encode(row[c]) for c in cols}}
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        if self.method is None:
+            return "Decoding codec for %s" % self.db
+        return "%s codec%s for %s" % \
+            (self.method, "" if self.dictionary is None
+             else " with dictionary", self.db)
+
+
+def samples(db, n=100):
+    r"""
+    Return a list of stored strings in the encoded columns.
+
+    INPUT:
+
+    - ``db`` - the database to sample.
+
+    - ``n`` - the maximal number of strings per column (default: 100).
+    """
+    out = []
+    codec = db.codec if db.codec is not None else DataCodec(db)
+    for table, cols in codec.targetColumns().items():
+        for c in cols:
+            cur = db.query([Column(c)], table, IsNotNull(Column(c)),
+                           limit=n)
+            out += [db.decode_data(r[0]) for r in cur.fetchall()]
+            cur.close()
+    return out
+
+
+def migrate(db, batch=1000, vacuum=True):
+    r"""
+    Convert the stored values in the encoded columns in place.
+
+    If the database uses a codec compressing values (see
+    ``SQLDB.use_codec``), the strings are compressed. Otherwise, the
+    compressed values are replaced by strings. The values are rewritten in
+    batches, committing after each batch, so the conversion may be resumed if
+    interrupted. Only supported by SQLite. Returns the number of converted
+    values.
+
+    INPUT:
+
+    - ``db`` - the database to convert.
+
+    - ``batch`` - the number of rows rewritten before committing
+      (default: 1000).
+
+    - ``vacuum`` - whether to vacuum the database afterwards, so that the
+      file shrinks (default: ``True``).
+    """
+    from ..entities.zooentity import ZooEntity
+    encode = db.codec is not None and db.codec.method is not None
+    codec = db.codec if db.codec is not None else DataCodec(db)
+    q = db.quoteIdent
+    pkey = ZooEntity._spec["primary_key"]
+    count = 0
+    for table, cols in codec.targetColumns().items():
+        for c in cols:
+            last = None
+            while True:
+                cur = db.cursor()
+                sql = 'SELECT %s, %s FROM %s WHERE typeof(%s) = %s' % \
+                    (q(pkey), q(c), q(table), q(c), db.data_string)
+                data = ['text' if encode else 'blob']
+                if last is not None:
+                    sql += ' AND %s > %s' % (q(pkey), db.data_string)
+                    data.append(last)
+                sql += ' ORDER BY %s LIMIT %d' % (q(pkey), batch)
+                cur.execute(sql, data)
+                rows = cur.fetchall()
+                for id, value in rows:
+                    db.update_rows(table, {c: db.decode_data(value)},
+                                   Column(pkey) == Value(id), cur=cur,
+                                   commit=False)
+                cur.close()
+                db.commit()
+                count += len(rows)
+                if len(rows) < batch:
+                    break
+                last = rows[-1][0]
+    if vacuum:
+        cur = db.cursor()
+        cur.execute('VACUUM')
+        cur.close()
+    return count
@@ -18,6 +18,9 @@ class DB:
     convert_from = None
     track = discretezoo.TRACK_CHANGES
 
+    # Whether the database is opened in read-only mode
+    readonly = False
+
     class __metaclass__(type):
         r"""
         A metaclass for initializing database classes.
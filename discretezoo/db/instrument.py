@@ -0,0 +1,279 @@
+r"""
+Statement instrumentation
+
+This module provides hooks for collecting statistics about the SQL statements
+executed by a database interface. A hook is any callable accepting the
+statement kind, the SQL string with wildcards, the number of parameters, the
+number of rows returned or affected (or ``None`` if unknown), and the latency
+in seconds. Both are measured when the statement is executed, so they do not
+account for rows fetched afterwards (see ``SQLDB.add_hook``). Hooks are
+registered using ``SQLDB.add_hook``. The module also provides a logging
+handler used by ``SQLDB.log_slow_queries``.
+"""
+
+import logging
+import sys
+import threading
+from time import time
+
+
+class LatencyHistogram(object):
+    r"""
+    A histogram of latencies with exponentially growing buckets.
+
+    The bucket with index ``i`` counts the latencies between ``2^(i-1)`` and
+    ``2^i`` microseconds.
+    """
+
+    def __init__(self):
+        r"""
+        Object constructor.
+        """
+        self.buckets = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        r"""
+        Add a latency to the histogram.
+
+        INPUT:
+
+        - ``latency`` - the latency in seconds.
+        """
+        i = int(latency * 1000000).bit_length()
+        if i >= len(self.buckets):
+            self.buckets += [0] * (i + 1 - len(self.buckets))
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        r"""
+        Return the mean latency in seconds.
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        r"""
+        Return an upper bound for the ``q``-quantile of the latencies in
+        seconds.
+
+        INPUT:
+
+        - ``q`` - a number between 0 and 1.
+        """
+        if not self.count:
+            return 0.0
+        n = q * self.count
+        s = 0
+        for i, c in enumerate(self.buckets):
+            s += c
+            if s >= n:
+                return min((1 << i) / 1000000.0, self.max)
+        return self.max
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Latency histogram of %d statements" % self.count
+
+
+class StatementProfiler(object):
+    r"""
+    A hook keeping a latency histogram for each statement shape.
+
+    Statements are identified by their kind and SQL string with wildcards.
+    """
+
+    def __init__(self):
+        r"""
+        Object constructor.
+        """
+        self.histograms = {}
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, kind, sql, params, rows, latency):
+        r"""
+        Record an executed statement.
+
+        INPUT:
+
+        - ``kind`` - the kind of the statement.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``params`` - the number of parameters.
+
+        - ``rows`` - the number of rows returned or affected, or ``None`` if
+          unknown.
+
+        - ``latency`` - the latency in seconds.
+        """
+        key = (kind, sql)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = LatencyHistogram()
+                self.rows[key] = 0
+            h.add(latency)
+            if rows is not None and rows > 0:
+                self.rows[key] += rows
+
+    def clear(self):
+        r"""
+        Discard all collected statistics.
+        """
+        with self.lock:
+            self.histograms.clear()
+            self.rows.clear()
+
+    def stats(self):
+        r"""
+        Return a list of dictionaries describing each statement shape.
+
+        The list is sorted by the total latency in decreasing order.
+        """
+        with self.lock:
+            out = [{"kind": kind, "sql": sql, "count": h.count,
+                    "rows": self.rows[kind, sql], "total": h.total,
+                    "mean": h.mean(), "p50": h.quantile(0.5),
+                    "p99": h.quantile(0.99), "max": h.max}
+                   for (kind, sql), h in self.histograms.items()]
+        return sorted(out, key=lambda s: -s["total"])
+
+    def dump(self, file=None, limit=None):
+        r"""
+        Print the collected statistics.
+
+        INPUT:
+
+        - ``file`` - the file to print to (default: ``None``, meaning the
+          standard output).
+
+        - ``limit`` - the maximal number of statement shapes to print
+          (default: ``None``).
+        """
+        if file is None:
+            file = sys.stdout
+        for s in self.stats()[:limit]:
+            file.write("%8d %10.3fms %9.3fms %9.3fms %9.3fms  %s: %s\n" %
+                       (s["count"], s["total"] * 1000, s["mean"] * 1000,
+                        s["p99"] * 1000, s["max"] * 1000, s["kind"],
+                        s["sql"]))
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Statement profiler for %d statement shapes" % \
+            len(self.histograms)
+
+
+class TableHandler(logging.Handler):
+    r"""
+    A logging handler writing slow queries into a database table.
+
+    The table is created if it does not exist. So that the rows do not
+    become part of the transaction in which the queries are logged, they are
+    kept in memory and written in a separate transaction right after the
+    database is next committed. For this purpose, the handler registers a
+    hook with the database (see ``SQLDB.add_hook``) until it is closed.
+    """
+
+    columns = ["logged", "latency", "statement", "params", "plan"]
+
+    def __init__(self, db, table="slow_queries"):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``db`` - the database to write to.
+
+        - ``table`` - the name of the table (default: ``"slow_queries"``).
+        """
+        logging.Handler.__init__(self)
+        self.db = db
+        self.table = table
+        self.created = False
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        db.add_hook(self.committed)
+
+    def emit(self, record):
+        r"""
+        Queue a log record to be written into the table.
+
+        INPUT:
+
+        - ``record`` - the log record, which should have the attributes
+          ``latency``, ``sql``, ``params`` and ``plan``.
+        """
+        with self.pending_lock:
+            self.pending.append((time(), record))
+
+    def committed(self, kind, sql, params, rows, latency):
+        r"""
+        Write the queued log records into the table after a commit.
+
+        To be registered as a hook (see ``SQLDB.add_hook``). The records are
+        written and committed using the connection of the current thread.
+
+        INPUT:
+
+        - ``kind`` - the kind of the statement.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``params`` - the number of parameters.
+
+        - ``rows`` - the number of rows returned or affected.
+
+        - ``latency`` - the latency in seconds.
+        """
+        if kind != "commit" or not self.pending:
+            return
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = []
+        cur = self.db.cursor()
+        try:
+            if not self.created:
+                q = self.db.quoteIdent
+                cur.execute('CREATE TABLE IF NOT EXISTS %s '
+                            '(%s REAL, %s REAL, %s TEXT, %s TEXT, %s TEXT)' %
+                            ((q(self.table), ) +
+                             tuple(q(c) for c in self.columns)))
+                self.created = True
+            sql = self.db.makeInsert(self.table, self.columns)
+            for logged, record in pending:
+                cur.execute(sql, [logged, record.latency, record.sql,
+                                  record.params, record.plan])
+            cur.connection.commit()
+            self.db.invalidate(self.table)
+        except Exception:
+            try:
+                cur.connection.rollback()
+            except Exception:
+                pass
+            self.handleError(pending[0][1])
+        finally:
+            cur.close()
+
+    def close(self):
+        r"""
+        Close the handler and unregister its hook.
+
+        Queued records which have not been written are discarded.
+        """
+        try:
+            self.db.remove_hook(self.committed)
+        except ValueError:
+            pass
+        logging.Handler.close(self)
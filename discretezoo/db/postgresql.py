@@ -5,7 +5,15 @@ This module defines an interface class implementing the peculiarities of the
 PostgreSQL database.
 """
 
-import psycopg2, psycopg2.extensions, psycopg2.extras
+import psycopg2, psycopg2.extensions, psycopg2.extras, psycopg2.pool
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from io import StringIO
+from itertools import count
 from types import ModuleType
 from .query import And
 from .query import BitwiseXOr
@@ -16,6 +24,242 @@ from .query import enlist
 from .sqldb import SQLDB
 from ..util.utility import lookup
 
+# Generator of names for server-side cursors
+CURSOR_NAMES = ("zoo_cursor_%d" % i for i in count())
+
+# Generators of names for prepared queries and other prepared statements
+QUERY_NAMES = ("zoo_query_%d" % i for i in count())
+STATEMENT_NAMES = ("zoo_statement_%d" % i for i in count())
+
+# Wildcards and escaped percent signs in SQL strings
+WILDCARD = re.compile(r'%[s%]')
+
+# Statements which do not modify the database
+READ_STATEMENT = re.compile(r'\s*(?:(?:SELECT|EXPLAIN|SHOW|PREPARE|DEALLOCATE|'
+                            r'SAVEPOINT|RELEASE|ROLLBACK\s+TO)\b|'
+                            r'EXECUTE\s+zoo_query_)', re.I)
+
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    r"""
+    A thread-safe connection pool waiting for a connection to become
+    available when all connections are in use.
+    """
+
+    def __init__(self, minconn, maxconn, *largs, **kargs):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``minconn`` - the minimal number of connections.
+
+        - ``maxconn`` - the maximal number of connections.
+
+        - ``timeout`` - the number of seconds to wait for a connection
+          (default: ``None``, meaning that there is no limit).
+
+        Any other input is forwarded to the constructor of
+        ``psycopg2.pool.ThreadedConnectionPool``.
+        """
+        self.timeout = lookup(kargs, "timeout", default=None, destroy=True)
+        self.available = threading.BoundedSemaphore(maxconn)
+        psycopg2.pool.ThreadedConnectionPool.__init__(self, minconn, maxconn,
+                                                      *largs, **kargs)
+
+    def getconn(self, key=None):
+        r"""
+        Check out a connection, waiting for one to become available.
+
+        Raises ``psycopg2.pool.PoolError`` if no connection becomes available
+        within the timeout.
+
+        INPUT:
+
+        - ``key`` - the key of the connection (default: ``None``).
+        """
+        if not self.available.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError("no connection available within "
+                                          "%s seconds" % self.timeout)
+        try:
+            return psycopg2.pool.ThreadedConnectionPool.getconn(self, key)
+        except BaseException:
+            self.available.release()
+            raise
+
+    def putconn(self, conn, key=None, close=False):
+        r"""
+        Return a connection to the pool.
+
+        INPUT:
+
+        - ``conn`` - the connection.
+
+        - ``key`` - the key of the connection (default: ``None``).
+
+        - ``close`` - whether to close the connection (default: ``False``).
+        """
+        psycopg2.pool.ThreadedConnectionPool.putconn(self, conn, key, close)
+        self.available.release()
+
+
+class PinnedConnection(object):
+    r"""
+    The pooled connection used by a thread.
+
+    Keeps track of the open cursors on the connection, and of whether the
+    current transaction has modified the database. When the object is
+    garbage collected (i.e., when its thread exits), the connection is
+    returned to the pool.
+    """
+
+    def __init__(self, pool):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``pool`` - the connection pool.
+        """
+        self.slot = [None]
+        self.cursors = set()
+        self.writes = False
+        self.thread = threading.get_ident()
+        weakref.finalize(self, PinnedConnection.restore,
+                         pool, self.slot).atexit = False
+
+    @property
+    def conn(self):
+        r"""
+        The connection pinned to the thread, or ``None``.
+        """
+        return self.slot[0]
+
+    @staticmethod
+    def restore(pool, slot):
+        r"""
+        Return a pinned connection to the pool.
+
+        If a transaction is in progress, it is rolled back first. If this
+        fails, the connection is closed.
+
+        INPUT:
+
+        - ``pool`` - the connection pool.
+
+        - ``slot`` - a list containing the connection.
+        """
+        conn = slot[0]
+        if conn is None:
+            return
+        slot[0] = None
+        close = bool(conn.closed)
+        if not close and \
+                conn.status != psycopg2.extensions.STATUS_READY:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        try:
+            pool.putconn(conn, close=close)
+        except psycopg2.pool.PoolError:
+            pass
+
+
+class PooledCursor(psycopg2.extras.DictCursor):
+    r"""
+    A cursor providing rows with dictionary-like access.
+
+    If the connection is pinned to a thread, executing a statement which may
+    modify the database keeps the connection pinned until the transaction is
+    committed or rolled back, and closing the cursor may release the
+    connection (see ``PostgreSQLDB.release``).
+    """
+    pin = None
+    untrack = None
+
+    def execute(self, query, vars=None):
+        r"""
+        Execute a statement.
+
+        INPUT:
+
+        - ``query`` - the SQL string.
+
+        - ``vars`` - the parameters of the statement (default: ``None``).
+        """
+        if self.pin is not None and not (isinstance(query, str) and
+                                         READ_STATEMENT.match(query)):
+            self.pin.writes = True
+        return psycopg2.extras.DictCursor.execute(self, query, vars)
+
+    def executemany(self, query, vars_list):
+        r"""
+        Execute a statement for each sequence of parameters.
+
+        INPUT:
+
+        - ``query`` - the SQL string.
+
+        - ``vars_list`` - a sequence of sequences of parameters.
+        """
+        if self.pin is not None:
+            self.pin.writes = True
+        return psycopg2.extras.DictCursor.executemany(self, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        r"""
+        Execute a COPY statement.
+
+        INPUT:
+
+        - ``sql`` - the SQL string.
+
+        - ``file`` - the file to read from or write to.
+
+        - ``size`` - the size of the buffer (default: 8192).
+        """
+        if self.pin is not None:
+            self.pin.writes = True
+        return psycopg2.extras.DictCursor.copy_expert(self, sql, file, size)
+
+    def close(self):
+        r"""
+        Close the cursor.
+        """
+        untrack = self.untrack
+        self.untrack = None
+        psycopg2.extras.DictCursor.close(self)
+        if untrack is not None:
+            untrack()
+
+
+class StreamingCursor(PooledCursor):
+    r"""
+    A server-side cursor providing rows with dictionary-like access.
+    """
+    pass
+
+
+class PreparedStatements(object):
+    r"""
+    The statements prepared on a connection.
+    """
+
+    def __init__(self, generation):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``generation`` - the schema generation the statements were
+          prepared for (see ``PostgreSQLDB.clear_prepared_statements``).
+        """
+        self.generation = generation
+        self.names = OrderedDict()
+        self.seen = OrderedDict()
+        self.failed = set()
+
 
 class PostgreSQLDB(SQLDB):
     r"""
@@ -31,6 +275,31 @@ class PostgreSQLDB(SQLDB):
         Or: 'FALSE'
     }
 
+    explain_analyze_prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    upsert = True
+    bulk_copy = True
+
+    # Connection pool, and the number of seconds to wait for a connection
+    pool = None
+    pool_timeout = None
+    dsn = None
+
+    # Blocks of preallocated IDs in bulk loading mode
+    idblocks = None
+    id_block = 1000
+    lastid = None
+
+    # Server-side prepared statements, registered per connection
+    prepared = None
+    prepared_lock = None
+    prepared_statement_size = 128
+    prepare_threshold = 2
+    prepared_generation = 0
+    prepared_count = 0
+    prepared_hits = 0
+    prepared_evictions = 0
+    prepared_failures = 0
+
     @classmethod
     def _init_class(cl):
         r"""
@@ -77,8 +346,27 @@ class PostgreSQLDB(SQLDB):
 
         - ``port`` - port number.
 
+        - ``pool`` - if specified, a pool of connections is used instead of a
+          single connection. Should be a pair specifying the minimal and
+          maximal number of connections, or an integer specifying the maximal
+          number of connections. A connection is checked out from the pool
+          by a thread on its first use, and is returned to the pool once the
+          thread has no open cursors and no uncommitted changes (see
+          ``release``), or when the thread exits. When all connections are in
+          use, a thread waits for one to become available. Note that
+          buffered inserts (see ``buffered``) are shared by all threads.
+
+        - ``pool_timeout`` - the number of seconds to wait for a pooled
+          connection before raising ``psycopg2.pool.PoolError`` (default:
+          ``None``, meaning that there is no limit).
+
         Please refer to the psycopg2 manual for details.
         """
+        pool = lookup(kargs, "pool", default=None, destroy=True)
+        self.pool_timeout = lookup(kargs, "pool_timeout", default=None,
+                                   destroy=True)
+        self.prepared = weakref.WeakKeyDictionary()
+        self.prepared_lock = threading.Lock()
         for arg in largs:
             d = None
             if isinstance(arg, str):
@@ -93,7 +381,110 @@ class PostgreSQLDB(SQLDB):
                 for k in d:
                     if k[:1] != '_':
                         kargs[k] = d[k]
-        self.db = psycopg2.connect(**kargs)
+        if pool is None:
+            self.db = psycopg2.connect(**kargs)
+        else:
+            if isinstance(pool, tuple):
+                minconn, maxconn = pool
+            else:
+                minconn, maxconn = 1, pool
+            self.dsn = psycopg2.extensions.make_dsn(**kargs)
+            self.pool = BlockingConnectionPool(minconn, maxconn,
+                                               timeout=self.pool_timeout,
+                                               **kargs)
+            self.local = threading.local()
+
+    def acquire(self):
+        r"""
+        Return a connection for the current thread.
+
+        The connection is checked out from the pool, waiting for one to
+        become available if necessary, and pinned to the current thread.
+        """
+        pin = getattr(self.local, "pin", None)
+        if pin is None:
+            pin = self.local.pin = PinnedConnection(self.pool)
+        pin.slot[0] = self.pool.getconn()
+        pin.writes = False
+        return pin.conn
+
+    def release(self):
+        r"""
+        Release the connection used by the current thread.
+
+        Called after each commit and rollback. If a connection pool is used,
+        the connection pinned to the current thread is returned to the pool,
+        unless the thread still has open cursors on it or is within a
+        transaction scope (see ``transaction``). Otherwise, the connection is
+        returned once the last open cursor of the thread is closed or garbage
+        collected, provided that no statement which may modify the database
+        has been executed since. If a read-only transaction is in progress,
+        it is rolled back first.
+        """
+        pin = None if self.local is None else getattr(self.local, "pin", None)
+        if pin is not None:
+            pin.writes = False
+            self.releaseIdle()
+
+    def releaseIdle(self):
+        r"""
+        Return the connection pinned to the current thread to the pool if it
+        is not in use.
+        """
+        pin = getattr(self.local, "pin", None)
+        if pin is None or pin.conn is None or pin.cursors or pin.writes or \
+                self.transaction_depth > 0:
+            return
+        self.local.conn = None
+        PinnedConnection.restore(self.pool, pin.slot)
+
+    def untrack(self, pinref, ref):
+        r"""
+        Stop tracking a closed or garbage collected cursor.
+
+        If it was the last open cursor on the connection pinned to the current
+        thread, the connection is released if it is not in use (see
+        ``release``).
+
+        INPUT:
+
+        - ``pinref`` - a weak reference to the ``PinnedConnection`` object
+          of the cursor's thread.
+
+        - ``ref`` - a weak reference to the cursor.
+        """
+        pin = pinref()
+        if pin is None or ref not in pin.cursors:
+            return
+        pin.cursors.discard(ref)
+        if not pin.cursors and pin.thread == threading.get_ident():
+            self.releaseIdle()
+
+    def trackCursor(self, make):
+        r"""
+        Create a cursor and track it if connections are pooled.
+
+        INPUT:
+
+        - ``make`` - a function creating a cursor on the given connection.
+        """
+        while True:
+            conn = self.db
+            cur = make(conn)
+            if self.local is None:
+                return cur
+            pin = self.local.pin
+            if pin.conn is conn:
+                break
+            # The connection has been released while creating the cursor
+            cur.close()
+        pinref = weakref.ref(pin)
+        ref = weakref.ref(cur, partial(self.untrack, pinref))
+        pin.cursors.add(ref)
+        if isinstance(cur, PooledCursor):
+            cur.pin = pin
+            cur.untrack = partial(self.untrack, pinref, ref)
+        return cur
 
     def cursor(self, **kargs):
         r"""
@@ -102,17 +493,164 @@ class PostgreSQLDB(SQLDB):
         INPUT:
 
         - ``cursor_factory`` - the cursor factory to be used. The default
-          value of ``psycopg2.extras.DictCursor`` provides rows with
-          dictionary-like access.
+          value of ``PooledCursor`` provides rows with dictionary-like access.
 
         Any keyword input is forwarded to the Python database interface's
-        ``cursor`` method.
+        ``cursor`` method. If a connection pool is used, the connection
+        remains pinned to the current thread while the cursor is open.
         """
         try:
             lookup(kargs, 'cursor_factory')
         except KeyError:
-            kargs['cursor_factory'] = psycopg2.extras.DictCursor
-        return self.db.cursor(**kargs)
+            kargs['cursor_factory'] = PooledCursor
+        return self.trackCursor(lambda conn: conn.cursor(**kargs))
+
+    def streaming_cursor(self, itersize=None):
+        r"""
+        Return a cursor suitable for iterating over large result sets.
+
+        Returns a named server-side cursor fetching ``itersize`` rows at once.
+        The cursor is declared ``WITH HOLD``, so it remains usable after the
+        transaction is committed.
+
+        INPUT:
+
+        - ``itersize`` - the number of rows to fetch at once. The default
+          value of ``None`` means that ``itersize`` is used.
+        """
+        cur = self.trackCursor(lambda conn: conn.cursor(
+            name=next(CURSOR_NAMES), cursor_factory=StreamingCursor,
+            withhold=True))
+        cur.itersize = self.itersize if itersize is None else itersize
+        return cur
+
+    def runStatement(self, cur, sql, data):
+        r"""
+        Execute a statement.
+
+        Statements executed at least ``prepare_threshold`` times on a
+        connection are prepared on the server, and subsequently executed
+        using the EXECUTE statement, so that they are not parsed and planned
+        each time. Statements on server-side cursors and statements with
+        floating-point parameters are executed directly, since the parameters
+        of prepared statements are converted to the types inferred when
+        preparing them.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards.
+        """
+        name = None
+        if self.prepared_statement_size and cur.name is None and \
+                not any(isinstance(x, float) for x in data):
+            name = self.preparedStatement(cur, sql)
+        if name is None:
+            cur.execute(sql, data)
+        elif len(data) == 0:
+            cur.execute('EXECUTE %s' % name)
+        else:
+            cur.execute('EXECUTE %s (%s)' %
+                        (name, ', '.join([self.data_string] * len(data))),
+                        data)
+
+    def preparedStatement(self, cur, sql):
+        r"""
+        Return the name of the prepared statement for an SQL string, or
+        ``None`` if it should be executed directly.
+
+        The statement is prepared when it reaches ``prepare_threshold``
+        executions on the cursor's connection. At most
+        ``prepared_statement_size`` statements are kept per connection, and
+        the least recently used ones are deallocated. A statement whose
+        preparation fails (e.g., since the types of its parameters cannot be
+        determined) is always executed directly.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``sql`` - the SQL string with wildcards.
+        """
+        conn = cur.connection
+        with self.prepared_lock:
+            stmts = self.prepared.get(conn)
+            if stmts is None or stmts.generation != self.prepared_generation:
+                if stmts is not None and stmts.names:
+                    cur.execute('DEALLOCATE ALL')
+                stmts = self.prepared[conn] = \
+                    PreparedStatements(self.prepared_generation)
+        name = stmts.names.get(sql)
+        if name is not None:
+            stmts.names.move_to_end(sql)
+            self.prepared_hits += 1
+            return name
+        if sql in stmts.failed:
+            return None
+        n = stmts.seen.pop(sql, 0) + 1
+        if n < self.prepare_threshold:
+            stmts.seen[sql] = n
+            while len(stmts.seen) > self.prepared_statement_size:
+                stmts.seen.popitem(last=False)
+            return None
+        name = next(QUERY_NAMES if READ_STATEMENT.match(sql)
+                    else STATEMENT_NAMES)
+        params = count(1)
+        text = WILDCARD.sub(lambda m: '%' if m.group() == '%%'
+                            else '$%d' % next(params), sql)
+        cur.execute('SAVEPOINT zoo_prepare')
+        try:
+            cur.execute('PREPARE %s AS %s' % (name, text))
+        except psycopg2.Error:
+            cur.execute('ROLLBACK TO SAVEPOINT zoo_prepare')
+            cur.execute('RELEASE SAVEPOINT zoo_prepare')
+            stmts.failed.add(sql)
+            self.prepared_failures += 1
+            return None
+        cur.execute('RELEASE SAVEPOINT zoo_prepare')
+        stmts.names[sql] = name
+        self.prepared_count += 1
+        while len(stmts.names) > self.prepared_statement_size:
+            _, old = stmts.names.popitem(last=False)
+            cur.execute('DEALLOCATE %s' % old)
+            self.prepared_evictions += 1
+        self.prepared_hits += 1
+        return name
+
+    def prepared_statement_info(self):
+        r"""
+        Return a dictionary describing the use of prepared statements.
+
+        The dictionary contains the numbers of statements prepared, of
+        executions of prepared statements, of deallocated statements, and of
+        statements which could not be prepared, as well as the number of
+        connections with prepared statements and the maximal number of
+        statements per connection.
+        """
+        return {"prepared": self.prepared_count,
+                "executions": self.prepared_hits,
+                "evictions": self.prepared_evictions,
+                "failures": self.prepared_failures,
+                "connections": len(self.prepared),
+                "maxsize": self.prepared_statement_size}
+
+    def clear_prepared_statements(self):
+        r"""
+        Discard the prepared statements and reset their counters.
+
+        The statements are deallocated on each connection on its next use.
+        Should be called after the schema is changed other than by
+        ``createGenerated``, since the result types of prepared statements
+        may not change.
+        """
+        self.prepared_generation += 1
+        self.prepared_count = 0
+        self.prepared_hits = 0
+        self.prepared_evictions = 0
+        self.prepared_failures = 0
 
     def binaryOp(self, op, left, right):
         r"""
@@ -160,7 +698,8 @@ class PostgreSQLDB(SQLDB):
         r"""
         Create an index.
 
-        Currently, only unique constraints are respected.
+        Currently, only unique constraints and partial indexes on live rows
+        are respected (see ``indexCondition``).
 
         INPUT:
 
@@ -184,12 +723,218 @@ class PostgreSQLDB(SQLDB):
             if cur.fetchone()[0] is None:
                 idxcols = ', '.join(self.quoteIdent(col) for col in cols)
                 unique = 'UNIQUE ' if 'unique' in cons else ''
-                cur.execute('CREATE %sINDEX %s ON %s(%s)' %
-                            (unique, idxname, self.quoteIdent(name), idxcols))
+                cur.execute('CREATE %sINDEX %s ON %s(%s)%s' %
+                            (unique, idxname, self.quoteIdent(name), idxcols,
+                             self.indexCondition(cons)))
         except psycopg2.ProgrammingError as ex:
             self.db.rollback()
             raise ex
 
+    def createGenerated(self, cur, table, name, exp, t):
+        r"""
+        Create an indexed generated column if it does not exist.
+
+        Since adding a column changes the result types of statements
+        selecting all columns, the prepared statements are discarded if the
+        column is created. See ``SQLDB.createGenerated`` for a description
+        of the parameters.
+        """
+        if not self.columnExists(cur, table, name):
+            self.prepared_generation += 1
+        SQLDB.createGenerated(self, cur, table, name, exp, t)
+
+    def inlineValues(self, sql, data):
+        r"""
+        Replace the wildcards in an SQL string by literals.
+
+        INPUT:
+
+        - ``sql`` - an SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards.
+        """
+        return sql % tuple(self.literal(x) for x in data)
+
+    def columnExists(self, cur, table, column):
+        r"""
+        Return whether a table has a column with the given name.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+
+        - ``column`` - the name of the column.
+        """
+        cur.execute('SELECT 1 FROM information_schema.columns '
+                    'WHERE table_schema = current_schema() '
+                    'AND table_name = %s AND column_name = %s',
+                    [table, column])
+        return cur.fetchone() is not None
+
+    def tableIndexes(self, cur, table):
+        r"""
+        Return a list of lists of columns of the indexes on a table.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+        """
+        cur.execute('SELECT array_agg(a.attname ORDER BY k.n) '
+                    'FROM pg_index AS i, '
+                    'unnest(i.indkey) WITH ORDINALITY AS k(attnum, n), '
+                    'pg_attribute AS a '
+                    'WHERE i.indrelid = to_regclass(%s) '
+                    'AND a.attrelid = i.indrelid AND a.attnum = k.attnum '
+                    'GROUP BY i.indexrelid', [self.quoteIdent(table)])
+        return [list(r[0]) for r in cur.fetchall()]
+
+    def executeMany(self, cur, table, cols, data):
+        r"""
+        Insert multiple rows with the same columns.
+
+        Rows are inserted using multi-row VALUES statements constructed by
+        ``psycopg2.extras.execute_values``, or using a COPY statement in bulk
+        loading mode (see ``bulk_load``).
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - a list of columns to be inserted.
+
+        - ``data`` - a list of lists of values to be inserted.
+        """
+        if len(cols) == 0:
+            SQLDB.executeMany(self, cur, table, cols, data)
+        elif self.idblocks is not None:
+            self.copyRows(cur, table, cols, data)
+        else:
+            psycopg2.extras.execute_values(
+                cur, 'INSERT INTO %s (%s) VALUES %%s' %
+                (self.quoteIdent(table),
+                 ', '.join([self.quoteIdent(c) for c in cols])),
+                data, page_size=self.buffer_size)
+
+    def copyValue(self, x):
+        r"""
+        Format a value for the text format of the COPY statement.
+
+        INPUT:
+
+        - ``x`` - the value to be formatted.
+        """
+        if x is None:
+            return '\\N'
+        elif isinstance(x, bool):
+            return 't' if x else 'f'
+        elif isinstance(x, (bytes, bytearray, memoryview)):
+            return '\\\\x' + bytes(x).hex()
+        return str(x).replace('\\', '\\\\').replace('\t', '\\t') \
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+    def copyRows(self, cur, table, cols, data):
+        r"""
+        Insert multiple rows using a COPY statement.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - a list of columns to be inserted.
+
+        - ``data`` - a list of lists of values to be inserted.
+        """
+        f = StringIO(''.join('%s\n' % '\t'.join(self.copyValue(x)
+                                                  for x in row)
+                             for row in data))
+        cur.copy_expert('COPY %s (%s) FROM STDIN' %
+                        (self.quoteIdent(table),
+                         ', '.join([self.quoteIdent(c) for c in cols])), f)
+
+    def allocate_id(self, table, id):
+        r"""
+        Return a new value of an auto-incrementing ID column.
+
+        The values are obtained from the sequence associated to the column in
+        blocks of ``id_block`` values.
+
+        INPUT:
+
+        - ``table`` - the table containing the ID column.
+
+        - ``id`` - the name of the ID column.
+        """
+        ids = self.idblocks.setdefault((table, id), [])
+        if len(ids) == 0:
+            cur = self.cursor()
+            self.executeStatement(
+                cur, "query", 'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                'FROM generate_series(1, %s)',
+                [self.quoteIdent(table), id, self.id_block])
+            ids.extend(reversed([r[0] for r in cur.fetchall()]))
+            cur.close()
+        return ids.pop()
+
+    @contextmanager
+    def bulk_load(self, size=None, block=None):
+        r"""
+        Return a context manager for loading new objects into the database.
+
+        While the context is active, inserted rows are buffered and written
+        using COPY statements. Values of auto-incrementing ID columns are
+        preallocated from the corresponding sequences, so rows requesting an
+        ID are also buffered. Queries do not see the rows that have not been
+        flushed yet, so this should only be used to load objects which are
+        not yet in the database.
+
+        INPUT:
+
+        - ``size`` - the number of rows after which the buffer is flushed
+          (default: ``None``, meaning that ``buffer_size`` is used).
+
+        - ``block`` - the number of IDs to preallocate at once
+          (default: ``None``, meaning that ``id_block`` is used).
+        """
+        if self.idblocks is not None:
+            with SQLDB.bulk_load(self, size=size):
+                yield self
+            return
+        idblock = self.id_block
+        if block is not None:
+            self.id_block = block
+        self.idblocks = {}
+        try:
+            with SQLDB.bulk_load(self, size=size):
+                yield self
+        finally:
+            self.idblocks = None
+            self.lastid = None
+            self.id_block = idblock
+
+    def insert_row(self, table, row, cur=None, commit=None, id=None):
+        r"""
+        Insert a row into the database.
+
+        In bulk loading mode (see ``bulk_load``), the value of the ID column
+        is preallocated, and the row is buffered. See ``SQLDB.insert_row``
+        for a description of the parameters.
+        """
+        if self.idblocks is not None and id is not None and \
+                row.get(id) is None:
+            self.lastid = self.allocate_id(table, id)
+            row = {**row, id: self.lastid}
+            id = None
+        return SQLDB.insert_row(self, table, row, cur=cur, commit=commit,
+                                id=id)
+
     def returning(self, id):
         r"""
         Format a RETURNING expression.
@@ -225,16 +970,22 @@ class PostgreSQLDB(SQLDB):
         r"""
         Return the ID of the last inserted row.
 
-        Fetches the ID by fetching a row given by the RETURNING clause.
+        Fetches the ID by fetching a row given by the RETURNING clause. In
+        bulk loading mode, the preallocated ID is returned instead.
 
         INPUT:
 
         - ``cur`` - the cursor to be used.
         """
+        if self.lastid is not None:
+            id = self.lastid
+            self.lastid = None
+            return id
         return cur.fetchone()[0]
 
     def __str__(self):
-        d = dict(x.split('=') for x in self.db.dsn.split())
+        dsn = self.db.dsn if self.pool is None else self.dsn
+        d = dict(x.split('=') for x in dsn.split())
         host = d["host"]
         if "user" in d:
             host = "%s@%s" % (d["user"], host)
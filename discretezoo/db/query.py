@@ -6,6 +6,7 @@ This module implements objects used to build query expressions.
 
 import operator
 import re
+from copy import copy
 
 
 class QueryObject(object):
@@ -1214,6 +1215,33 @@ def makeExpression(val):
         return Value(val)
 
 
+def unqualify(exp):
+    r"""
+    Return a copy of an expression with table information removed from
+    columns.
+
+    INPUT:
+
+    - ``exp`` - the expression to copy.
+    """
+    exp = makeExpression(exp)
+    if isinstance(exp, Column):
+        if isinstance(exp.column, str):
+            return Column(exp.column, alias=exp.colalias)
+        return Column(unqualify(exp.column), alias=exp.colalias)
+    exp = copy(exp)
+    if isinstance(exp, BinaryOp):
+        exp.left = unqualify(exp.left)
+        exp.right = unqualify(exp.right)
+    elif isinstance(exp, UnaryOp):
+        exp.exp = unqualify(exp.exp)
+    elif isinstance(exp, LogicalExpression):
+        exp.terms = [unqualify(t) for t in exp.terms]
+    elif isinstance(exp, Count):
+        exp.column = unqualify(exp.column)
+    return exp
+
+
 def makeFields(cl, join=None, by=None, table=None):
     r"""
     Make field objects.
@@ -0,0 +1,1173 @@
+r"""
+Sharded SQLite database interface
+
+This module defines an interface class distributing the rows of graphs over
+several SQLite database files according to their orders. All rows belonging
+to an object - the rows of its class hierarchy and of its properties - are
+stored in the same shard, so the queries on a single shard never need to see
+the other shards. Queries are sent to the shards which may contain matching
+rows, and the results are merged.
+"""
+
+import heapq
+import os
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import ExitStack
+from contextlib import contextmanager
+from itertools import chain
+from itertools import islice
+from .cache import dependencies
+from .codec import samples
+from .codec import train
+from .query import And
+from .query import BinaryOp
+from .query import Column
+from .query import Count
+from .query import Equal
+from .query import GreaterEqual
+from .query import GreaterThan
+from .query import In
+from .query import LessEqual
+from .query import LessThan
+from .query import LogicalExpression
+from .query import Or
+from .query import Order
+from .query import Value
+from .query import makeExpression
+from .sqlite import DBFILE
+from .sqlite import SQLiteDB
+
+# Comparisons with swapped arguments
+FLIPPED = {Equal: Equal, LessThan: GreaterThan, LessEqual: GreaterEqual,
+           GreaterThan: LessThan, GreaterEqual: LessEqual}
+
+
+class ShardRow(object):
+    r"""
+    A row of merged query results.
+
+    Supports access by index and by column name, like the rows returned by
+    the ``sqlite3`` module.
+    """
+
+    def __init__(self, index, values):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``index`` - a dictionary mapping column names to positions.
+
+        - ``values`` - a tuple of values.
+        """
+        self.index = index
+        self.values = values
+
+    def keys(self):
+        r"""
+        Return the list of column names.
+        """
+        return sorted(self.index, key=self.index.get)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.values[self.index[key]]
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Row %s" % (self.values, )
+
+
+class SortKey(object):
+    r"""
+    A key for merging rows sorted by several expressions.
+
+    Null values are smaller than all other values, as in SQLite.
+    """
+    __slots__ = ("values", "orders")
+
+    def __init__(self, values, orders):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``values`` - a tuple of values to compare.
+
+        - ``orders`` - a list of booleans specifying whether the respective
+          values are sorted in ascending order.
+        """
+        self.values = values
+        self.orders = orders
+
+    def __lt__(self, other):
+        for a, b, asc in zip(self.values, other.values, self.orders):
+            if a == b:
+                continue
+            elif a is None:
+                lt = True
+            elif b is None:
+                lt = False
+            else:
+                lt = a < b
+            return lt if asc else not lt
+        return False
+
+
+class ShardedCursor(object):
+    r"""
+    A cursor of the sharded database.
+
+    Statements are executed on the catalog database. The results of queries
+    spanning several shards are read from an iterator of merged rows.
+    """
+
+    def __init__(self, db, cur):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``db`` - the sharded database.
+
+        - ``cur`` - a cursor of the catalog database.
+        """
+        self.db = db
+        self.cur = cur
+        self.result = None
+        self.cursors = []
+        self.count = -1
+
+    def setResult(self, rows, cursors=[], count=-1):
+        r"""
+        Set the rows to be returned by the cursor.
+
+        INPUT:
+
+        - ``rows`` - an iterable of rows.
+
+        - ``cursors`` - a list of cursors to close along with the cursor
+          (default: ``[]``).
+
+        - ``count`` - the number of affected rows (default: ``-1``).
+        """
+        self.closeCursors()
+        self.result = iter(rows)
+        self.cursors = cursors
+        self.count = count
+
+    def closeCursors(self):
+        r"""
+        Close the cursors the results were read from.
+        """
+        for c in self.cursors:
+            c.close()
+        self.cursors = []
+
+    def execute(self, *largs, **kargs):
+        r"""
+        Execute a statement on the catalog database.
+        """
+        self.result = None
+        self.closeCursors()
+        return self.cur.execute(*largs, **kargs)
+
+    def executemany(self, *largs, **kargs):
+        r"""
+        Execute a statement for several sets of parameters on the catalog
+        database.
+        """
+        self.result = None
+        self.closeCursors()
+        return self.cur.executemany(*largs, **kargs)
+
+    def fetchone(self):
+        r"""
+        Return the next row, or ``None`` if there are no more rows.
+        """
+        if self.result is None:
+            return self.cur.fetchone()
+        return next(self.result, None)
+
+    def fetchmany(self, size=1):
+        r"""
+        Return a list of at most ``size`` next rows.
+
+        INPUT:
+
+        - ``size`` - the maximal number of rows to return (default: 1).
+        """
+        if self.result is None:
+            return self.cur.fetchmany(size)
+        return list(islice(self.result, size))
+
+    def fetchall(self):
+        r"""
+        Return a list of all remaining rows.
+        """
+        if self.result is None:
+            return self.cur.fetchall()
+        return list(self.result)
+
+    def close(self):
+        r"""
+        Close the cursor.
+        """
+        self.result = None
+        self.closeCursors()
+        self.cur.close()
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount if self.result is None else self.count
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    def __iter__(self):
+        return iter(self.cur) if self.result is None else self.result
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+
+class ShardedSQLiteDB(SQLiteDB):
+    r"""
+    An interface class for a SQLite database split into shards by the orders
+    of graphs.
+
+    The database consists of a catalog file and one file per shard. The
+    objects are stored in the shard covering their order, while the rows of
+    the remaining tables (e.g., the change log) and of objects not having an
+    order are stored in the catalog. Since the shards are separate files,
+    writing to one of them does not lock the others. Object IDs are allocated
+    in blocks from a separate file, so that they are unique across shards.
+
+    While an object is being written, its rows are held back until the shard
+    is known, i.e., until the row containing its order is inserted; rows that
+    are still held back on commit are written to the catalog. The rows held
+    back are not visible to queries. The order of a stored graph is assumed
+    not to change.
+
+    Tables not keyed by object IDs are stored in the catalog only. In
+    particular, this includes the change log, so writes to any shard also
+    write to the catalog when changes are tracked, and thus hold its lock
+    until they are committed. Concurrent writers should open the database
+    with ``track=False`` to only lock the shards they write to.
+
+    Query results are not cached, queries are not reported to the index
+    advisor, and subqueries on sharded tables are not supported, so count
+    cubes cannot be used with a sharded database.
+    """
+
+    # The column to shard by and the table containing it; if ``None``, the
+    # table of ``ZooGraph`` is used
+    shard_column = "order"
+    shard_table = None
+
+    # The number of object IDs to allocate at once
+    id_block = 1000
+
+    # The maximal number of remembered object locations, and the number of
+    # objects to look up with a single query
+    directory_size = 100000
+    locate_batch = 500
+
+    # Shards are never upserted into, so that rows can be routed one by one
+    upsert = False
+
+    # Count cubes are built by subqueries, which are not supported
+    cube_support = False
+
+    # Sharding state
+    bounds = None
+    shards = None
+    allocator = None
+
+    def connect(self, file=DBFILE, bounds=(), **kargs):
+        r"""
+        Connect to the database.
+
+        INPUT:
+
+        - ``file`` - the file containing the catalog database
+          (default: ``DBFILE``). The shards are stored in files named
+          ``<name>.shard<i><extension>``, and the allocated IDs in a file
+          named ``<name>.ids<extension>``.
+
+        - ``bounds`` - the sequence of orders at which new shards start
+          (default: ``()``). Shard ``i`` contains the graphs with order at
+          least ``bounds[i-1]`` and less than ``bounds[i]``. The same bounds
+          must be given each time the database is opened.
+
+        Any other keyword input is forwarded to ``SQLiteDB.connect``.
+        """
+        SQLiteDB.connect(self, file=file, **kargs)
+        self.bounds = sorted(bounds)
+        base, ext = os.path.splitext(file)
+        self.shards = [SQLiteDB(file="%s.shard%d%s" % (base, i, ext),
+                                track=False, **kargs)
+                       for i in range(len(self.bounds) + 1)]
+        self.routes = {}
+        self.directory = OrderedDict()
+        self.pending = {}
+        self.dirty = set()
+        self.ids = []
+        self.lastid = None
+        from ..entities import zootypes
+        from ..entities.zooentity import ZooEntity
+        for cl in [ZooEntity] + list(zootypes.names.values()):
+            if isinstance(cl, type) and issubclass(cl, ZooEntity) and \
+                    cl._spec is not None:
+                self.addRoutes(cl._spec)
+        if not self.readonly:
+            self.allocator = SQLiteDB(file="%s.ids%s" % (base, ext),
+                                      track=False, timeout=self.timeout,
+                                      retries=self.retries)
+            cur = self.allocator.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS "ids" '
+                        '("next" INTEGER NOT NULL)')
+            cur.execute('INSERT INTO "ids" SELECT 1 WHERE NOT EXISTS '
+                        '(SELECT * FROM "ids")')
+            cur.close()
+            self.allocator.commit()
+
+    def close(self):
+        r"""
+        Close all connections to the catalog and the shards.
+        """
+        for db in self.shards:
+            db.close()
+        if self.allocator is not None:
+            self.allocator.close()
+        SQLiteDB.close(self)
+
+    def cursor(self, **kargs):
+        r"""
+        Return a cursor.
+
+        Any keyword input is forwarded to ``SQLiteDB.cursor``.
+        """
+        return ShardedCursor(self, SQLiteDB.cursor(self, **kargs))
+
+    def shardTable(self):
+        r"""
+        Return the name of the table containing the column to shard by.
+        """
+        if self.shard_table is None:
+            from ..entities.zoograph import ZooGraph
+            return ZooGraph._spec["name"]
+        return self.shard_table
+
+    def shardFor(self, value):
+        r"""
+        Return the index of the shard covering a value.
+
+        INPUT:
+
+        - ``value`` - the value of the column to shard by.
+        """
+        return bisect_right(self.bounds, value)
+
+    def init_table(self, spec, commit=False):
+        r"""
+        Create a table in the catalog and in all shards if it does not exist.
+
+        Tables keyed by object IDs are routed to the shards, as are the tables
+        of their properties, which are routed by their foreign key.
+
+        INPUT:
+
+        - ``spec`` - table specification (see the ``spec/`` folder).
+
+        - ``commit`` - whether to commit after a new table is created
+          (defaut: ``False``).
+        """
+        SQLiteDB.init_table(self, spec, commit=False)
+        for db in self.shards:
+            db.init_table(spec, commit=commit)
+        self.addRoutes(spec)
+        if commit:
+            self.commit()
+
+    def addRoutes(self, spec):
+        r"""
+        Route a table and the tables of its properties to the shards if it is
+        keyed by object IDs.
+
+        The routes of the classes defined when connecting are added by
+        ``connect``, and the routes of other tables when they are initialized.
+
+        INPUT:
+
+        - ``spec`` - table specification (see the ``spec/`` folder).
+        """
+        from ..entities.zooentity import ZooEntity
+        from ..entities.zooproperty import ZooProperty
+        pkey = spec["primary_key"]
+        if pkey == ZooEntity._spec["primary_key"]:
+            self.routes[spec["name"]] = (pkey, pkey)
+            for c in spec["fields"].values():
+                if issubclass(c, ZooProperty):
+                    self.routes[c._spec["name"]] = \
+                        (c._spec["primary_key"], c._foreign_key)
+
+    def allocate(self):
+        r"""
+        Return a new object ID.
+
+        IDs are reserved in blocks of ``id_block`` and committed immediately,
+        so other connections allocate disjoint blocks.
+        """
+        if not self.ids:
+            n = self.id_block
+            cur = self.allocator.cursor()
+            cur.execute('UPDATE "ids" SET "next" = "next" + ?', [n])
+            cur.execute('SELECT "next" FROM "ids"')
+            end = cur.fetchone()[0]
+            cur.close()
+            self.allocator.commit()
+            self.ids = list(range(end - 1, end - n - 1, -1))
+        return self.ids.pop()
+
+    def locate(self, id):
+        r"""
+        Return the database storing an object.
+
+        Returns ``None`` if the object's rows are being held back or the
+        object is not found.
+
+        INPUT:
+
+        - ``id`` - the ID of the object.
+        """
+        return self.locateAll([id]).get(id)
+
+    def locateAll(self, ids):
+        r"""
+        Return a dictionary mapping object IDs to the databases storing them.
+
+        Objects whose rows are being held back and objects which are not
+        found are omitted. The locations of the remaining objects are looked
+        up in the directory of recently seen objects first, and the others
+        are queried for in batches of ``locate_batch``, so that each
+        database is queried once per batch.
+
+        INPUT:
+
+        - ``ids`` - an iterable of object IDs.
+        """
+        out = {}
+        missing = []
+        for id in ids:
+            if id is None or id in self.pending or id in out:
+                continue
+            db = self.directory.get(id)
+            if db is None:
+                missing.append(id)
+            else:
+                self.directory.move_to_end(id)
+                out[id] = db
+        from ..entities.zooentity import ZooEntity
+        table = ZooEntity._spec["name"]
+        pkey = ZooEntity._spec["primary_key"]
+        for db in self.shards + [self]:
+            if not missing:
+                break
+            found = set()
+            for i in range(0, len(missing), self.locate_batch):
+                cond = Or([Column(pkey) == Value(id) for id
+                           in missing[i:i+self.locate_batch]])
+                if db is self:
+                    cur = SQLiteDB.query(self, [Column(pkey)], table, cond,
+                                         cur=SQLiteDB.cursor(self))
+                else:
+                    cur = db.query([Column(pkey)], table, cond)
+                found.update(r[0] for r in cur.fetchall())
+                cur.close()
+            for id in found:
+                self.remember(id, db)
+                out[id] = db
+            missing = [id for id in missing if id not in found]
+        return out
+
+    def remember(self, id, db):
+        r"""
+        Record the database storing an object in the directory.
+
+        The least recently used entries are discarded when the directory
+        holds more than ``directory_size`` entries; the locations of the
+        corresponding objects are queried for again when needed.
+
+        INPUT:
+
+        - ``id`` - the ID of the object.
+
+        - ``db`` - the shard or the catalog.
+        """
+        self.directory[id] = db
+        self.directory.move_to_end(id)
+        while len(self.directory) > self.directory_size:
+            self.directory.popitem(last=False)
+
+    def assign(self, id, db):
+        r"""
+        Record the database storing an object and write its rows held back.
+
+        INPUT:
+
+        - ``id`` - the ID of the object.
+
+        - ``db`` - the shard or the catalog.
+        """
+        self.remember(id, db)
+        for table, row in self.pending.pop(id, []):
+            self.write(db, table, row)
+
+    def write(self, db, table, row):
+        r"""
+        Write a row to a shard or the catalog.
+
+        The row's own ID, if any, is recorded to be stored in the same
+        database.
+
+        INPUT:
+
+        - ``db`` - the shard or the catalog.
+
+        - ``table`` - the table to insert into.
+
+        - ``row`` - a dictionary mapping columns to values to be inserted.
+        """
+        pkey, col = self.routes[table]
+        if pkey != col and row.get(pkey) is not None:
+            self.assign(row[pkey], db)
+        if db is self:
+            SQLiteDB.insert_row(self, table, row, cur=False, commit=False)
+        else:
+            db.insert_row(table, row, cur=False, commit=False)
+            self.dirty.add(db)
+
+    def targets(self, table, cond, deps):
+        r"""
+        Return the list of databases a statement should be sent to.
+
+        If all sharded tables are routed by the same column and the condition
+        fixes its value, only the databases storing the given objects are
+        returned. Otherwise, the shards are restricted by the condition on
+        the column to shard by, and the catalog is included unless the table
+        containing this column is joined.
+
+        INPUT:
+
+        - ``table`` - the ``Table`` or table name.
+
+        - ``cond`` - the condition of the statement.
+
+        - ``deps`` - the set of table names the statement depends on, or
+          ``None`` if unknown.
+        """
+        exp = None if cond is None else makeExpression(cond)
+        routed = None if deps is None else \
+            [t for t in deps if t in self.routes]
+        if routed:
+            cols = {self.routes[t][1] for t in routed}
+            if len(cols) == 1 and exp is not None:
+                ids = self.pinned(exp, cols.pop(), routed)
+                if ids is not None:
+                    out = []
+                    for db in self.locateAll(ids).values():
+                        if db not in out:
+                            out.append(db)
+                    return out
+        shards = None
+        if exp is not None and (deps is None or self.shardTable() in deps):
+            shards = self.shardRange(exp)
+        out = self.shards if shards is None \
+            else [self.shards[i] for i in sorted(shards)]
+        if isinstance(table, str):
+            tables = {table}
+        else:
+            tables = {t["table"] for t in getattr(table, "tables", [])
+                      if not t["left"]}
+        if self.shardTable() not in tables:
+            out = out + [self]
+        return out
+
+    def isColumn(self, exp, column, tables):
+        r"""
+        Check whether an expression is a given column of one of the given
+        tables.
+
+        INPUT:
+
+        - ``exp`` - the expression.
+
+        - ``column`` - the column name.
+
+        - ``tables`` - a collection of table names.
+        """
+        if not isinstance(exp, Column) or exp.column != column:
+            return False
+        if exp.table is None:
+            return True
+        d = dependencies(exp.table)
+        return d is not None and len(d) == 1 and d.pop() in tables
+
+    def pinned(self, exp, column, tables):
+        r"""
+        Return the set of values a condition allows for a column, or ``None``
+        if they cannot be determined.
+
+        INPUT:
+
+        - ``exp`` - the condition.
+
+        - ``column`` - the column name.
+
+        - ``tables`` - a collection of table names the column may belong to.
+        """
+        if isinstance(exp, And):
+            for t in exp.terms:
+                out = self.pinned(t, column, tables)
+                if out is not None:
+                    return out
+            return None
+        elif not isinstance(exp, (Equal, In)):
+            return None
+        left, right = exp.left, exp.right
+        if isinstance(exp, Equal) and isinstance(left, Value):
+            left, right = right, left
+        if not self.isColumn(left, column, tables):
+            return None
+        return self.values(right, isinstance(exp, In))
+
+    def values(self, exp, many):
+        r"""
+        Return the set of values represented by an expression, or ``None``
+        if it does not represent known values.
+
+        INPUT:
+
+        - ``exp`` - the expression.
+
+        - ``many`` - whether the expression represents a collection.
+        """
+        if not many:
+            if isinstance(exp, Value) and exp.value is not None:
+                return {exp.value}
+            return None
+        if isinstance(exp, Value) and \
+                isinstance(exp.value, (list, tuple, set, frozenset)):
+            return set(exp.value)
+        elif isinstance(exp, LogicalExpression) and \
+                all(isinstance(t, Value) for t in exp.terms):
+            return {t.value for t in exp.terms}
+        return None
+
+    def shardRange(self, exp):
+        r"""
+        Return the set of indices of shards that may contain rows satisfying
+        a condition, or ``None`` if all shards may.
+
+        INPUT:
+
+        - ``exp`` - the condition.
+        """
+        if isinstance(exp, And):
+            out = None
+            for t in exp.terms:
+                s = self.shardRange(t)
+                if s is not None:
+                    out = s if out is None else out & s
+            return out
+        elif isinstance(exp, Or):
+            out = set()
+            for t in exp.terms:
+                s = self.shardRange(t)
+                if s is None:
+                    return None
+                out |= s
+            return out
+        elif not isinstance(exp, BinaryOp):
+            return None
+        op, left, right = type(exp), exp.left, exp.right
+        if isinstance(left, Value) and op in FLIPPED:
+            op, left, right = FLIPPED[op], right, left
+        if not self.isColumn(left, self.shard_column, [self.shardTable()]):
+            return None
+        values = self.values(right, op is In)
+        if values is None:
+            return None
+        try:
+            if op in (Equal, In):
+                return {self.shardFor(v) for v in values}
+            v = values.pop()
+            if op is LessThan:
+                return set(range(bisect_left(self.bounds, v) + 1))
+            elif op is LessEqual:
+                return set(range(bisect_right(self.bounds, v) + 1))
+            elif op in (GreaterThan, GreaterEqual):
+                return set(range(bisect_right(self.bounds, v),
+                                 len(self.shards)))
+        except TypeError:
+            pass
+        return None
+
+    def heldBack(self, table, cond, deps):
+        r"""
+        Return the list of rows held back which a statement applies to.
+
+        INPUT:
+
+        - ``table`` - the table name.
+
+        - ``cond`` - the condition of the statement.
+
+        - ``deps`` - the set of table names the statement depends on.
+        """
+        if not self.pending or deps is None or table not in self.routes:
+            return []
+        exp = None if cond is None else makeExpression(cond)
+        ids = None if exp is None else \
+            self.pinned(exp, self.routes[table][1], [table])
+        if ids is None:
+            ids = list(self.pending)
+
+        def matches(row):
+            def parse(e):
+                if isinstance(e, Column) and isinstance(e.column, str):
+                    return row.get(e.column)
+                return e.eval(parse)
+            try:
+                return exp is None or bool(exp.eval(parse))
+            except (NotImplementedError, AttributeError, TypeError):
+                return False
+
+        return [row for id in ids for t, row in self.pending.get(id, [])
+                if t == table and matches(row)]
+
+    def insert_row(self, table, row, cur=None, commit=None, id=None):
+        r"""
+        Insert a row into the database.
+
+        Rows of sharded tables are written to the database storing the object
+        they belong to, or held back until it is known. If ``id`` is given
+        and the row does not contain it, a new object ID is allocated (see
+        ``allocate``).
+
+        See ``SQLDB.insert_row`` for a description of the parameters.
+        """
+        route = self.routes.get(table)
+        if route is None:
+            return SQLiteDB.insert_row(self, table, row, cur=cur,
+                                       commit=commit, id=id)
+        pkey, col = route
+        row = dict(row)
+        if id is not None:
+            if row.get(id) is None:
+                row[id] = self.allocate()
+            self.lastid = row[id]
+        oid = row.get(col)
+        if table == self.shardTable() and \
+                row.get(self.shard_column) is not None:
+            db = self.shards[self.shardFor(row[self.shard_column])]
+            self.assign(oid, db)
+        else:
+            db = self.locate(oid)
+        if db is None:
+            self.pending.setdefault(oid, []).append((table, row))
+        else:
+            self.write(db, table, row)
+        if cur is False:
+            if commit is not False:
+                self.commit()
+            return None
+        if commit:
+            self.commit()
+        return self.cursor() if cur is None else cur
+
+    def insert_rows(self, table, rows, cur=None, commit=None):
+        r"""
+        Insert multiple rows into the database.
+
+        Rows of sharded tables are inserted one by one (see ``insert_row``).
+
+        See ``SQLDB.insert_rows`` for a description of the parameters.
+        """
+        if table not in self.routes:
+            return SQLiteDB.insert_rows(self, table, rows, cur=cur,
+                                        commit=commit)
+        for row in rows:
+            self.insert_row(table, row, cur=False, commit=False)
+        if cur is False:
+            if commit is not False:
+                self.commit()
+            return None
+        if commit:
+            self.commit()
+        return self.cursor() if cur is None else cur
+
+    def modify(self, method, table, largs, cond, cur, commit):
+        r"""
+        Apply an update or a deletion to the relevant shards and the catalog.
+
+        Returns the cursor with the total number of affected rows, or ``None``
+        if ``cur`` is ``False``.
+
+        INPUT:
+
+        - ``method`` - the name of the method to call on each database.
+
+        - ``table`` - the table to be modified.
+
+        - ``largs`` - a list of parameters to pass before the condition.
+
+        - ``cond`` - the condition of the statement.
+
+        - ``cur`` - the cursor to be used (see ``SQLDB.update_rows``).
+
+        - ``commit`` - whether to commit afterwards
+          (see ``SQLDB.update_rows``).
+        """
+        deps = dependencies(table, cond)
+        count = 0
+        for db in self.targets(table, cond, deps):
+            if db is self:
+                c = getattr(SQLiteDB, method)(self, table, *largs, cond=cond,
+                                              cur=SQLiteDB.cursor(self),
+                                              commit=False)
+            else:
+                c = getattr(db, method)(table, *largs, cond=cond,
+                                        commit=False)
+                self.dirty.add(db)
+            if c is not None:
+                count += max(c.rowcount, 0)
+                c.close()
+        return self.finish(cur, commit, count)
+
+    def finish(self, cur, commit, count):
+        r"""
+        Commit if requested and return the cursor holding the number of
+        affected rows.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used (see ``SQLDB.update_rows``).
+
+        - ``commit`` - whether to commit (see ``SQLDB.update_rows``).
+
+        - ``count`` - the number of affected rows.
+        """
+        if cur is False:
+            if commit is not False:
+                self.commit()
+            return None
+        if cur is None:
+            cur = self.cursor()
+        cur.setResult([], count=count)
+        if commit:
+            self.commit()
+        return cur
+
+    def update_rows(self, table, row, cond=False, cur=None, commit=None):
+        r"""
+        Update rows matching specified criteria.
+
+        Rows of sharded tables are updated in the databases which may contain
+        them (see ``targets``), including the rows held back.
+
+        See ``SQLDB.update_rows`` for a description of the parameters.
+        """
+        if table not in self.routes:
+            return SQLiteDB.update_rows(self, table, row, cond=cond, cur=cur,
+                                        commit=commit)
+        if cond is False:
+            raise UserWarning("false condition given; "
+                              "to change all rows specify cond=None")
+        if len(row) == 0:
+            return None if cur is False else cur
+        held = self.heldBack(table, cond, dependencies(table, cond))
+        for r in held:
+            r.update(row)
+        cur = self.modify("update_rows", table, [row], cond, cur, commit)
+        if cur is not None:
+            cur.count += len(held)
+        return cur
+
+    def delete_rows(self, table, cond=False, cur=None, commit=None):
+        r"""
+        Delete rows matching specified criteria.
+
+        Rows of sharded tables are deleted from the databases which may
+        contain them (see ``targets``), including the rows held back.
+
+        See ``SQLDB.delete_rows`` for a description of the parameters.
+        """
+        if table not in self.routes:
+            return SQLiteDB.delete_rows(self, table, cond=cond, cur=cur,
+                                        commit=commit)
+        if cond is False:
+            raise UserWarning("false condition given; "
+                              "to delete all rows specify cond=None")
+        held = self.heldBack(table, cond, dependencies(table, cond))
+        for id, rows in list(self.pending.items()):
+            rows[:] = [(t, r) for t, r in rows
+                       if not any(r is h for h in held)]
+        cur = self.modify("delete_rows", table, [], cond, cur, commit)
+        if cur is not None:
+            cur.count += len(held)
+        return cur
+
+    def lastrowid(self, cur):
+        r"""
+        Return the ID of the last inserted row.
+
+        If an object ID has been allocated by the last insertion, it is
+        returned. Otherwise, the cursor's ``lastrowid`` field is used.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+        """
+        if self.lastid is not None:
+            id = self.lastid
+            self.lastid = None
+            return id
+        return cur.lastrowid
+
+    def query(self, columns, table, cond=None, groupby=None, orderby=None,
+              limit=None, offset=None, distinct=False, cur=None,
+              subquery=False):
+        r"""
+        Perform a query.
+
+        Queries involving sharded tables are sent to the databases which may
+        contain matching rows (see ``targets``). The results are merged
+        according to ``orderby``, or concatenated if no order is given, and
+        the limit and offset are applied to the merged results. Counts are
+        summed over the databases for each group, so the limit is not passed
+        to the databases in this case; the merged counts are not sorted.
+        Queries on the remaining tables are performed on the catalog.
+        Subqueries on sharded tables are not supported.
+
+        See ``SQLDB.query`` for a description of the parameters.
+        """
+        deps = dependencies(table, cond)
+        if deps is not None and not any(t in self.routes for t in deps):
+            return SQLiteDB.query(self, columns, table, cond=cond,
+                                  groupby=groupby, orderby=orderby,
+                                  limit=limit, offset=offset,
+                                  distinct=distinct, cur=cur,
+                                  subquery=subquery)
+        if subquery:
+            raise NotImplementedError("subqueries on sharded tables "
+                                      "are not supported")
+        if orderby is None:
+            orderby = []
+        elif isinstance(orderby, dict):
+            orderby = list(orderby.items())
+        elif not isinstance(orderby, (list, set)):
+            orderby = [orderby]
+        orderby = [Order(x) for x in orderby]
+        columns = list(columns)
+        n = len(columns)
+        cols = columns + [Column(o.exp, alias="_shard%d" % i)
+                          for i, o in enumerate(orderby)]
+        order = [(Column("_shard%d" % i), o.order)
+                 for i, o in enumerate(orderby)]
+        orders = [o.order for o in orderby]
+        counts = [i for i, c in enumerate(columns) if isinstance(c, Count)]
+        if limit is None or counts:
+            sublimit = None
+        else:
+            sublimit = limit + (offset or 0)
+        cursors = []
+        for db in self.targets(table, cond, deps):
+            if db is self:
+                c = SQLiteDB.query(self, cols, table, cond=cond,
+                                   groupby=groupby, orderby=order,
+                                   limit=sublimit, distinct=distinct,
+                                   cur=SQLiteDB.cursor(self))
+            else:
+                c = db.query(cols, table, cond=cond, groupby=groupby,
+                             orderby=order, limit=sublimit,
+                             distinct=distinct)
+            cursors.append(c)
+        index = {}
+        for i, c in enumerate(cols[:n]):
+            if isinstance(c, Column) and c.colalias is not None:
+                index.setdefault(c.colalias, i)
+            elif isinstance(c, Column) and isinstance(c.column, str):
+                index.setdefault(c.column, i)
+            else:
+                index.setdefault(str(c), i)
+
+        def rows(c):
+            for r in c:
+                r = tuple(r)
+                yield (SortKey(r[n:], orders), ShardRow(index, r[:n]))
+
+        if counts:
+            groups = {}
+            for _, r in chain(*(rows(c) for c in cursors)):
+                key = tuple(v for i, v in enumerate(r)
+                            if i not in counts)
+                values = groups.get(key)
+                if values is None:
+                    groups[key] = list(r)
+                else:
+                    for i in counts:
+                        values[i] += r[i]
+            if not groups and not groupby:
+                groups[None] = [0 if i in counts else None
+                                for i in range(n)]
+            out = (ShardRow(index, tuple(v)) for v in groups.values())
+        elif orderby:
+            out = (r for _, r in heapq.merge(*(rows(c) for c in cursors),
+                                             key=lambda p: p[0]))
+        else:
+            out = (r for _, r in chain(*(rows(c) for c in cursors)))
+        start = offset or 0
+        out = islice(out, start, None if limit is None else start + limit)
+        if cur is None:
+            cur = self.cursor()
+        cur.setResult(out, cursors)
+        return cur
+
+    def commit(self, **kargs):
+        r"""
+        Commit the active transactions on the modified shards and the
+        catalog.
+
+        The rows still held back are written to the catalog first. The
+        shards are committed before the catalog, but the commits are not
+        atomic across files.
+
+        Any keyword input is forwarded to ``SQLDB.commit``.
+        """
+        if self.transaction_depth > 0:
+            return
+        for id in list(self.pending):
+            self.assign(id, self)
+        dirty, self.dirty = self.dirty, set()
+        for db in dirty:
+            db.commit()
+        SQLiteDB.commit(self, **kargs)
+
+    def rollback(self, **kargs):
+        r"""
+        Rollback the active transactions on the modified shards and the
+        catalog.
+
+        The rows held back are discarded.
+
+        Any keyword input is forwarded to ``SQLDB.rollback``.
+        """
+        self.pending.clear()
+        self.directory.clear()
+        dirty, self.dirty = self.dirty, set()
+        for db in dirty:
+            if db.transaction_depth == 0:
+                db.rollback()
+        SQLiteDB.rollback(self, **kargs)
+
+    def use_codec(self, method="zlib", level=9, dictionary=None,
+                  sample_size=100):
+        r"""
+        Store graph data compressed in the catalog and all shards.
+
+        A trained dictionary is trained once on samples from all shards and
+        stored in each database. See ``SQLDB.use_codec`` for a description
+        of the parameters.
+        """
+        if dictionary is True:
+            dictionary = train(samples(self, sample_size)) or None
+        for db in self.shards:
+            db.use_codec(method=method, level=level, dictionary=dictionary)
+        return SQLiteDB.use_codec(self, method=method, level=level,
+                                  dictionary=dictionary)
+
+    def migrate_data(self, batch=1000, vacuum=True):
+        r"""
+        Convert the stored graph data in the shards and the catalog in place.
+
+        See ``SQLDB.migrate_data`` for a description of the parameters.
+        """
+        return sum(db.migrate_data(batch=batch, vacuum=vacuum)
+                   for db in self.shards) + \
+            SQLiteDB.migrate_data(self, batch=batch, vacuum=vacuum)
+
+    def maintain(self, tables=None):
+        r"""
+        Refresh the planner statistics of the shards and the catalog.
+
+        Only the sharded tables are analyzed in the shards.
+
+        INPUT:
+
+        - ``tables`` - a list of names of tables to analyze (default:
+          ``None``, meaning that all tables are analyzed).
+        """
+        if self.readonly:
+            return
+        routed = None if tables is None else \
+            [t for t in tables if t in self.routes]
+        if routed is None or routed:
+            for db in self.shards:
+                db.maintain(routed)
+        SQLiteDB.maintain(self, tables)
+
+    @contextmanager
+    def buffered(self, size=None):
+        r"""
+        Return a context manager buffering inserted rows in the catalog and
+        all shards.
+
+        See ``SQLDB.buffered`` for a description of the parameters.
+        """
+        with ExitStack() as stack:
+            for db in self.shards:
+                stack.enter_context(db.buffered(size=size))
+            stack.enter_context(SQLiteDB.buffered(self, size=size))
+            yield self
+
+    @contextmanager
+    def transaction(self):
+        r"""
+        Return a context manager for a transaction scope spanning the catalog
+        and all shards.
+
+        See ``SQLDB.transaction`` for a description of the scopes.
+        """
+        with ExitStack() as stack:
+            for db in self.shards:
+                stack.enter_context(db.transaction())
+            stack.enter_context(SQLiteDB.transaction(self))
+            yield self
+
+    def streaming_cursor(self, itersize=None):
+        r"""
+        Return a cursor suitable for iterating over large result sets.
+
+        INPUT:
+
+        - ``itersize`` - ignored.
+        """
+        return self.cursor()
+
+    def __str__(self):
+        return "Sharded SQLite database in %s with %d shards" % \
+            (self.file, len(self.shards))
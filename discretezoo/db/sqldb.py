@@ -5,15 +5,33 @@ This module defines a class implementing most methods applicable to SQL
 databases.
 """
 
+import asyncio
+import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
 from sage.rings.integer import Integer
 from sage.rings.rational import Rational
 from sage.rings.real_mpfr import RealNumber
 from sage.rings.real_mpfr import create_RealNumber
 from . import query
+from .cache import ResultCache
+from .codec import DataCodec
+from .codec import isEncoded
+from .codec import migrate
+from .codec import samples
+from .codec import train
+from .cache import dependencies
 from .db import DB
+from .instrument import TableHandler
 from .query import enlist
 from ..util.utility import int_or_real
+from ..entities import zootypes
 from ..entities.zooentity import ZooEntity
 from ..entities.zooproperty import ZooProperty
 
@@ -22,7 +40,10 @@ class SQLDB(DB):
     r"""
     A generic class for SQL databases.
     """
-    db = None
+    conn = None
+
+    # Per-thread state when each thread uses its own connection
+    local = None
 
     data_string = None
     ident_quote = None
@@ -31,6 +52,66 @@ class SQLDB(DB):
     none_val = 'NULL'
     random = 'RANDOM()'
 
+    # Buffer of rows waiting to be inserted, and whether a commit has been
+    # deferred until the buffer is flushed
+    buffer = None
+    buffer_size = 1000
+    buffer_commit = False
+
+    # Whether queries may skip flushing the buffer, and whether bulk loading
+    # uses a dedicated mechanism rather than just buffering
+    bulk = False
+    bulk_copy = False
+
+    # Number of active transaction scopes on the single connection
+    scope_depth = 0
+
+    # Whether INSERT ... ON CONFLICT ... RETURNING is supported
+    upsert = False
+
+    # Number of rows fetched at once by streaming cursors
+    itersize = 2000
+
+    # Executor performing the operations of the asynchronous interface
+    executor = None
+
+    # Cache of compiled queries, and the lock protecting it
+    statements = None
+    statement_lock = None
+    statement_cache_size = 256
+    statement_hits = 0
+    statement_misses = 0
+
+    # Cache of query results
+    cache = None
+
+    # Codec compressing graph data, and whether it is supported
+    codec = None
+    codec_support = False
+
+    # Whether count cubes are supported (see ``zoocube.ZooCube``)
+    cube_support = True
+
+    # Rows written per table since the last analysis, and the number of
+    # written rows after which a table is analyzed on commit
+    written = None
+    analyze_threshold = 10000
+
+    # Functions called after each executed statement
+    hooks = None
+
+    # Index advisor observing the performed queries
+    advisor = None
+
+    # Logging of queries taking at least the threshold (in seconds)
+    slow_query_threshold = None
+    slow_query_logger = None
+    slow_query_analyze = False
+
+    # Prefixes for obtaining query plans, or ``None`` if not supported
+    explain_prefix = 'EXPLAIN '
+    explain_analyze_prefix = 'EXPLAIN ANALYZE '
+
     # Conversions from Sage/Python to database types
     convert_to = {
         Integer: int,
@@ -63,6 +144,15 @@ class SQLDB(DB):
         ZooEntity: 'INTEGER'
     }
 
+    # Generated columns replacing expressions, indexed by expression IDs,
+    # and whether the database supports generated columns
+    generated = None
+    generated_storage = 'STORED'
+    generated_columns = True
+
+    # Column marking deleted rows, excluded from indexes on live rows
+    deleted_column = 'deleted'
+
     # SQL constraint keywords
     constraints = {
         'not_null': 'NOT NULL',
@@ -117,6 +207,18 @@ class SQLDB(DB):
         query.Or: '0'
     }
 
+    def __init__(self, *largs, **kargs):
+        r"""
+        Object constructor.
+
+        After connecting, the existing generated columns are registered (see
+        ``registerGenerated``). See ``DB.__init__`` for a description of the
+        parameters.
+        """
+        self.statement_lock = threading.Lock()
+        DB.__init__(self, *largs, **kargs)
+        self.registerGenerated()
+
     def quoteIdent(self, ident):
         r"""
         Wrap an identifier into appropriate quotes.
@@ -214,6 +316,9 @@ class SQLDB(DB):
           it is returned unchanged.
 
         - ``alias`` - whether to give the table an alias (default: ``True``).
+
+        Boolean constants in join criteria are formatted inline (see
+        ``joinTerm``).
         """
         if isinstance(t, query.Table):
             if not alias and len(t.tables) == 1:
@@ -229,7 +334,8 @@ class SQLDB(DB):
             joins = [' %sJOIN ' % ('LEFT ' if x['left'] else '')
                      for x in t.tables]
             bydata = [{} if not isinstance(x['by'], tuple) else
-                      {k: self.makeExpression(v) for k, v in x['by']}
+                      {k: (v, []) if isinstance(v, bool)
+                       else self.makeExpression(v) for k, v in x['by']}
                       for x in t.tables]
             bykeys = [d.keys() for d in bydata]
             using = ['' if x['by'] is None or len(x['by']) == 0 else
@@ -237,9 +343,8 @@ class SQLDB(DB):
                                                   for c in x['by']]))
                      if isinstance(x['by'], frozenset)
                      else ' ON %s' %
-                     ' AND '.join(['%s.%s = %s' %
-                                   (self.quoteIdent(aliases[i]),
-                                    self.quoteIdent(k), bydata[i][k][0])
+                     ' AND '.join([self.joinTerm(aliases[i], k,
+                                                 bydata[i][k][0])
                                    for k in bykeys[i]]))
                      for i, x in enumerate(t.tables)]
             out = tables[0] + ''.join([joins[i] + tables[i] + using[i]
@@ -252,6 +357,30 @@ class SQLDB(DB):
         else:
             return self.quoteIdent(t), []
 
+    def joinTerm(self, alias, column, exp):
+        r"""
+        Format a term of a join criterion.
+
+        If ``exp`` is a boolean constant, the column itself or its negation is
+        output, so that the term matches the condition of partial indexes
+        (see ``indexCondition``).
+
+        INPUT:
+
+        - ``alias`` - the alias of the joined table.
+
+        - ``column`` - the column of the joined table.
+
+        - ``exp`` - an SQL string representing the expression the column
+          should match in value, or a boolean constant.
+        """
+        col = '%s.%s' % (self.quoteIdent(alias), self.quoteIdent(column))
+        if exp is True:
+            return col
+        elif exp is False:
+            return 'NOT %s' % col
+        return '%s = %s' % (col, exp)
+
     def makeExpression(self, exp, alias=False):
         r"""
         Format an SQL expression.
@@ -265,7 +394,9 @@ class SQLDB(DB):
           ``Table``, an expression for all columns in the table is output. If
           ``exp`` is an ``All`` object, then the expression for all columns in
           all tables is output. In the other cases, ``exp`` is a converted into
-          an ``Expression`` using ``query.makeExpression``.
+          an ``Expression`` using ``query.makeExpression``. Expressions for
+          which a generated column exists (see ``createGenerated``) are
+          replaced by the column.
 
         - ``alias`` - whether to give the expression an alias
           (default: ``False``).
@@ -278,6 +409,8 @@ class SQLDB(DB):
             return ('%s.*' % self.quoteIdent(exp.tables[0]['alias']), [])
         else:
             exp = query.makeExpression(exp)
+        if self.generated and id(exp) in self.generated:
+            exp = self.generated[id(exp)][1]
         if isinstance(exp, query.Value):
             return (self.data_string, [self.to_db_type(exp.value)])
         elif isinstance(exp, query.Column):
@@ -325,244 +458,1514 @@ class SQLDB(DB):
         else:
             raise NotImplementedError
 
-    def cursor(self, **kargs):
+    def tableKey(self, t, values, alias=True):
         r"""
-        Return a cursor.
+        Return a hashable key describing the shape of a table specification.
 
-        Any keyword input is forwarded to the Python database interface's
-        ``cursor`` method.
+        Two table specifications with the same key are formatted by
+        ``makeTable`` into the same SQL string. The values of ``Value``
+        objects are not part of the key - instead, they are appended to
+        ``values`` in the order of the wildcards in the SQL string.
+
+        INPUT:
+
+        - ``t`` - the ``Table`` to compute the key for.
+
+        - ``values`` - the list to append the values to.
+
+        - ``alias`` - whether to give the table an alias (default: ``True``).
         """
-        return self.db.cursor(**kargs)
+        if isinstance(t, query.Table):
+            if not alias and len(t.tables) == 1:
+                return self.tableKey(t.tables[0]['table'], values, alias=False)
+            key = []
+            for x in t.tables:
+                tk = self.tableKey(x['table'], values,
+                                   alias=x['alias'] is None)
+                if isinstance(x['by'], tuple):
+                    by = {k: v for k, v in x['by']}
+                    by = tuple((k, v if isinstance(v, bool)
+                                else self.expressionKey(v, values))
+                               for k, v in by.items())
+                elif x['by'] is None:
+                    by = None
+                else:
+                    by = tuple(x['by'])
+                key.append((tk, x['alias'], x['left'], by))
+            return (query.Table, tuple(key))
+        else:
+            return t
 
-    def commit(self, **kargs):
+    def expressionKey(self, exp, values, alias=False):
         r"""
-        Commit the active transaction.
+        Return a hashable key describing the shape of an SQL expression.
 
-        Any keyword input is forwarded to the Python database interface's
-        ``commit`` method.
+        Two expressions with the same key are formatted by ``makeExpression``
+        into the same SQL string. The values of ``Value`` objects are not part
+        of the key - instead, they are appended to ``values`` in the order of
+        the wildcards in the SQL string. Raises ``NotImplementedError`` if
+        the expression is not supported.
+
+        INPUT:
+
+        - ``exp`` - the ``Expression`` to compute the key for.
+
+        - ``values`` - the list to append the values to.
+
+        - ``alias`` - whether to give the expression an alias
+          (default: ``False``).
         """
-        self.db.commit(**kargs)
+        if exp is None:
+            return (None, )
+        elif isinstance(exp, query.All):
+            return (query.All, )
+        elif isinstance(exp, query.Table):
+            return (query.Table, exp.tables[0]['alias'])
+        else:
+            exp = query.makeExpression(exp)
+        if self.generated and id(exp) in self.generated:
+            exp = self.generated[id(exp)][1]
+        if isinstance(exp, query.Value):
+            values.append(exp.value)
+            return (query.Value, )
+        elif isinstance(exp, query.Column):
+            if isinstance(exp.column, str):
+                key = (exp.column, None if exp.table is None
+                       else self.tableAlias(exp.table))
+            else:
+                key = self.expressionKey(exp.column, values)
+            return (query.Column, key, exp.colalias if alias else None)
+        elif isinstance(exp, query.LogicalExpression):
+            return (exp.__class__,
+                    tuple(self.expressionKey(x, values) for x in exp.terms))
+        elif isinstance(exp, query.BinaryOp):
+            return (exp.__class__, self.expressionKey(exp.left, values),
+                    self.expressionKey(exp.right, values),
+                    getattr(exp, "case", None))
+        elif isinstance(exp, query.UnaryOp):
+            return (exp.__class__, self.expressionKey(exp.exp, values))
+        elif isinstance(exp, query.Random):
+            return (query.Random, )
+        elif isinstance(exp, query.Count):
+            return (query.Count, self.expressionKey(exp.column, values),
+                    exp.distinct)
+        elif isinstance(exp, query.Subquery):
+            return (query.Subquery,
+                    self.queryKey(exp.columns, exp.table, values,
+                                  cond=exp.cond, groupby=exp.groupby,
+                                  orderby=exp.orderby, limit=exp.limit,
+                                  offset=exp.offset))
+        else:
+            raise NotImplementedError
 
-    def rollback(self, **kargs):
+    def queryKey(self, columns, table, values, cond=None, groupby=None,
+                 orderby=None, limit=None, offset=None, distinct=False):
         r"""
-        Rollback the active transaction.
+        Return a hashable key describing the shape of a query.
 
-        Any keyword input is forwarded to the Python database interface's
-        ``rollback`` method.
-        """
-        self.db.rollback(**kargs)
+        Two queries with the same key are formatted by ``makeQuery`` into the
+        same SQL string. The values of ``Value`` objects are not part of the
+        key - instead, they are appended to ``values`` in the order of the
+        wildcards in the SQL string. Raises ``NotImplementedError`` if the
+        query is not supported.
 
-    def handle_exception(self, ex):
+        INPUT:
+
+        - ``values`` - the list to append the values to.
+
+        See ``query`` for a description of other parameters.
+        """
+        cols = tuple(self.expressionKey(col, values, alias=True)
+                     for col in columns)
+        t = self.tableKey(table, values)
+        w = None if cond is None else self.expressionKey(cond, values)
+        g = None
+        if groupby is not None:
+            if not isinstance(groupby, (set, list)):
+                groupby = [groupby]
+            g = tuple(self.expressionKey(grp, values) for grp in groupby)
+        o = None
+        if orderby is not None:
+            if isinstance(orderby, dict):
+                orderby = orderby.items()
+            elif not isinstance(orderby, (list, set)):
+                orderby = [orderby]
+            orderby = [query.Order(x) for x in orderby]
+            o = tuple((self.expressionKey(v.exp, values), v.order)
+                      for v in orderby)
+        return (distinct, cols, t, w, g, o, limit, offset)
+
+    def statement_cache_info(self):
         r"""
-        Clean up after an exception occurs.
+        Return a dictionary describing the state of the statement cache.
 
-        Rolls back the current transaction so that the database will be in a
-        usable state.
+        The dictionary contains the numbers of cache hits and misses, and the
+        current and maximal number of cached statements.
         """
-        self.rollback()
-        raise ex
+        return {"hits": self.statement_hits,
+                "misses": self.statement_misses,
+                "size": 0 if self.statements is None
+                else len(self.statements),
+                "maxsize": self.statement_cache_size}
 
-    def createIndex(self, cur, name, idx):
+    def clear_statement_cache(self):
         r"""
-        Create an index.
+        Clear the statement cache and reset its counters.
+        """
+        with self.statement_lock:
+            self.statements = None
+            self.statement_hits = 0
+            self.statement_misses = 0
 
-        Since different databases handle index creation differently, this
-        method is not implemented and should be overridden.
+    def cache_results(self, size=1024, max_rows=10000, max_entry_rows=1000):
+        r"""
+        Cache the results of queries.
+
+        Results of queries performed without giving a cursor are cached until
+        a table they depend on is written to. Only committed data is cached:
+        results depending on tables written to in the current transaction
+        are not cached until it is committed. Returns the cache used (see
+        ``cache.ResultCache``).
+
+        Since the cache is shared, it cannot be used when each thread uses its
+        own connection, as uncommitted changes made on one connection would
+        not be visible on the others.
 
         INPUT:
 
-        - ``cur`` - the cursor to be used.
+        - ``size`` - the maximal number of cached results (default: 1024).
+          If ``None``, caching is disabled.
 
-        - ``name`` - the table on which the index is to be created.
+        - ``max_rows`` - the maximal total number of cached rows
+          (default: 10000).
 
-        - ``idx`` - a list of columns to be indexed. May also be a tuple
-          containing said list and a collection of constraints.
+        - ``max_entry_rows`` - the maximal number of rows of a single cached
+          result (default: 1000).
         """
-        raise NotImplementedError
+        if size is None:
+            self.cache = None
+        elif self.local is not None:
+            raise ValueError("results cannot be cached when each thread "
+                             "uses its own connection")
+        else:
+            self.cache = ResultCache(size, max_rows, max_entry_rows)
+        return self.cache
 
-    def init_table(self, spec, commit=False):
+    def use_codec(self, method="zlib", level=9, dictionary=None,
+                  sample_size=100):
         r"""
-        Create a table if it does not exist.
+        Store graph data compressed.
+
+        Afterwards, the graph data strings written to the database are stored
+        as compressed binary values (see ``codec.DataCodec``), and are only
+        decompressed when a graph is constructed. Existing values may be
+        converted using ``migrate_data``. The codec is used by the current
+        connection only; compressed values are decoded regardless. Returns
+        the codec used.
+
+        Compressed values cannot be compared to strings, so conditions on the
+        graph data only match the values which have not been compressed.
+        ``ZooInfo.props`` decodes the values it returns.
 
         INPUT:
 
-        - ``spec`` - table specification (see the ``spec/`` folder).
+        - ``method`` - the compression method, either ``"zlib"`` (default) or
+          ``"lzma"``. If ``None``, compression is disabled.
 
-        - ``commit`` - whether to commit after a new table is created
-          (defaut: ``False``).
-        """
-        try:
-            pkey = enlist(spec['primary_key'])
-            idxs = [k[0] if isinstance(k, tuple) else k
-                    for k in spec['indices']]
-            idxs = [enlist(k) for k in idxs]
-            if isinstance(spec['indices'], set):
-                idxs = sorted(idxs)
-            idxs = sum(idxs, [])
-            ext = {k: v for k, v in spec['fields'].items()
-                   if issubclass(v, ZooProperty)}
-            cols = pkey[:]
-            cols += [idxs[i] for i in range(len(idxs))
-                     if idxs[i] not in (cols + idxs[:i])]
-            cols += sorted([k for k in spec['fields'] if k not in ext
-                            and k in spec['fieldparams'] and k not in cols])
-            cols += sorted([k for k in spec['fields']
-                            if k not in ext and k not in cols])
-            colspec = ['%s %s' % (self.quoteIdent(k),
-                                  self.makeType(spec['fields'][k],
-                                                spec['fieldparams'][k]
-                                                if k in spec['fieldparams']
-                                                else set()))
-                       for k in cols]
-            if len(pkey) == 1 and pkey[0] in spec['fieldparams'] and \
-                    "autoincrement" in spec['fieldparams'][pkey[0]]:
-                pkey = []
-            if len(pkey) > 0:
-                colspec += ["PRIMARY KEY (%s)" % ', '.join(pkey)]
-            cur = self.cursor()
-            cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
-                        (self.quoteIdent(spec['name']), ', '.join(colspec)))
-            for idx in spec['indices']:
-                self.createIndex(cur, spec['name'], idx)
-            cur.close()
-            for c in ext.values():
-                self.init_table(c._spec, commit=False)
-            if commit:
-                self.db.commit()
-        except self.exceptions as ex:
-            self.handle_exception(ex)
+        - ``level`` - the compression level, or the preset in the case of
+          ``"lzma"`` (default: 9).
 
-    def returning(self, id):
+        - ``dictionary`` - a ``bytes`` object to be used as a preset
+          dictionary for ``"zlib"``, or ``True`` to train a dictionary on the
+          stored graph data (default: ``None``).
+
+        - ``sample_size`` - the number of stored strings to train the
+          dictionary on (default: 100).
+        """
+        if not self.codec_support:
+            raise NotImplementedError("compressed graph data is not "
+                                      "supported by the database")
+        if dictionary is True:
+            dictionary = train(samples(self, sample_size)) or None
+        self.codec = DataCodec(self, method=method, level=level,
+                               dictionary=dictionary)
+        return self.codec
+
+    def decode_data(self, x):
         r"""
-        Format a RETURNING expression.
+        Return the string represented by a stored graph data value.
 
-        This is not standard SQL, so this method returns an empty string.
+        Values which are not compressed are returned unchanged.
 
         INPUT:
 
-        - ``id`` - the name of the ID column.
+        - ``x`` - the stored value.
         """
-        return ''
+        if not isEncoded(x):
+            return x
+        if self.codec is None:
+            self.codec = DataCodec(self)
+        return self.codec.decode(x)
 
-    def limit(self, limit=None, offset=None):
+    def migrate_data(self, batch=1000, vacuum=True):
         r"""
-        Format a LIMIT clause.
+        Convert the stored graph data in place.
 
-        An OFFSET clause will only be added if ``offset`` is not ``None``.
+        The strings are compressed if a codec is used (see ``use_codec``),
+        and the compressed values are decompressed otherwise. Returns the
+        number of converted values.
 
         INPUT:
 
-        - ``limit`` - the maximal number of rows to output (default: ``None``).
+        - ``batch`` - the number of rows rewritten before committing
+          (default: 1000).
 
-        - ``offset`` - the number of rows to skip (default: ``None``).
+        - ``vacuum`` - whether to vacuum the database afterwards
+          (default: ``True``).
         """
-        out = ''
-        if limit is not None:
-            out += ' LIMIT %d' % limit
-            if offset is not None:
-                out += ' OFFSET %d' % offset
-        return out
+        if not self.codec_support:
+            raise NotImplementedError("compressed graph data is not "
+                                      "supported by the database")
+        return migrate(self, batch=batch, vacuum=vacuum)
 
-    def insert_row(self, table, row, cur=None, commit=None, id=None):
+    def invalidate(self, *tables):
         r"""
-        Insert a row into the database.
+        Discard the cached results depending on the given tables, and do not
+        cache results depending on them until the transaction is committed.
 
-        Returns the cursor used for inserting.
+        Should be called after tables are modified other than through
+        ``insert_row``, ``insert_rows``, ``update_rows`` or ``delete_rows``.
 
         INPUT:
 
-        - ``table`` - the table to insert into.
+        - any unnamed parameter is a table name, or a ``Table`` object.
+          If none are given, all cached results are discarded.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(*tables)
 
-        - ``row`` - a dictionary mapping columns to values to be inserted.
+    def add_hook(self, hook):
+        r"""
+        Register a function to be called after each executed statement.
+
+        The function is called with the kind of the statement (one of
+        ``"query"``, ``"insert"``, ``"update"``, ``"delete"`` and
+        ``"commit"``), the SQL string with wildcards, the number of
+        parameters, the number of rows returned or affected (or ``None`` if
+        unknown), and the latency in seconds. See ``instrument`` for hooks
+        collecting latency histograms. Returns the hook.
+
+        The row counts and latencies are obtained when the statement is
+        executed, before any rows are fetched. The number of rows returned by
+        a query is thus only known if the database interface fetches them
+        when executing it (e.g., for client-side PostgreSQL cursors), and is
+        reported as ``None`` otherwise (e.g., for SQLite and streaming
+        cursors). Likewise, the latency of a query does not include the time
+        spent fetching rows which are not fetched when executing it.
 
-        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
-          will be created. If ``False``, a new cursor will also be created, but
-          not returned.
+        INPUT:
 
-        - ``commit`` - whether to commit after a new row is inserted. If
-          ``None`` (default), commit only if ``cur`` is ``False``.
+        - ``hook`` - the function to register.
+        """
+        if self.hooks is None:
+            self.hooks = []
+        self.hooks.append(hook)
+        return hook
 
-        - ``id`` - the name of the ID column (default: ``None``).
+    def remove_hook(self, hook):
+        r"""
+        Unregister a function registered by ``add_hook``.
+
+        INPUT:
+
+        - ``hook`` - the function to unregister.
         """
-        try:
-            cols = [c for c in row if row[c] is not None]
-            if cur is False:
-                cur = None
-                ret = False
-            else:
-                ret = True
-            if cur is None:
-                cur = self.cursor()
-            if len(cols) == 0:
-                sql = 'INSERT INTO %s DEFAULT VALUES%s' % \
-                            (self.quoteIdent(table), self.returning(id))
-                data = []
-            else:
-                sql = 'INSERT INTO %s (%s) VALUES (%s)%s' % \
-                            (self.quoteIdent(table),
-                                ', '.join([self.quoteIdent(c) for c in cols]),
-                                ', '.join([self.data_string] * len(cols)),
-                                self.returning(id))
-                data = [self.to_db_type(row[c]) for c in cols]
-            cur.execute(sql, data)
-            if ret:
-                if commit:
-                    self.db.commit()
-                return cur
-            else:
-                cur.close()
-                if commit is not False:
-                    self.db.commit()
-        except self.exceptions as ex:
-            self.handle_exception(ex)
+        self.hooks.remove(hook)
 
-    def lastrowid(self, cur):
+    def log_slow_queries(self, threshold, file=None, table=None,
+                         analyze=False, max_bytes=1 << 20, backups=5):
         r"""
-        Return the ID of the last inserted row.
+        Log queries taking at least the given time.
 
-        Uses the cursor's ``lastrowid`` field.
+        Each logged query is recorded together with its parameters and the
+        plan obtained using ``explain``. Returns the logger used.
 
         INPUT:
 
-        - ``cur`` - the cursor to be used.
+        - ``threshold`` - the minimal latency of a logged query in seconds.
+          If ``None``, logging of slow queries is disabled.
+
+        - ``file`` - the name of the file to log to (default: ``None``). The
+          file is rotated once it grows past ``max_bytes`` bytes, keeping
+          ``backups`` old files.
+
+        - ``table`` - the name of the table to log to (default: ``None``).
+          See ``instrument.TableHandler``.
+
+        - ``analyze`` - whether to execute the query again to obtain the
+          actual costs in the plan (default: ``False``). Raises
+          ``NotImplementedError`` if this is not supported by the database.
+
+        - ``max_bytes`` - the maximal size of the log file in bytes
+          (default: 1 MiB).
+
+        - ``backups`` - the number of old log files to keep (default: 5).
         """
-        return cur.lastrowid
+        if analyze and threshold is not None and \
+                self.explain_analyze_prefix is None:
+            raise NotImplementedError("the database does not report "
+                                      "the actual costs of queries")
+        self.slow_query_threshold = threshold
+        self.slow_query_analyze = analyze
+        logger = logging.getLogger("discretezoo.db.slow.%x" % id(self))
+        for h in logger.handlers[:]:
+            logger.removeHandler(h)
+            h.close()
+        if threshold is None:
+            self.slow_query_logger = None
+            return None
+        logger.setLevel(logging.INFO)
+        if file is not None:
+            h = RotatingFileHandler(file, maxBytes=max_bytes,
+                                    backupCount=backups)
+            h.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            logger.addHandler(h)
+        if table is not None:
+            logger.addHandler(TableHandler(self, table))
+        self.slow_query_logger = logger
+        return logger
+
+    def explain(self, sql, data=[], analyze=False, cur=None):
+        r"""
+        Return the plan for a query as a list of strings.
 
-    def update_rows(self, table, row, cond=False, cur=None, commit=None):
+        INPUT:
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards
+          (default: ``[]``).
+
+        - ``analyze`` - whether to execute the query to obtain the actual
+          costs (default: ``False``). Raises ``NotImplementedError`` if this
+          is not supported by the database.
+
+        - ``cur`` - the cursor to be used (default: ``None``).
+        """
+        prefix = self.explain_analyze_prefix if analyze \
+            else self.explain_prefix
+        if prefix is None:
+            raise NotImplementedError("the database does not report "
+                                      "the actual costs of queries")
+        ret = cur is not None
+        if not ret:
+            cur = self.cursor()
+        cur.execute(prefix + sql, data)
+        plan = [str(r[-1]) for r in cur.fetchall()]
+        if not ret:
+            cur.close()
+        return plan
+
+    def logSlowQuery(self, sql, data, latency):
         r"""
-        Update rows matching specified criteria.
+        Log a slow query together with its plan.
 
-        Returns the cursor used for updating.
+        The plan is obtained within a savepoint, so that a failure to obtain
+        it does not affect the current transaction. In that case, the error
+        is logged in place of the plan.
 
         INPUT:
 
-        - ``table`` - the table to be updated.
+        - ``sql`` - the SQL string with wildcards.
 
-        - ``row`` - a dictionary mapping columns to values to be set.
+        - ``data`` - the list of objects corresponding to the wildcards.
 
-        - ``cond`` - an ``Expression`` specifying the condition necessary for
-          the update to take place. If ``False`` (default), a warning will be
-          raised and no update performed. Other values are converted into an
-          ``Expression`` using ``query.makeExpression``.
+        - ``latency`` - the latency in seconds.
+        """
+        cur = self.cursor()
+        try:
+            cur.execute('SAVEPOINT zoo_explain')
+            try:
+                plan = self.explain(sql, data,
+                                    analyze=self.slow_query_analyze, cur=cur)
+            except self.exceptions as ex:
+                cur.execute('ROLLBACK TO SAVEPOINT zoo_explain')
+                plan = ["plan unavailable: %s" % ex]
+            cur.execute('RELEASE SAVEPOINT zoo_explain')
+        except self.exceptions as ex:
+            plan = ["plan unavailable: %s" % ex]
+        finally:
+            cur.close()
+        self.slow_query_logger.info(
+            "%.3fms %s %r\n%s", latency * 1000, sql, data, "\n".join(plan),
+            extra={"latency": latency, "sql": sql, "params": repr(data),
+                   "plan": "\n".join(plan)})
 
-        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
-          will be created. If ``False``, a new cursor will also be created, but
-          not returned.
+    def reportStatement(self, kind, sql, params, rows, latency):
+        r"""
+        Call the registered hooks with information about a statement.
 
-        - ``commit`` - whether to commit after the rows are updated. If
-          ``None`` (default), commit only if ``cur`` is ``False``.
+        INPUT:
+
+        - ``kind`` - the kind of the statement.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``params`` - the number of parameters.
+
+        - ``rows`` - the number of rows returned or affected. Negative values
+          are reported as ``None``.
+
+        - ``latency`` - the latency in seconds.
         """
-        if cond is False:
-            raise UserWarning("false condition given; "
-                              "to change all rows specify cond=None")
-        if cur is False:
-            cur = None
-            ret = False
+        if rows is not None and rows < 0:
+            rows = None
+        for hook in self.hooks:
+            hook(kind, sql, params, rows, latency)
+
+    def executeStatement(self, cur, kind, sql, data):
+        r"""
+        Execute a statement, reporting it to the registered hooks.
+
+        Queries taking at least ``slow_query_threshold`` seconds are logged
+        (see ``log_slow_queries``). Only the time spent executing the
+        statement is measured (see ``add_hook``).
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``kind`` - the kind of the statement.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards.
+        """
+        if not self.hooks and self.slow_query_logger is None:
+            self.runStatement(cur, sql, data)
+            return
+        start = perf_counter()
+        self.runStatement(cur, sql, data)
+        latency = perf_counter() - start
+        if self.hooks:
+            self.reportStatement(kind, sql, len(data), cur.rowcount, latency)
+        if kind == "query" and self.slow_query_logger is not None and \
+                latency >= self.slow_query_threshold:
+            self.logSlowQuery(sql, data, latency)
+
+    def runStatement(self, cur, sql, data):
+        r"""
+        Execute a statement.
+
+        This generic implementation passes the statement to the cursor.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``sql`` - the SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards.
+        """
+        cur.execute(sql, data)
+
+    def executeRows(self, cur, table, cols, data):
+        r"""
+        Insert multiple rows using ``executeMany``, reporting the insertion
+        to the registered hooks.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - the list of columns to be set.
+
+        - ``data`` - a list of lists of values to be inserted.
+        """
+        if not self.hooks:
+            self.executeMany(cur, table, cols, data)
+            return
+        start = perf_counter()
+        self.executeMany(cur, table, cols, data)
+        self.reportStatement("insert", self.makeInsert(table, cols),
+                             len(cols) * len(data), len(data),
+                             perf_counter() - start)
+
+    @property
+    def db(self):
+        r"""
+        The connection to the database.
+
+        If each thread uses its own connection, the connection for the current
+        thread is returned, acquiring one if necessary (see ``acquire``).
+        """
+        if self.local is None:
+            return self.conn
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.acquire()
+        return conn
+
+    @db.setter
+    def db(self, conn):
+        self.conn = conn
+
+    @property
+    def transaction_depth(self):
+        r"""
+        The number of active transaction scopes (see ``transaction``).
+
+        If each thread uses its own connection, the scopes of the current
+        thread are counted.
+        """
+        state = self if self.local is None else self.local
+        return getattr(state, "scope_depth", 0)
+
+    @transaction_depth.setter
+    def transaction_depth(self, depth):
+        state = self if self.local is None else self.local
+        state.scope_depth = depth
+
+    def acquire(self):
+        r"""
+        Return a connection for the current thread.
+
+        Not implemented, to be overridden by databases using per-thread
+        connections.
+        """
+        raise NotImplementedError
+
+    def release(self):
+        r"""
+        Release the connection used by the current thread.
+
+        Called after each commit and rollback. Does nothing, to be overridden
+        by databases using per-thread connections.
+        """
+        pass
+
+    def cursor(self, **kargs):
+        r"""
+        Return a cursor.
+
+        Any keyword input is forwarded to the Python database interface's
+        ``cursor`` method.
+        """
+        return self.db.cursor(**kargs)
+
+    async def run_async(self, fun, *largs, **kargs):
+        r"""
+        Call a function in the database's executor and return its result.
+
+        The executor is created on first use and has a single thread, so the
+        calls made through it are serialized, and cursors created by them may
+        be used by subsequent calls (see ``aio.AsyncCursor``).
+
+        INPUT:
+
+        - ``fun`` - the function to call.
+
+        - any other parameters are passed to ``fun``.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="discretezoo-db")
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(fun, *largs, **kargs))
+
+    def shutdown_async(self, wait=True):
+        r"""
+        Shut down the executor used by the asynchronous interface.
+
+        A new executor is created if the asynchronous interface is used
+        afterwards.
+
+        INPUT:
+
+        - ``wait`` - whether to wait for the pending calls to finish
+          (default: ``True``).
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+
+    def streaming_cursor(self, itersize=None):
+        r"""
+        Return a cursor suitable for iterating over large result sets.
+
+        This generic implementation returns an ordinary cursor.
+
+        INPUT:
+
+        - ``itersize`` - the number of rows to fetch at once. The default
+          value of ``None`` means that ``itersize`` is used.
+        """
+        return self.cursor()
+
+    def commit(self, **kargs):
+        r"""
+        Commit the active transaction.
+
+        Any buffered rows are written before committing. Afterwards, the
+        connection used by the current thread is released (see ``release``).
+
+        Within a transaction scope (see ``transaction``), this method does
+        nothing - the transaction is committed when the outermost scope is
+        exited.
+
+        Any keyword input is forwarded to the Python database interface's
+        ``commit`` method.
+        """
+        if self.transaction_depth > 0:
+            return
+        self.flush()
+        self.buffer_commit = False
+        if self.hooks:
+            start = perf_counter()
+            self.db.commit(**kargs)
+            self.reportStatement("commit", "COMMIT", 0, None,
+                                 perf_counter() - start)
+        else:
+            self.db.commit(**kargs)
+        if self.cache is not None:
+            self.cache.commit()
+        self.release()
+        if self.analyze_threshold is not None and self.written:
+            due = [t for t, n in self.written.items()
+                   if n >= self.analyze_threshold]
+            if due:
+                self.maintain(due)
+
+    def rollback(self, **kargs):
+        r"""
+        Rollback the active transaction.
+
+        Any buffered rows are discarded. Afterwards, the connection used by
+        the current thread is released (see ``release``).
+
+        Within a transaction scope (see ``transaction``), an exception should
+        be raised instead, so that the scope is rolled back.
+
+        Any keyword input is forwarded to the Python database interface's
+        ``rollback`` method.
+        """
+        if self.transaction_depth > 0:
+            raise UserWarning("rollback requested within a transaction "
+                              "scope; raise an exception to leave it")
+        if self.buffer:
+            self.buffer.clear()
+        self.buffer_commit = False
+        if self.cache is not None:
+            self.cache.rollback()
+        self.db.rollback(**kargs)
+        self.release()
+
+    def handle_exception(self, ex):
+        r"""
+        Clean up after an exception occurs.
+
+        Rolls back the current transaction so that the database will be in a
+        usable state. Within a transaction scope, the rollback is left to the
+        scope being exited by the exception (see ``transaction``).
+        """
+        if self.transaction_depth == 0:
+            self.rollback()
+        raise ex
+
+    def createIndex(self, cur, name, idx):
+        r"""
+        Create an index.
+
+        Since different databases handle index creation differently, this
+        method is not implemented and should be overridden.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``name`` - the table on which the index is to be created.
+
+        - ``idx`` - a list of columns to be indexed. May also be a tuple
+          containing said list and a collection of constraints.
+        """
+        raise NotImplementedError
+
+    def indexCondition(self, cons):
+        r"""
+        Return the condition for a partial index with the given constraints.
+
+        If the constraints contain ``'live'``, the index only covers the rows
+        not marked as deleted by ``deleted_column``. Otherwise, an empty
+        string is returned.
+
+        INPUT:
+
+        - ``cons`` - a collection of constraints.
+        """
+        if 'live' in cons:
+            return ' WHERE NOT %s' % self.quoteIdent(self.deleted_column)
+        return ''
+
+    def tableIndexes(self, cur, table):
+        r"""
+        Return a list of lists of columns of the indexes on a table.
+
+        Since different databases handle index introspection differently,
+        this method is not implemented and should be overridden.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+        """
+        raise NotImplementedError
+
+    def init_table(self, spec, commit=False):
+        r"""
+        Create a table if it does not exist.
+
+        INPUT:
+
+        - ``spec`` - table specification (see the ``spec/`` folder).
+
+        - ``commit`` - whether to commit after a new table is created
+          (defaut: ``False``).
+        """
+        try:
+            pkey = enlist(spec['primary_key'])
+            idxs = [k[0] if isinstance(k, tuple) else k
+                    for k in spec['indices']]
+            idxs = [enlist(k) for k in idxs]
+            if isinstance(spec['indices'], set):
+                idxs = sorted(idxs)
+            idxs = sum(idxs, [])
+            ext = {k: v for k, v in spec['fields'].items()
+                   if issubclass(v, ZooProperty)}
+            cols = pkey[:]
+            cols += [idxs[i] for i in range(len(idxs))
+                     if idxs[i] not in (cols + idxs[:i])]
+            cols += sorted([k for k in spec['fields'] if k not in ext
+                            and k in spec['fieldparams'] and k not in cols])
+            cols += sorted([k for k in spec['fields']
+                            if k not in ext and k not in cols])
+            colspec = ['%s %s' % (self.quoteIdent(k),
+                                  self.makeType(spec['fields'][k],
+                                                spec['fieldparams'][k]
+                                                if k in spec['fieldparams']
+                                                else set()))
+                       for k in cols]
+            if len(pkey) == 1 and pkey[0] in spec['fieldparams'] and \
+                    "autoincrement" in spec['fieldparams'][pkey[0]]:
+                pkey = []
+            if len(pkey) > 0:
+                colspec += ["PRIMARY KEY (%s)" % ', '.join(pkey)]
+            cur = self.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
+                        (self.quoteIdent(spec['name']), ', '.join(colspec)))
+            for idx in spec['indices']:
+                self.createIndex(cur, spec['name'], idx)
+            if 'generated' in spec:
+                for k, (exp, t) in spec['generated'].items():
+                    self.createGenerated(cur, spec['name'], k, exp, t)
+            cur.close()
+            for c in ext.values():
+                self.init_table(c._spec, commit=False)
+            if commit:
+                self.commit()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def literal(self, x):
+        r"""
+        Format a value as an SQL literal.
+
+        INPUT:
+
+        - ``x`` - the value to format.
+        """
+        x = self.to_db_type(x)
+        if x is None:
+            return self.none_val
+        elif isinstance(x, bool):
+            return 'TRUE' if x else 'FALSE'
+        elif isinstance(x, (int, float)):
+            return repr(x)
+        elif isinstance(x, str):
+            return "'%s'" % x.replace("'", "''")
+        raise TypeError("cannot format %s as a literal" % type(x))
+
+    def inlineValues(self, sql, data):
+        r"""
+        Replace the wildcards in an SQL string by literals.
+
+        INPUT:
+
+        - ``sql`` - an SQL string with wildcards.
+
+        - ``data`` - the list of objects corresponding to the wildcards.
+        """
+        parts = sql.split(self.data_string)
+        return parts[0] + ''.join(self.literal(x) + p
+                                  for x, p in zip(data, parts[1:]))
+
+    def columnExists(self, cur, table, column):
+        r"""
+        Return whether a table has a column with the given name.
+
+        Since different databases handle table introspection differently,
+        this method is not implemented and should be overridden.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+
+        - ``column`` - the name of the column.
+        """
+        raise NotImplementedError
+
+    def createGenerated(self, cur, table, name, exp, t):
+        r"""
+        Create an indexed generated column if it does not exist.
+
+        Afterwards, queries containing the expression use the column instead
+        (see ``makeExpression``). If the database does not support generated
+        columns, nothing is done, and the expression is evaluated in queries.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table containing the columns referenced by ``exp``.
+
+        - ``name`` - the name of the generated column.
+
+        - ``exp`` - the expression determining the value of the column.
+
+        - ``t`` - the Sage/Python type of the value.
+        """
+        if not self.generated_columns:
+            return
+        if not self.columnExists(cur, table, name):
+            sql, data = self.makeExpression(query.unqualify(exp))
+            cur.execute('ALTER TABLE %s ADD COLUMN %s %s '
+                        'GENERATED ALWAYS AS (%s) %s' %
+                        (self.quoteIdent(table), self.quoteIdent(name),
+                         self.makeType(t, set()),
+                         self.inlineValues(sql, data),
+                         self.generated_storage))
+            self.invalidate(table)
+        self.createIndex(cur, table, [name])
+        if self.generated is None:
+            self.generated = {}
+        self.generated[id(exp)] = (exp, query.Column(name, table=table))
+
+    def registerGenerated(self):
+        r"""
+        Register the existing generated columns of the classes defined so far.
+
+        Generated columns are registered when the tables are initialized (see
+        ``createGenerated``). This method registers the ones which already
+        exist in the database, so that queries use them even if the tables
+        are not initialized in the current session.
+        """
+        if not self.generated_columns:
+            return
+        specs = [cl._spec for cl in zootypes.names.values()
+                 if isinstance(cl, type) and issubclass(cl, ZooEntity)
+                 and cl._spec is not None and "generated" in cl._spec]
+        if not specs:
+            return
+        try:
+            cur = self.cursor()
+            for spec in specs:
+                for k, (exp, t) in spec["generated"].items():
+                    if self.columnExists(cur, spec["name"], k):
+                        if self.generated is None:
+                            self.generated = {}
+                        self.generated[id(exp)] = \
+                            (exp, query.Column(k, table=spec["name"]))
+            cur.close()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def returning(self, id):
+        r"""
+        Format a RETURNING expression.
+
+        This is not standard SQL, so this method returns an empty string.
+
+        INPUT:
+
+        - ``id`` - the name of the ID column.
+        """
+        return ''
+
+    def limit(self, limit=None, offset=None):
+        r"""
+        Format a LIMIT clause.
+
+        An OFFSET clause will only be added if ``offset`` is not ``None``.
+
+        INPUT:
+
+        - ``limit`` - the maximal number of rows to output (default: ``None``).
+
+        - ``offset`` - the number of rows to skip (default: ``None``).
+        """
+        out = ''
+        if limit is not None:
+            out += ' LIMIT %d' % limit
+            if offset is not None:
+                out += ' OFFSET %d' % offset
+        return out
+
+    def makeInsert(self, table, cols, id=None):
+        r"""
+        Format an INSERT statement.
+
+        INPUT:
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - a list of columns to be inserted.
+
+        - ``id`` - the name of the ID column (default: ``None``).
+        """
+        if len(cols) == 0:
+            return 'INSERT INTO %s DEFAULT VALUES%s' % \
+                (self.quoteIdent(table), self.returning(id))
+        return 'INSERT INTO %s (%s) VALUES (%s)%s' % \
+            (self.quoteIdent(table),
+             ', '.join([self.quoteIdent(c) for c in cols]),
+             ', '.join([self.data_string] * len(cols)),
+             self.returning(id))
+
+    def makeUpsert(self, table, cols, keys, update=None, id=None, rows=1):
+        r"""
+        Format an INSERT statement resolving conflicts on a unique index.
+
+        The statement returns the ID column and the key columns of the
+        inserted or updated rows.
+
+        INPUT:
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - a list of columns to be inserted.
+
+        - ``keys`` - a list of columns forming a unique index.
+
+        - ``update`` - a list of columns to be updated when a conflicting row
+          exists (default: ``None``). If ``None`` or empty, conflicting rows
+          are left unchanged and not returned.
+
+        - ``id`` - the name of the ID column (default: ``None``).
+
+        - ``rows`` - the number of rows to be inserted (default: 1).
+        """
+        if update:
+            action = 'UPDATE SET %s' % \
+                ', '.join('%s = EXCLUDED.%s' % (self.quoteIdent(c),
+                                                self.quoteIdent(c))
+                          for c in update)
+        else:
+            action = 'NOTHING'
+        values = '(%s)' % ', '.join([self.data_string] * len(cols))
+        return 'INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO %s ' \
+            'RETURNING %s' % \
+            (self.quoteIdent(table),
+             ', '.join([self.quoteIdent(c) for c in cols]),
+             ', '.join([values] * rows),
+             ', '.join([self.quoteIdent(c) for c in keys]), action,
+             ', '.join([self.quoteIdent(c) for c in
+                        ([] if id is None else [id]) + keys]))
+
+    def executeMany(self, cur, table, cols, data):
+        r"""
+        Insert multiple rows with the same columns.
+
+        Uses the cursor's ``executemany`` method.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table to insert into.
+
+        - ``cols`` - a list of columns to be inserted.
+
+        - ``data`` - a list of lists of values to be inserted.
+        """
+        cur.executemany(self.makeInsert(table, cols), data)
+
+    @contextmanager
+    def buffered(self, size=None):
+        r"""
+        Return a context manager buffering inserted rows.
+
+        While the context is active, rows inserted by ``insert_row`` without
+        requesting an ID are not written immediately, but are collected and
+        written in batches grouped by the inserted columns. The buffer is
+        flushed when it reaches the specified size, before a statement
+        touching one of the buffered tables is executed, on commit, and when
+        the outermost context is exited. On rollback, the buffer is discarded.
+        Tables are written in the order in which they were first inserted
+        into, so that rows referenced by foreign keys are written first.
+
+        The implicit commits of buffered rows (i.e., when ``commit`` is
+        ``None``) are deferred until the outermost context is exited.
+
+        INPUT:
+
+        - ``size`` - the number of rows after which the buffer is flushed
+          (default: ``None``, meaning that ``buffer_size`` is used).
+        """
+        if self.buffer is not None:
+            yield self
+            return
+        bufsize = self.buffer_size
+        if size is not None:
+            self.buffer_size = size
+        self.buffer = OrderedDict()
+        self.buffer_commit = False
+        try:
+            yield self
+            self.flush()
+            if self.buffer_commit:
+                self.commit()
+        finally:
+            self.buffer = None
+            self.buffer_size = bufsize
+            self.buffer_commit = False
+
+    @contextmanager
+    def bulk_load(self, size=None):
+        r"""
+        Return a context manager for loading new objects into the database.
+
+        While the context is active, queries do not see the rows that have
+        not been flushed yet, so it should only be used to load objects which
+        are not yet in the database. This generic implementation buffers the
+        inserted rows (see ``buffered``); subclasses providing more efficient
+        loading mechanisms set ``bulk_copy``.
+
+        INPUT:
+
+        - ``size`` - the number of rows after which the buffer is flushed
+          (default: ``None``, meaning that ``buffer_size`` is used).
+        """
+        bulk = self.bulk
+        self.bulk = True
+        try:
+            with self.buffered(size=size):
+                yield self
+        finally:
+            self.bulk = bulk
+
+    def recordWrites(self, table, rows):
+        r"""
+        Record the number of rows written to a table.
+
+        INPUT:
+
+        - ``table`` - the table written to, or a ``Table`` object.
+
+        - ``rows`` - the number of written rows. Negative values are ignored.
+        """
+        if rows is None or rows <= 0:
+            return
+        names = dependencies(table)
+        if not names:
+            return
+        if self.written is None:
+            self.written = {}
+        for t in names:
+            self.written[t] = self.written.get(t, 0) + rows
+
+    def analyzeTables(self, cur, tables=None):
+        r"""
+        Refresh the planner statistics.
+
+        This generic implementation runs an ANALYZE statement for each table.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``tables`` - a list of names of tables to analyze (default:
+          ``None``, meaning that the whole database is analyzed).
+        """
+        if tables is None:
+            cur.execute('ANALYZE')
+        else:
+            for t in tables:
+                cur.execute('ANALYZE %s' % self.quoteIdent(t))
+
+    def maintain(self, tables=None):
+        r"""
+        Refresh the planner statistics and commit.
+
+        This method is called on commit for the tables with at least
+        ``analyze_threshold`` rows written since they were last analyzed.
+        It should be called explicitly after the database has been modified
+        by other means. Within a transaction scope, the commit is deferred
+        (see ``transaction``). Does nothing in read-only mode.
+
+        INPUT:
+
+        - ``tables`` - a list of names of tables to analyze (default:
+          ``None``, meaning that the whole database is analyzed).
+        """
+        if self.readonly:
+            return
+        try:
+            cur = self.cursor()
+            self.flush(cur=cur)
+            self.analyzeTables(cur, tables)
+            cur.close()
+            if self.written is not None:
+                if tables is None:
+                    self.written.clear()
+                else:
+                    for t in tables:
+                        self.written.pop(t, None)
+            self.commit()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def begin(self, cur):
+        r"""
+        Start a transaction if none is active.
+
+        This generic implementation does nothing, since the Python database
+        interface starts transactions implicitly.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        r"""
+        Return a context manager for a transaction scope.
+
+        While the context is active, commits requested by the write methods
+        and entities (including commits implied by the default values of the
+        ``commit`` parameters) are suppressed. When the outermost scope is
+        exited normally, the transaction is committed; if it is exited by an
+        exception, the transaction is rolled back.
+
+        Nested scopes are implemented using savepoints: if a nested scope is
+        exited by an exception, only the changes made within it are rolled
+        back, and the exception is propagated to the enclosing scope.
+
+        If each thread uses its own connection, the scopes of each thread
+        apply to its own transaction only.
+        """
+        cur = self.cursor()
+        if self.transaction_depth == 0:
+            self.begin(cur)
+            savepoint = None
+        else:
+            self.flush(cur=cur)
+            savepoint = self.quoteIdent("savepoint%d" %
+                                        self.transaction_depth)
+            cur.execute('SAVEPOINT %s' % savepoint)
+        cur.close()
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if savepoint is None:
+                self.rollback()
+            else:
+                if self.buffer:
+                    self.buffer.clear()
+                self.invalidate()
+                cur = self.cursor()
+                cur.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+                cur.execute('RELEASE SAVEPOINT %s' % savepoint)
+                cur.close()
+            raise
+        self.transaction_depth -= 1
+        if savepoint is None:
+            self.commit()
+        else:
+            cur = self.cursor()
+            cur.execute('RELEASE SAVEPOINT %s' % savepoint)
+            cur.close()
+
+    def flush(self, cur=None, sql=None):
+        r"""
+        Write the buffered rows to the database.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
+          will be created.
+
+        - ``sql`` - if specified, the buffer is only flushed if one of the
+          buffered tables appears in the given SQL string
+          (default: ``None``).
+        """
+        if not self.buffer:
+            return
+        if sql is not None and \
+                not any(self.quoteIdent(t) in sql for t in self.buffer):
+            return
+        rows = self.buffer
+        self.buffer = OrderedDict()
+        close = cur is None
+        if close:
+            cur = self.cursor()
+        for table, groups in rows.items():
+            for cols, data in groups.items():
+                self.executeRows(cur, table, list(cols), data)
+        if close:
+            cur.close()
+
+    def insert_row(self, table, row, cur=None, commit=None, id=None):
+        r"""
+        Insert a row into the database.
+
+        Returns the cursor used for inserting. If rows are being buffered (see
+        ``buffered``) and ``id`` is ``None``, the row is added to the buffer
+        instead of being written immediately, and an implicit commit is
+        deferred until the buffering context is exited.
+
+        INPUT:
+
+        - ``table`` - the table to insert into.
+
+        - ``row`` - a dictionary mapping columns to values to be inserted.
+
+        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
+          will be created. If ``False``, a new cursor will also be created, but
+          not returned.
+
+        - ``commit`` - whether to commit after a new row is inserted. If
+          ``None`` (default), commit only if ``cur`` is ``False``.
+
+        - ``id`` - the name of the ID column (default: ``None``).
+        """
+        try:
+            if self.codec is not None:
+                row = self.codec.encodeRow(table, row)
+            cols = [c for c in row if row[c] is not None]
+            data = [self.to_db_type(row[c]) for c in cols]
+            if cur is False:
+                cur = None
+                ret = False
+            else:
+                ret = True
+            self.invalidate(table)
+            self.recordWrites(table, 1)
+            if self.buffer is not None and id is None:
+                self.buffer.setdefault(table, OrderedDict()) \
+                    .setdefault(tuple(cols), []).append(data)
+                if sum(len(d) for t in self.buffer.values()
+                       for d in t.values()) >= self.buffer_size:
+                    self.flush(cur=cur)
+                if commit:
+                    self.commit()
+                elif commit is None and not ret:
+                    self.buffer_commit = True
+                if ret:
+                    return self.cursor() if cur is None else cur
+                return
+            if cur is None:
+                cur = self.cursor()
+            sql = self.makeInsert(table, cols, id)
+            self.flush(cur=cur, sql=sql)
+            self.executeStatement(cur, "insert", sql, data)
+            if ret:
+                if commit:
+                    self.commit()
+                return cur
+            else:
+                cur.close()
+                if commit is not False:
+                    self.commit()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def insert_rows(self, table, rows, cur=None, commit=None):
+        r"""
+        Insert multiple rows into the database.
+
+        The rows are grouped by the columns having values other than ``None``,
+        and each group is inserted using a single call to ``executeMany``.
+        Returns the cursor used for inserting.
+
+        INPUT:
+
+        - ``table`` - the table to insert into.
+
+        - ``rows`` - an iterable of dictionaries mapping columns to values to
+          be inserted.
+
+        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
+          will be created. If ``False``, a new cursor will also be created, but
+          not returned.
+
+        - ``commit`` - whether to commit after the rows are inserted. If
+          ``None`` (default), commit only if ``cur`` is ``False``.
+        """
+        try:
+            groups = OrderedDict()
+            for row in rows:
+                if self.codec is not None:
+                    row = self.codec.encodeRow(table, row)
+                cols = tuple(c for c in row if row[c] is not None)
+                groups.setdefault(cols, []).append([self.to_db_type(row[c])
+                                                    for c in cols])
+            if cur is False:
+                cur = None
+                ret = False
+            else:
+                ret = True
+            if cur is None:
+                cur = self.cursor()
+            self.invalidate(table)
+            self.recordWrites(table, sum(len(d) for d in groups.values()))
+            self.flush(cur=cur, sql=self.quoteIdent(table))
+            for cols, data in groups.items():
+                self.executeRows(cur, table, list(cols), data)
+            if ret:
+                if commit:
+                    self.commit()
+                return cur
+            else:
+                cur.close()
+                if commit is not False:
+                    self.commit()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def upsert_rows(self, table, rows, keys, update=None, id=None, cur=None,
+                    commit=None):
+        r"""
+        Insert multiple rows into the database, resolving conflicts on a
+        unique index.
+
+        Requires support for ``INSERT ... ON CONFLICT ... RETURNING`` (see
+        ``upsert``). The rows are grouped by the columns having values other
+        than ``None``, and each group is inserted using a single statement.
+        Returns a list of tuples containing the values of the ID column (if
+        given) and the key columns of the inserted or updated rows, in the
+        database types.
+
+        INPUT:
+
+        - ``table`` - the table to insert into.
+
+        - ``rows`` - an iterable of dictionaries mapping columns to values to
+          be inserted. Rows in the same call should have distinct keys.
+
+        - ``keys`` - a list of columns forming a unique index.
+
+        - ``update`` - a list of columns to be updated when a conflicting row
+          exists, or ``True`` to update all inserted columns other than the ID
+          and key columns (default: ``None``). If ``None`` or empty,
+          conflicting rows are left unchanged and not returned.
+
+        - ``id`` - the name of the ID column (default: ``None``).
+
+        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
+          will be created.
+
+        - ``commit`` - whether to commit after the rows are inserted
+          (default: ``None``).
+        """
+        if not self.upsert:
+            raise NotImplementedError("upserts are not supported")
+        try:
+            groups = OrderedDict()
+            for row in rows:
+                if self.codec is not None:
+                    row = self.codec.encodeRow(table, row)
+                cols = tuple(c for c in row if row[c] is not None)
+                groups.setdefault(cols, []).append([self.to_db_type(row[c])
+                                                    for c in cols])
+            close = cur is None
+            if close:
+                cur = self.cursor()
+            self.invalidate(table)
+            self.recordWrites(table, sum(len(d) for d in groups.values()))
+            self.flush(cur=cur, sql=self.quoteIdent(table))
+            out = []
+            for cols, data in groups.items():
+                upd = [c for c in cols if c not in keys and c != id] \
+                    if update is True else update
+                sql = self.makeUpsert(table, list(cols), keys,
+                                      update=upd, id=id, rows=len(data))
+                self.executeStatement(cur, "insert", sql, sum(data, []))
+                out += [tuple(r) for r in cur.fetchall()]
+            if close:
+                cur.close()
+            if commit:
+                self.commit()
+            return out
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def lastrowid(self, cur):
+        r"""
+        Return the ID of the last inserted row.
+
+        Uses the cursor's ``lastrowid`` field.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+        """
+        return cur.lastrowid
+
+    def update_rows(self, table, row, cond=False, cur=None, commit=None):
+        r"""
+        Update rows matching specified criteria.
+
+        Returns the cursor used for updating.
+
+        INPUT:
+
+        - ``table`` - the table to be updated.
+
+        - ``row`` - a dictionary mapping columns to values to be set.
+
+        - ``cond`` - an ``Expression`` specifying the condition necessary for
+          the update to take place. If ``False`` (default), a warning will be
+          raised and no update performed. Other values are converted into an
+          ``Expression`` using ``query.makeExpression``.
+
+        - ``cur`` - the cursor to be used. If ``None`` (default), a new cursor
+          will be created. If ``False``, a new cursor will also be created, but
+          not returned.
+
+        - ``commit`` - whether to commit after the rows are updated. If
+          ``None`` (default), commit only if ``cur`` is ``False``.
+        """
+        if cond is False:
+            raise UserWarning("false condition given; "
+                              "to change all rows specify cond=None")
+        if cur is False:
+            cur = None
+            ret = False
         else:
             ret = True
         if len(row) == 0:
             return cur if ret else None
         try:
+            if self.codec is not None:
+                row = self.codec.encodeRow(table, row)
             t, data = self.makeTable(table)
             cols = row.keys()
             s = ', '.join(['%s = %s' % (self.quoteIdent(c), self.data_string)
@@ -576,15 +1979,18 @@ class SQLDB(DB):
             sql = 'UPDATE %s SET %s%s' % (t, s, w)
             if cur is None:
                 cur = self.cursor()
-            cur.execute(sql, data)
+            self.flush(cur=cur, sql=sql)
+            self.invalidate(table)
+            self.executeStatement(cur, "update", sql, data)
+            self.recordWrites(table, cur.rowcount)
             if ret:
                 if commit:
-                    self.db.commit()
+                    self.commit()
                 return cur
             else:
                 cur.close()
                 if commit is not False:
-                    self.db.commit()
+                    self.commit()
         except self.exceptions as ex:
             self.handle_exception(ex)
 
@@ -628,15 +2034,18 @@ class SQLDB(DB):
             sql = 'DELETE FROM %s%s' % (t, w)
             if cur is None:
                 cur = self.cursor()
-            cur.execute(sql, data)
+            self.flush(cur=cur, sql=sql)
+            self.invalidate(table)
+            self.executeStatement(cur, "delete", sql, data)
+            self.recordWrites(table, cur.rowcount)
             if ret:
                 if commit:
-                    self.db.commit()
+                    self.commit()
                 return cur
             else:
                 cur.close()
                 if commit is not False:
-                    self.db.commit()
+                    self.commit()
         except self.exceptions as ex:
             self.handle_exception(ex)
 
@@ -682,6 +2091,108 @@ class SQLDB(DB):
           (default: ``False``). If ``True``, the query will not be executed -
           instead the method will return a tuple containing an SQL string with
           wildcards, and a list of objects corresponding to the wildcards.
+
+        Queries which are not subqueries are formatted using the statement
+        cache (see ``prepareQuery``), and reported to the index advisor, if
+        set (see ``advisor.IndexAdvisor``). If results are being cached (see
+        ``cache_results``) and ``cur`` is ``None``, a cached result may be
+        returned as a cursor-like object.
+        """
+        try:
+            if subquery:
+                return self.makeQuery(columns, table, cond=cond,
+                                      groupby=groupby, orderby=orderby,
+                                      limit=limit, offset=offset,
+                                      distinct=distinct)
+            sql, data = self.prepareQuery(columns, table, cond=cond,
+                                          groupby=groupby, orderby=orderby,
+                                          limit=limit, offset=offset,
+                                          distinct=distinct)
+            cache = self.cache if cur is None else None
+            if cache is not None:
+                key = (sql, tuple(data))
+                res = cache.get(key)
+                if res is not None:
+                    return res
+                version = cache.version
+            if cur is None:
+                cur = self.cursor()
+            if not self.bulk:
+                self.flush(sql=sql)
+            if self.advisor is None:
+                self.executeStatement(cur, "query", sql, data)
+            else:
+                start = perf_counter()
+                self.executeStatement(cur, "query", sql, data)
+                self.advisor.observe(table, cond=cond, groupby=groupby,
+                                     orderby=orderby,
+                                     latency=perf_counter() - start)
+            if cache is not None:
+                return cache.store(key, dependencies(table, cond), cur,
+                                   version)
+            return cur
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+
+    def prepareQuery(self, columns, table, cond=None, groupby=None,
+                     orderby=None, limit=None, offset=None, distinct=False):
+        r"""
+        Format a query, using the statement cache if possible.
+
+        Returns a tuple containing an SQL string with wildcards, and a list of
+        objects corresponding to the wildcards. The SQL string is looked up in
+        the statement cache by the shape of the query (see ``queryKey``), so
+        only the values need to be extracted on a cache hit. On a miss, the
+        query is formatted by ``makeQuery`` and the result is cached.
+
+        See ``query`` for a description of the parameters.
+        """
+        values = []
+        key = None
+        if self.statement_cache_size > 0:
+            try:
+                key = self.queryKey(columns, table, values, cond=cond,
+                                    groupby=groupby, orderby=orderby,
+                                    limit=limit, offset=offset,
+                                    distinct=distinct)
+            except NotImplementedError:
+                pass
+        if key is not None:
+            with self.statement_lock:
+                if self.statements is None:
+                    self.statements = OrderedDict()
+                sql = self.statements.get(key)
+                if sql is not None:
+                    self.statement_hits += 1
+                    self.statements.move_to_end(key)
+                else:
+                    self.statement_misses += 1
+            if sql is not None:
+                return (sql, [self.to_db_type(v) for v in values])
+        else:
+            self.statement_misses += 1
+        sql, data = self.makeQuery(columns, table, cond=cond, groupby=groupby,
+                                   orderby=orderby, limit=limit,
+                                   offset=offset, distinct=distinct)
+        if key is not None and \
+                [self.to_db_type(v) for v in values] == data:
+            with self.statement_lock:
+                if self.statements is None:
+                    self.statements = OrderedDict()
+                self.statements[key] = sql
+                while len(self.statements) > self.statement_cache_size:
+                    self.statements.popitem(last=False)
+        return (sql, data)
+
+    def makeQuery(self, columns, table, cond=None, groupby=None,
+                  orderby=None, limit=None, offset=None, distinct=False):
+        r"""
+        Format a query.
+
+        Returns a tuple containing an SQL string with wildcards, and a list of
+        objects corresponding to the wildcards.
+
+        See ``query`` for a description of the parameters.
         """
         try:
             dist = 'DISTINCT ' if distinct else ''
@@ -718,12 +2229,7 @@ class SQLDB(DB):
                                   for (k, _), v in orderby)
                     data += sum([x[0][1] for x in orderby], [])
             l = self.limit(limit, offset)
-            sql = 'SELECT %s%s FROM %s%s%s%s%s' % (dist, c, t, w, g, o, l)
-            if subquery:
-                return (sql, data)
-            if cur is None:
-                cur = self.cursor()
-            cur.execute(sql, data)
-            return cur
+            return ('SELECT %s%s FROM %s%s%s%s%s' % (dist, c, t, w, g, o, l),
+                    data)
         except self.exceptions as ex:
             self.handle_exception(ex)
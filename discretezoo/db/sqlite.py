@@ -9,14 +9,118 @@ import errno
 import os
 import shutil
 import sqlite3
+import threading
+import time
+import weakref
+from urllib.request import pathname2url
 from .query import Modulo
 from .query import enlist
 from .sqldb import SQLDB
+from ..entities.zooentity import ZooEntity
+from ..util.utility import lookup
 
 # The default location for the database
 DBFILE = os.path.join(os.path.expanduser('~'),
                       '.discretezoo', 'discretezoo.db')
 
+# The default size of the memory-mapped part of a read-only database
+MMAP_SIZE = 1 << 30
+
+
+class SQLiteConnection(sqlite3.Connection):
+    r"""
+    A connection to an SQLite database.
+
+    Stores the parameters used by ``SQLiteCursor`` to retry statements.
+    """
+    retries = 0
+    retry_delay = 0.1
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    r"""
+    A cursor retrying statements when the database is locked.
+
+    A statement failing because the database is locked is retried up to
+    ``retries`` times, as specified by the connection. The delay between
+    retries starts at ``retry_delay`` seconds and doubles with each retry.
+    """
+
+    def execute(self, *largs):
+        r"""
+        Execute a statement, retrying if the database is locked.
+        """
+        return self.retry(sqlite3.Cursor.execute, *largs)
+
+    def executemany(self, *largs):
+        r"""
+        Execute a statement for each set of parameters, retrying if the
+        database is locked.
+        """
+        return self.retry(sqlite3.Cursor.executemany, *largs)
+
+    def retry(self, fun, *largs):
+        r"""
+        Call ``fun``, retrying if the database is locked.
+
+        INPUT:
+
+        - ``fun`` - the method to be called.
+
+        - any further arguments are passed to ``fun``.
+        """
+        retries = getattr(self.connection, "retries", 0)
+        delay = getattr(self.connection, "retry_delay", 0)
+        i = 0
+        while True:
+            try:
+                return fun(self, *largs)
+            except sqlite3.OperationalError as ex:
+                if i >= retries or "locked" not in str(ex):
+                    raise ex
+            time.sleep(delay * 2**i)
+            i += 1
+
+
+class ThreadConnection(object):
+    r"""
+    The connection used by a thread.
+
+    When the object is garbage collected (i.e., when its thread exits), the
+    connection is closed and removed from the list of open connections.
+    """
+
+    def __init__(self, conn, connections):
+        r"""
+        Object constructor.
+
+        INPUT:
+
+        - ``conn`` - the connection.
+
+        - ``connections`` - the list of open connections of the database.
+        """
+        self.conn = conn
+        weakref.finalize(self, ThreadConnection.dispose,
+                         conn, connections).atexit = False
+
+    @staticmethod
+    def dispose(conn, connections):
+        r"""
+        Close a connection and remove it from the list of open connections.
+
+        INPUT:
+
+        - ``conn`` - the connection.
+
+        - ``connections`` - the list of open connections of the database.
+        """
+        try:
+            connections.remove(conn)
+        except ValueError:
+            pass
+        conn.close()
+
 
 class SQLiteDB(SQLDB):
     r"""
@@ -28,6 +132,28 @@ class SQLiteDB(SQLDB):
     exceptions = sqlite3.Error
     file = None
 
+    explain_prefix = 'EXPLAIN QUERY PLAN '
+    generated_storage = 'VIRTUAL'
+
+    # Generated columns are supported since SQLite 3.31.0
+    generated_columns = sqlite3.sqlite_version_info >= (3, 31, 0)
+
+    # SQLite does not report the actual costs of queries
+    explain_analyze_prefix = None
+
+    # RETURNING is supported since SQLite 3.35.0
+    upsert = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+    # Binary values may be stored in text columns
+    codec_support = True
+
+    # Connection parameters
+    wal = False
+    timeout = None
+    retries = 0
+    mmap_size = None
+    connections = None
+
     @classmethod
     def _init_class(cl):
         r"""
@@ -38,31 +164,183 @@ class SQLiteDB(SQLDB):
         cl.constraints['autoincrement'] = 'PRIMARY KEY AUTOINCREMENT'
         cl.binaryops[Modulo] = '%'
 
-    def connect(self, file=DBFILE):
+    def connect(self, file=DBFILE, wal=False, timeout=None, retries=0,
+                threaded=False, readonly=False, mmap_size=None):
         r"""
         Connect to the database.
 
         INPUT:
 
         - ``file`` - the file containing the database (default: ``DBFILE``).
+
+        - ``wal`` - whether to use write-ahead logging, allowing readers to
+          access the database while it is being written to
+          (default: ``False``).
+
+        - ``timeout`` - the number of seconds to wait for a lock on the
+          database to be released. The default value of ``None`` means that
+          the default timeout of the ``sqlite3`` module is used.
+
+        - ``retries`` - the number of times a statement is retried if the
+          database is still locked after the timeout (default: ``0``).
+
+        - ``threaded`` - whether each thread should use its own connection
+          (default: ``False``).
+
+        - ``readonly`` - whether to open the database in read-only mode
+          (default: ``False``). In this mode, the database file is assumed not
+          to change while it is open, so no locks are taken, and objects are
+          never stored to the database. The parameter ``wal`` is ignored.
+
+        - ``mmap_size`` - the maximal number of bytes of the database file to
+          access through memory-mapped I/O. The default value of ``None``
+          means ``MMAP_SIZE`` in read-only mode, and the SQLite default
+          otherwise.
         """
+        if readonly and mmap_size is None:
+            mmap_size = MMAP_SIZE
+        self.readonly = readonly
+        self.mmap_size = mmap_size
         dir = os.path.dirname(file)
-        if dir:
+        if dir and not readonly:
             try:
                 os.makedirs(dir)
             except OSError as ex:
                 if ex.errno != errno.EEXIST:
                     raise ex
         self.file = file
-        self.db = sqlite3.connect(file)
-        self.db.text_factory = str
-        self.db.row_factory = sqlite3.Row
+        self.wal = wal
+        self.timeout = timeout
+        self.retries = retries
+        if threaded:
+            self.local = threading.local()
+            self.connections = []
+        else:
+            self.local = None
+            self.connections = None
+            self.db = self.acquire()
+
+    def acquire(self):
+        r"""
+        Return a new connection to the database.
+
+        If each thread uses its own connection, this method is called on the
+        first use of the database in a thread, and the connection is closed
+        when the thread exits (see ``ThreadConnection``).
+        """
+        kargs = {}
+        if self.timeout is not None:
+            kargs["timeout"] = self.timeout
+        if self.local is not None:
+            kargs["check_same_thread"] = False
+        if self.readonly:
+            file = 'file:%s?mode=ro&immutable=1' % \
+                pathname2url(os.path.abspath(self.file))
+            kargs["uri"] = True
+        else:
+            file = self.file
+        conn = sqlite3.connect(file, factory=SQLiteConnection, **kargs)
+        conn.text_factory = str
+        conn.row_factory = sqlite3.Row
+        conn.retries = self.retries
+        if self.mmap_size is not None:
+            conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+        if self.wal and not self.readonly:
+            conn.execute('PRAGMA journal_mode=WAL')
+        if self.connections is not None:
+            self.connections.append(conn)
+            self.local.holder = ThreadConnection(conn, self.connections)
+        return conn
+
+    def close(self):
+        r"""
+        Close all connections to the database.
+
+        The executor used by the asynchronous interface is shut down first
+        (see ``SQLDB.shutdown_async``).
+        """
+        self.shutdown_async()
+        if self.local is None:
+            self.db.close()
+        else:
+            for conn in list(self.connections):
+                conn.close()
+            self.connections = []
+            self.local = threading.local()
+
+    def cursor(self, **kargs):
+        r"""
+        Return a cursor.
+
+        INPUT:
+
+        - ``factory`` - the cursor class to be used. The default value of
+          ``SQLiteCursor`` retries statements if the database is locked.
+
+        Any keyword input is forwarded to the Python database interface's
+        ``cursor`` method.
+        """
+        try:
+            lookup(kargs, 'factory')
+        except KeyError:
+            kargs['factory'] = SQLiteCursor
+        return self.db.cursor(**kargs)
+
+    async def run_async(self, fun, *largs, **kargs):
+        r"""
+        Call a function in the database's executor and return its result.
+
+        Since an SQLite connection may only be used by the thread which
+        created it, the asynchronous interface requires each thread to use
+        its own connection (see ``connect``), so that the executor's thread
+        uses a separate connection. See ``SQLDB.run_async`` for a description
+        of the parameters.
+        """
+        if self.local is None:
+            raise ValueError("the asynchronous interface requires each "
+                             "thread to use its own connection "
+                             "(threaded=True)")
+        return await SQLDB.run_async(self, fun, *largs, **kargs)
+
+    def begin(self, cur):
+        r"""
+        Start a transaction if none is active.
+
+        The Python interface only starts transactions implicitly before
+        modifying statements, so a transaction is started explicitly to
+        prevent savepoints from starting their own transactions.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+        """
+        if not self.db.in_transaction:
+            cur.execute('BEGIN')
+
+    def analyzeTables(self, cur, tables=None):
+        r"""
+        Refresh the planner statistics.
+
+        After the tables are analyzed, ``PRAGMA optimize`` is run, so that
+        SQLite may also refresh the statistics of other tables it deems
+        stale.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``tables`` - a list of names of tables to analyze (default:
+          ``None``, meaning that the whole database is analyzed).
+        """
+        SQLDB.analyzeTables(self, cur, tables)
+        cur.execute('PRAGMA optimize')
 
     def createIndex(self, cur, name, idx):
         r"""
         Create an index.
 
-        Currently, only unique constraints are respected.
+        Currently, only unique constraints and partial indexes on live rows
+        are respected (see ``indexCondition``).
 
         INPUT:
 
@@ -83,28 +361,255 @@ class SQLiteDB(SQLDB):
                                                  '_'.join(cols + list(cons))))
         idxcols = ', '.join(self.quoteIdent(col) for col in cols)
         unique = 'UNIQUE ' if 'unique' in cons else ''
-        cur.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s(%s)' %
-                    (unique, idxname, self.quoteIdent(name), idxcols))
+        cur.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s(%s)%s' %
+                    (unique, idxname, self.quoteIdent(name), idxcols,
+                     self.indexCondition(cons)))
+
+    def tableIndexes(self, cur, table):
+        r"""
+        Return a list of lists of columns of the indexes on a table.
+
+        The primary key is included even if it is an alias for the row ID.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+        """
+        q = self.quoteIdent(table)
+        cur.execute('PRAGMA main.table_info(%s)' % q)
+        pkey = sorted((r["pk"], r["name"]) for r in cur.fetchall()
+                      if r["pk"] > 0)
+        idxs = [[c for i, c in pkey]] if pkey else []
+        cur.execute('PRAGMA main.index_list(%s)' % q)
+        for name in [r["name"] for r in cur.fetchall()]:
+            cur.execute('PRAGMA main.index_info(%s)' % self.quoteIdent(name))
+            idxs.append([r["name"] for r in
+                         sorted(cur.fetchall(), key=lambda r: r["seqno"])])
+        return idxs
+
+    def columnExists(self, cur, table, column):
+        r"""
+        Return whether a table has a column with the given name.
+
+        Unlike ``tableColumns``, generated columns are also considered.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the name of the table.
+
+        - ``column`` - the name of the column.
+        """
+        cur.execute('PRAGMA main.table_xinfo(%s)' % self.quoteIdent(table))
+        return any(r["name"] == column for r in cur.fetchall())
+
+    def tableColumns(self, cur, table, schema="main"):
+        r"""
+        Return a dictionary mapping the columns of a table to their types.
+
+        Columns belonging to the primary key are mapped to a pair containing
+        the type and ``True``, and the remaining columns to a pair containing
+        the type and ``False``.
 
-    def importDB(self, file):
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``table`` - the table whose columns are returned.
+
+        - ``schema`` - the schema containing the table (default: ``"main"``).
+        """
+        cur.execute('PRAGMA %s.table_info(%s)' %
+                    (self.quoteIdent(schema), self.quoteIdent(table)))
+        return {r["name"]: (r["type"], r["pk"] > 0) for r in cur.fetchall()}
+
+    def importDB(self, file, replace=False):
         r"""
         Import the database from a file.
 
-        Currently, simply replaces the current database file with a copy of the
-        specified file. A non-destructive import of new objects and properties
-        is planned for the future.
+        Unless ``replace`` is set, objects and properties are merged into the
+        current database (see ``mergeDB``). Otherwise, the current database
+        file is replaced with a copy of the specified file.
 
         INPUT:
 
         - ``file`` - the file containing the new database.
+
+        - ``replace`` - whether to replace the current database
+          (default: ``False``).
         """
-        # TODO: import data in the database instead of replacing it!
         file = os.path.expanduser(file)
         if not os.path.isfile(file):
             raise OSError(errno.ENOENT)
-        self.db.close()
-        shutil.copy(file, self.file)
-        self.connect(file=self.file)
+        if replace:
+            self.close()
+            shutil.copy(file, self.file)
+            self.connect(file=self.file, wal=self.wal, timeout=self.timeout,
+                         retries=self.retries, threaded=self.local is not None,
+                         readonly=self.readonly, mmap_size=self.mmap_size)
+            if self.cache is not None:
+                self.cache.rollback()
+        else:
+            self.mergeDB(file)
+
+    def mergeDB(self, file, schema="incoming"):
+        r"""
+        Merge the contents of a database file into the current database.
+
+        The file is attached to the current database, and its rows are copied
+        using ``INSERT ... SELECT`` statements. Objects are identified by
+        their unique IDs - if an object is already present, its existing
+        properties are kept, and only the missing ones are copied. Other
+        entities are assigned new IDs following the largest ID in the current
+        database, and all columns referencing entities are remapped
+        accordingly. Tables and columns missing in the current database are
+        created. The change log is not imported.
+
+        Since a database cannot be attached while a transaction is open, the
+        current transaction is committed first. Raises ``ValueError`` if
+        called within a transaction scope (see ``SQLDB.transaction``).
+
+        INPUT:
+
+        - ``file`` - the file containing the database to merge.
+
+        - ``schema`` - the name under which the file is attached
+          (default: ``"incoming"``).
+        """
+        if self.transaction_depth > 0:
+            raise ValueError("databases cannot be merged "
+                             "within a transaction scope")
+        self.commit()
+        cur = self.cursor()
+        cur.execute('ATTACH DATABASE ? AS %s' % self.quoteIdent(schema),
+                    [file])
+        try:
+            self.mergeAttached(cur, schema)
+            self.invalidate()
+            self.commit()
+        except self.exceptions as ex:
+            self.handle_exception(ex)
+        finally:
+            cur.execute('DETACH DATABASE %s' % self.quoteIdent(schema))
+            cur.close()
+
+    def mergeAttached(self, cur, schema):
+        r"""
+        Merge the contents of an attached database into the current database.
+
+        See ``mergeDB`` for details.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``schema`` - the name of the attached database.
+        """
+        from ..entities.change import Change
+        from ..entities.zooobject import ZooObject
+        q = self.quoteIdent
+        s = q(schema)
+        root = ZooEntity._spec["name"]
+        rootkey = ZooEntity._spec["primary_key"]
+        cur.execute('SELECT name, sql FROM %s.sqlite_master '
+                    'WHERE type = ? AND name NOT LIKE ?' % s,
+                    ['table', 'sqlite_%'])
+        tables = {r["name"]: r["sql"] for r in cur.fetchall()
+                  if r["name"] != Change._spec["name"]}
+        if root not in tables:
+            return
+        cur.execute('SELECT name FROM main.sqlite_master WHERE type = ?',
+                    ['table'])
+        existing = {r["name"] for r in cur.fetchall()}
+        fkeys = {}
+        for t in tables:
+            cur.execute('PRAGMA %s.foreign_key_list(%s)' % (s, q(t)))
+            fkeys[t] = {r["from"]: r["table"] for r in cur.fetchall()}
+        order = []
+        while len(order) < len(tables):
+            ready = [t for t in tables if t not in order and
+                     all(f == t or f in order or f not in tables
+                         for f in fkeys[t].values())]
+            if len(ready) == 0:
+                ready = [t for t in tables if t not in order]
+            order += sorted(ready)
+        cur.execute('SELECT MAX(%s) FROM main.%s' % (q(rootkey), q(root)))
+        offset = cur.fetchone()[0] or 0
+        if "sqlite_sequence" in existing:
+            cur.execute('SELECT seq FROM main.sqlite_sequence WHERE name = ?',
+                        [root])
+            r = cur.fetchone()
+            if r is not None and r[0] is not None:
+                offset = max(offset, r[0])
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS _zoomap '
+                    '(old INTEGER PRIMARY KEY, new INTEGER)')
+        cur.execute('CREATE INDEX IF NOT EXISTS temp._zoomap_new '
+                    'ON _zoomap(new)')
+        cur.execute('DELETE FROM temp._zoomap')
+        uid = ZooObject._spec["fields"]["unique_id"]
+        utable = uid._spec["name"]
+        if utable in tables and utable in existing:
+            fkey = q(uid._foreign_key)
+            match = ' AND '.join('i.%s = l.%s' % (q(c), q(c)) for c in
+                                 uid._key_ordering + uid._val_ordering)
+            cur.execute('INSERT OR IGNORE INTO temp._zoomap (old, new) '
+                        'SELECT i.%s, l.%s FROM %s.%s AS i '
+                        'JOIN main.%s AS l ON %s '
+                        'WHERE NOT i."deleted" AND NOT l."deleted"' %
+                        (fkey, fkey, s, q(utable), q(utable), match))
+        cur.execute('INSERT OR IGNORE INTO temp._zoomap (old, new) '
+                    'SELECT %s, %s + ? FROM %s.%s' %
+                    (q(rootkey), q(rootkey), s, q(root)), [offset])
+        entities = []
+        for t in order:
+            if t not in existing:
+                cur.execute(tables[t])
+                cur.execute('SELECT sql FROM %s.sqlite_master '
+                            'WHERE type = ? AND tbl_name = ? '
+                            'AND sql IS NOT NULL' % s, ['index', t])
+                for r in cur.fetchall():
+                    cur.execute(r["sql"])
+            cols = self.tableColumns(cur, t, schema=schema)
+            local = self.tableColumns(cur, t)
+            for c, (type, _) in cols.items():
+                if c not in local:
+                    cur.execute('ALTER TABLE main.%s ADD COLUMN %s %s' %
+                                (q(t), q(c), type))
+            pkey = [c for c, (_, pk) in cols.items() if pk]
+            if len(pkey) == 1 and fkeys[t].get(pkey[0]) == root:
+                entities.append((t, pkey[0]))
+            remap = {c: '(SELECT m.new FROM temp._zoomap AS m '
+                        'WHERE m.old = i.%s)' % q(c) for c in cols
+                     if c in fkeys[t] or (t == root and c == rootkey)}
+            exps = [remap.get(c, 'i.%s' % q(c)) for c in cols]
+            cur.execute('INSERT OR IGNORE INTO main.%s (%s) '
+                        'SELECT %s FROM %s.%s AS i' %
+                        (q(t), ', '.join(q(c) for c in cols),
+                         ', '.join(exps), s, q(t)))
+            if len(pkey) != 1 or pkey[0] not in fkeys[t] or \
+                    len(cols) == 1:
+                continue
+            pk = q(pkey[0])
+            cur.execute('UPDATE main.%s SET %s WHERE %s IN '
+                        '(SELECT new FROM temp._zoomap WHERE new <= ?)' %
+                        (q(t), ', '.join(
+                            '%s = COALESCE(%s, (SELECT %s FROM %s.%s AS i '
+                            'JOIN temp._zoomap AS m ON i.%s = m.old '
+                            'WHERE m.new = %s.%s))' %
+                            (q(c), q(c), exps[i], s, q(t), pk, q(t), pk)
+                            for i, c in enumerate(cols) if c != pkey[0]),
+                         pk), [offset])
+        if len(entities) > 0:
+            cur.execute('DELETE FROM main.%s WHERE %s > ? AND %s' %
+                        (q(root), q(rootkey), ' AND '.join(
+                            'NOT EXISTS (SELECT 1 FROM main.%s AS t '
+                            'WHERE t.%s = %s.%s)' % (q(t), q(pk), q(root),
+                                                     q(rootkey))
+                            for t, pk in entities)), [offset])
+        cur.execute('DROP TABLE temp._zoomap')
 
     def __str__(self):
         return 'SQLite database in %s' % self.file
@@ -17,6 +17,10 @@ This module contains the following submodules:
 
 - ``zooobject``: A superclass for all DiscreteZOO objects
 
+- ``zoocube``: A class for materialized count cubes
+
+- ``columnar``: A class for columnar snapshots of object properties
+
 - ``zoograph``: A class for generic undirected graphs
 
 - ``vt``: A class for vertex-transitive graphs
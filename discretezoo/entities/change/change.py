@@ -83,6 +83,7 @@ class Change(ZooEntity):
                     self._chgid = self._db.lastrowid(cur)
                 else:
                     self._chgid = r[0]
+                self._db.invalidate(table)
             self.table = table
             self.column = column
             self.commit = commithash
@@ -0,0 +1,378 @@
+r"""
+Columnar snapshots
+
+This module provides a class for exporting the scalar properties of objects
+into memory-mapped NumPy arrays, and for evaluating conditions on them
+without querying the database.
+"""
+
+import json
+import numbers
+import os
+import numpy as np
+from sage.rings.integer import Integer
+from sage.rings.rational import Rational
+from sage.rings.real_mpfr import RealNumber
+from .zooentity import ZooEntity
+from .zooentity import ZooInfo
+from .zooproperty import ZooProperty
+from ..db.query import And
+from ..db.query import BinaryOp
+from ..db.query import Column
+from ..db.query import Divide
+from ..db.query import FloorDivide
+from ..db.query import In
+from ..db.query import IsNotNull
+from ..db.query import IsNull
+from ..db.query import LogicalExpression
+from ..db.query import Modulo
+from ..db.query import Not
+from ..db.query import Or
+from ..db.query import UnaryOp
+from ..db.query import Value
+from ..db.query import makeExpression
+
+# The name of the file describing a snapshot
+META_FILE = "meta.json"
+
+# Binary operations not supported by the evaluator
+UNSUPPORTED = {"++", "like"}
+
+
+def columnType(t):
+    r"""
+    Return the NumPy type storing a field, or ``None`` if it is not scalar.
+
+    INPUT:
+
+    - ``t`` - the type of the field in the class specification.
+    """
+    if isinstance(t, tuple):
+        t = t[0]
+    if not isinstance(t, type) or issubclass(t, ZooProperty):
+        return None
+    elif issubclass(t, ZooEntity):
+        return "int64"
+    elif issubclass(t, bool):
+        return "bool"
+    elif issubclass(t, (Integer, int)):
+        return "int64"
+    elif issubclass(t, (RealNumber, Rational, float)):
+        return "float64"
+    return None
+
+
+def scalar(x):
+    r"""
+    Convert a value to a Python scalar suitable for NumPy.
+
+    INPUT:
+
+    - ``x`` - the value to convert.
+    """
+    if isinstance(x, bool) or x is None:
+        return x
+    elif isinstance(x, numbers.Integral):
+        return int(x)
+    elif isinstance(x, numbers.Real):
+        return float(x)
+    return x
+
+
+def evaluate(exp, column, size):
+    r"""
+    Evaluate an expression over columns of values.
+
+    Returns a pair of arrays containing the values of the expression and a
+    mask of null values. Null values are propagated as in SQL, and logical
+    expressions use three-valued logic. Raises ``NotImplementedError`` for
+    expressions which cannot be evaluated over arrays.
+
+    INPUT:
+
+    - ``exp`` - the expression to evaluate.
+
+    - ``column`` - a function mapping a column name to a pair of arrays
+      containing the values and the null mask.
+
+    - ``size`` - the length of the arrays.
+    """
+    exp = makeExpression(exp)
+    if isinstance(exp, Value):
+        v = scalar(exp.value)
+        if v is None:
+            return (np.zeros(size, dtype=bool), np.ones(size, dtype=bool))
+        return (np.full(size, v), np.zeros(size, dtype=bool))
+    elif isinstance(exp, Column):
+        if isinstance(exp.column, str):
+            return column(exp.column)
+        return evaluate(exp.column, column, size)
+    elif isinstance(exp, LogicalExpression):
+        conj = isinstance(exp, And)
+        if not conj and not isinstance(exp, Or):
+            raise NotImplementedError(exp)
+        value = np.full(size, conj)
+        nulls = np.zeros(size, dtype=bool)
+        for t in exp.terms:
+            v, n = evaluate(t, column, size)
+            v = v.astype(bool)
+            if conj:
+                value &= v | n
+            else:
+                value |= v & ~n
+            nulls |= n
+        return (value, nulls & (value if conj else ~value))
+    elif isinstance(exp, In):
+        left, nl = evaluate(exp.left, column, size)
+        right = exp.right
+        if isinstance(right, Value) and \
+                isinstance(right.value, (list, tuple, set, frozenset)):
+            values = right.value
+        elif isinstance(right, LogicalExpression) and \
+                all(isinstance(t, Value) for t in right.terms):
+            values = [t.value for t in right.terms]
+        else:
+            raise NotImplementedError(exp)
+        values = [scalar(v) for v in values if v is not None]
+        return (np.isin(left, values), nl)
+    elif isinstance(exp, BinaryOp):
+        if exp.op in UNSUPPORTED:
+            raise NotImplementedError(exp)
+        left, nl = evaluate(exp.left, column, size)
+        right, nr = evaluate(exp.right, column, size)
+        nulls = nl | nr
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if isinstance(exp, (Divide, FloorDivide, Modulo)):
+                zero = right == 0
+                nulls = nulls | zero
+                right = np.where(zero, 1, right)
+            if isinstance(exp, Divide):
+                left = left.astype(float)
+            return (exp.oper(left, right), nulls)
+    elif isinstance(exp, IsNull):
+        v, n = evaluate(exp.exp, column, size)
+        return (n.copy(), np.zeros(size, dtype=bool))
+    elif isinstance(exp, IsNotNull):
+        v, n = evaluate(exp.exp, column, size)
+        return (~n, np.zeros(size, dtype=bool))
+    elif isinstance(exp, Not):
+        v, n = evaluate(exp.exp, column, size)
+        return (~v.astype(bool), n)
+    elif isinstance(exp, UnaryOp):
+        v, n = evaluate(exp.exp, column, size)
+        return (exp.oper(v), n)
+    raise NotImplementedError(exp)
+
+
+class ColumnarSnapshot(object):
+    r"""
+    A columnar snapshot of the scalar properties of objects.
+
+    A snapshot is a directory containing, for each scalar column of the
+    tables of a class and its ancestors, a NumPy file with the values and a
+    NumPy file with the mask of null values, as well as the file
+    ``META_FILE`` describing the columns. The rows are sorted by object ID.
+    The files are memory-mapped, so only the columns used are read.
+
+    Columns of other types (e.g., strings) and properties stored in separate
+    tables are not exported. Integer values not fitting into 64 bits are
+    stored as null.
+    """
+    cl = None
+    path = None
+    size = None
+    columns = None
+    arrays = None
+
+    # Number of rows fetched from the database at once when exporting
+    batch_size = 10000
+
+    def __init__(self, path, cl=None):
+        r"""
+        Object constructor.
+
+        Opens an exported snapshot.
+
+        INPUT:
+
+        - ``path`` - the directory containing the snapshot.
+
+        - ``cl`` - the class whose objects are described (default: ``None``).
+        """
+        self.path = path
+        self.cl = cl
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.size = meta["size"]
+        self.columns = meta["columns"]
+        self.key = meta["key"]
+        self.arrays = {}
+
+    @classmethod
+    def export(cl, zcl, path, db=None):
+        r"""
+        Export the scalar properties of all objects of a class and return the
+        snapshot.
+
+        INPUT:
+
+        - ``zcl`` - the class whose objects are exported.
+
+        - ``path`` - the directory to write the snapshot to. It is created if
+          it does not exist; existing files are overwritten.
+
+        - ``db`` - the database to export from (default: ``None``).
+        """
+        info = ZooInfo(zcl)
+        if db is None:
+            db = info.getdb()
+        columns = {}
+        c = zcl
+        while c is not None:
+            for k, t in c._spec["fields"].items():
+                dtype = columnType(t)
+                if dtype is not None and k not in columns:
+                    columns[k] = dtype
+            c = c._parent
+        key = zcl._spec["primary_key"]
+        columns[key] = "int64"
+        size = int(info.count(db=db))
+        os.makedirs(path, exist_ok=True)
+        arrays = {k: (np.lib.format.open_memmap(
+                        os.path.join(path, "%s.npy" % k), mode="w+",
+                        dtype=t, shape=(size, )),
+                      np.lib.format.open_memmap(
+                        os.path.join(path, "%s.null.npy" % k), mode="w+",
+                        dtype=bool, shape=(size, )))
+                  for k, t in columns.items()}
+        cur = info.query(db=db, cur=db.streaming_cursor(),
+                         orderby=[Column(key, zcl._spec["name"])])
+        pos = 0
+        try:
+            while pos < size:
+                rows = cur.fetchmany(min(cl.batch_size, size - pos))
+                if not rows:
+                    break
+                end = pos + len(rows)
+                for k, (values, nulls) in arrays.items():
+                    col = [r[k] for r in rows]
+                    nulls[pos:end] = [x is None for x in col]
+                    col = [0 if x is None else x for x in col]
+                    try:
+                        values[pos:end] = col
+                    except OverflowError:
+                        for i, x in enumerate(col):
+                            try:
+                                values[pos+i] = x
+                            except OverflowError:
+                                values[pos+i] = 0
+                                nulls[pos+i] = True
+                pos = end
+        finally:
+            cur.close()
+        for values, nulls in arrays.values():
+            values.flush()
+            nulls.flush()
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"class": zcl.__name__, "size": pos, "key": key,
+                       "columns": columns}, f)
+        return cl(path, cl=zcl)
+
+    def column(self, name):
+        r"""
+        Return a pair of memory-mapped arrays containing the values and the
+        null mask of a column.
+
+        INPUT:
+
+        - ``name`` - the name of the column.
+        """
+        if name not in self.columns:
+            raise KeyError(name)
+        if name not in self.arrays:
+            self.arrays[name] = tuple(
+                np.load(os.path.join(self.path, f % name),
+                        mmap_mode="r")[:self.size]
+                for f in ["%s.npy", "%s.null.npy"])
+        return self.arrays[name]
+
+    def values(self, name):
+        r"""
+        Return a masked array of the values of a column.
+
+        INPUT:
+
+        - ``name`` - the name of the column.
+        """
+        values, nulls = self.column(name)
+        return np.ma.MaskedArray(values, mask=nulls)
+
+    def evaluate(self, exp):
+        r"""
+        Evaluate an expression over the snapshot.
+
+        Returns a masked array of the values of the expression. Columns are
+        referenced by name only, regardless of the table given.
+
+        INPUT:
+
+        - ``exp`` - the expression to evaluate.
+        """
+        values, nulls = evaluate(exp, self.column, self.size)
+        return np.ma.MaskedArray(values, mask=nulls)
+
+    def where(self, *largs, **kargs):
+        r"""
+        Return a boolean array marking the objects satisfying the conditions.
+
+        As in SQL, objects for which a condition evaluates to null are not
+        included.
+
+        INPUT:
+
+        - an unnamed attribute should be an expression representing a
+          condition.
+
+        - a named parameter specifies the condition that the property specified
+          by the name takes the specified by the value.
+        """
+        values, nulls = evaluate(And(*largs, **kargs), self.column,
+                                 self.size)
+        return values.astype(bool) & ~nulls
+
+    def ids(self, *largs, **kargs):
+        r"""
+        Return an array of IDs of objects satisfying the conditions.
+
+        See ``where`` for a description of the parameters.
+        """
+        return self.column(self.key)[0][self.where(*largs, **kargs)]
+
+    def select(self, columns, *largs, **kargs):
+        r"""
+        Return a dictionary mapping column names to masked arrays of their
+        values for the objects satisfying the conditions.
+
+        INPUT:
+
+        - ``columns`` - a list of column names.
+
+        See ``where`` for a description of other parameters.
+        """
+        mask = self.where(*largs, **kargs)
+        return {k: self.values(k)[mask] for k in columns}
+
+    def count(self, *largs, **kargs):
+        r"""
+        Return the number of objects satisfying the conditions.
+
+        See ``where`` for a description of the parameters.
+        """
+        return Integer(np.count_nonzero(self.where(*largs, **kargs)))
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Columnar snapshot of %d objects in %s" % (self.size,
+                                                           self.path)
@@ -0,0 +1,413 @@
+r"""
+Count cubes
+
+This module provides a class for materialized summary tables holding the
+numbers of objects grouped by a fixed set of expressions.
+"""
+
+from .zooentity import ZooInfo
+from ..db.query import And
+from ..db.query import Column
+from ..db.query import IsNull
+from ..db.query import Or
+from ..db.query import Table
+from ..db.query import Value
+from ..util.utility import tomultidict
+
+
+class ZooCube(object):
+    r"""
+    A materialized count cube.
+
+    A cube stores the number of objects of a class satisfying a condition for
+    each combination of values of the grouping expressions. It consists of
+    two tables: ``_cube_<name>_members`` containing the values of the
+    grouping expressions for each object, and ``_cube_<name>`` containing the
+    counts. The ID of the last processed change is stored in the table
+    ``_cubes``.
+
+    The cube is refreshed incrementally from the change log (see
+    ``change.Change``): only the objects with changes recorded after the
+    last refresh are regrouped. If the database does not track changes,
+    incremental refreshes do nothing, and a full rebuild should be requested
+    using ``refresh(full=True)`` after the objects are modified.
+
+    Once declared, the cube is used by ``ZooInfo.count`` whenever the
+    grouping expressions (in any order) and the conditions match.
+    """
+    cl = None
+    db = None
+    name = None
+    groupby = None
+    largs = None
+    kargs = None
+    change = None
+
+    # Declared cubes by class
+    cubes = {}
+
+    # Number of objects regrouped at once
+    batch_size = 500
+
+    def __init__(self, cl, name, groupby, *largs, **kargs):
+        r"""
+        Object constructor.
+
+        Declares a cube and creates its tables if they do not exist. Raises
+        ``NotImplementedError`` if the database does not support count cubes
+        (e.g., a sharded database).
+
+        INPUT:
+
+        - ``cl`` - the class whose objects are counted.
+
+        - ``name`` - the name of the cube.
+
+        - ``groupby`` - an expression or list of expressions to group by.
+
+        - ``db`` - the database being used (must be a named parameter;
+          default: ``None``).
+
+        - an unnamed attribute should be an expression representing a
+          condition.
+
+        - a named parameter specifies the condition that the property specified
+          by the name takes the specified by the value.
+        """
+        if isinstance(groupby, set):
+            groupby = list(groupby)
+        elif not isinstance(groupby, list):
+            groupby = [groupby]
+        self.cl = cl
+        self.db = kargs.pop("db", None)
+        if self.db is None:
+            self.db = ZooInfo(cl).getdb()
+        if not getattr(self.db, "cube_support", False):
+            raise NotImplementedError("count cubes are not supported "
+                                      "by the database")
+        self.name = name
+        self.groupby = groupby
+        self.largs = largs
+        self.kargs = kargs
+        self.cond = And(*largs, **kargs)
+        self.init_tables()
+        ZooCube.cubes.setdefault(cl, []).append(self)
+
+    @staticmethod
+    def key(exp):
+        r"""
+        Return a string identifying a grouping expression.
+
+        INPUT:
+
+        - ``exp`` - the expression.
+        """
+        return str(exp)
+
+    @classmethod
+    def find(cl, zcl, db, *largs, **kargs):
+        r"""
+        Return a declared cube able to answer a count query, or ``None``.
+
+        INPUT:
+
+        - ``zcl`` - the class whose objects are counted.
+
+        - ``db`` - the database being used.
+
+        - ``groupby`` - an expression or list of expressions to group by
+          (must be a named parameter; default: ``[]``).
+
+        - any other parameters specify the conditions as in
+          ``ZooInfo.count``.
+        """
+        if zcl not in cl.cubes:
+            return None
+        groupby = kargs.get("groupby", [])
+        if isinstance(groupby, set):
+            groupby = list(groupby)
+        elif not isinstance(groupby, list):
+            groupby = [groupby]
+        keys = sorted(cl.key(x) for x in groupby)
+        cond = str(And(*largs, **{k: v for k, v in kargs.items()
+                                  if k != "groupby"}))
+        for cube in cl.cubes[zcl]:
+            if cube.db is db and str(cube.cond) == cond and \
+                    sorted(cl.key(x) for x in cube.groupby) == keys:
+                return cube
+        return None
+
+    def tables(self):
+        r"""
+        Return the names of the counts and members tables.
+        """
+        name = "_cube_%s" % self.name
+        return (name, "%s_members" % name)
+
+    def dims(self):
+        r"""
+        Return the names of the dimension columns.
+        """
+        return ["_dim%d" % i for i in range(len(self.groupby))]
+
+    def init_tables(self):
+        r"""
+        Create the state table and load the state of the cube.
+
+        If the cube has not been built yet, it is built.
+        """
+        q = self.db.quoteIdent
+        cur = self.db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS %s (%s TEXT PRIMARY KEY, '
+                    '%s INTEGER)' % (q("_cubes"), q("name"), q("change")))
+        self.db.query([Column("change")], Table("_cubes"),
+                      Column("name") == Value(self.name), cur=cur)
+        r = cur.fetchone()
+        cur.close()
+        if r is None:
+            self.refresh(full=True)
+        else:
+            self.change = r[0]
+
+    def last_change(self):
+        r"""
+        Return the ID of the last recorded change.
+        """
+        from .change import Change
+        id = Column(Change._spec["primary_key"])
+        cur = self.db.query([id], Table(Change._spec["name"]),
+                            orderby=[(id, "D")], limit=1)
+        r = cur.fetchone()
+        cur.close()
+        return 0 if r is None else r[0]
+
+    def changed(self, change):
+        r"""
+        Return the set of IDs of objects changed after the given change.
+
+        Changes to rows of property tables of the class are mapped to the
+        objects they belong to.
+
+        INPUT:
+
+        - ``change`` - the ID of the last processed change.
+        """
+        from .change import Change
+        from .zooproperty import ZooProperty
+        own = set()
+        props = {}
+        cl = self.cl
+        while cl is not None:
+            own.add(cl._spec["name"])
+            for v in cl._spec["fields"].values():
+                if isinstance(v, tuple):
+                    v = v[0]
+                if isinstance(v, type) and issubclass(v, ZooProperty) \
+                        and v._spec is not None:
+                    props[v._spec["name"]] = v
+            cl = cl._parent
+        cur = self.db.query([Column("zooid"), Column("table")],
+                            Table(Change._spec["name"]),
+                            Column(Change._spec["primary_key"]) >
+                            Value(change), distinct=True)
+        ids = set()
+        rows = {}
+        for r in cur:
+            if r["table"] in own:
+                ids.add(r["zooid"])
+            elif r["table"] in props:
+                rows.setdefault(r["table"], []).append(r["zooid"])
+        cur.close()
+        for t, l in rows.items():
+            p = props[t]
+            pk = Column(p._spec["primary_key"])
+            for i in range(0, len(l), self.batch_size):
+                cur = self.db.query([Column(p._foreign_key)], Table(t),
+                                    Or(*[pk == Value(x) for x in
+                                         l[i:i+self.batch_size]]),
+                                    distinct=True)
+                ids.update(r[0] for r in cur)
+                cur.close()
+        return ids
+
+    def dimCond(self, values):
+        r"""
+        Return a condition matching the given values of the dimensions.
+
+        INPUT:
+
+        - ``values`` - the values of the dimensions.
+        """
+        return And(*[IsNull(Column(d)) if v is None
+                     else Column(d) == Value(v)
+                     for d, v in zip(self.dims(), values)])
+
+    def adjust(self, cur, deltas):
+        r"""
+        Adjust the counts by the given differences.
+
+        INPUT:
+
+        - ``cur`` - the cursor to be used.
+
+        - ``deltas`` - a dictionary mapping tuples of values of the
+          dimensions to differences of counts.
+        """
+        counts, members = self.tables()
+        q = self.db.quoteIdent
+        for values, delta in deltas.items():
+            if delta == 0:
+                continue
+            w, data = self.db.makeExpression(self.dimCond(values))
+            sql = 'UPDATE %s SET %s = %s + %s WHERE %s' % \
+                (q(counts), q("count"), q("count"), self.db.data_string, w)
+            self.db.flush(cur=cur, sql=sql)
+            cur.execute(sql, [delta] + data)
+            if cur.rowcount == 0:
+                self.db.insert_row(counts, dict(zip(self.dims(), values),
+                                                 count=delta), cur=cur)
+        self.db.delete_rows(counts, Column("count") <= Value(0), cur=cur)
+
+    def refresh(self, full=False, commit=True):
+        r"""
+        Bring the cube up to date.
+
+        INPUT:
+
+        - ``full`` - whether to rebuild the cube from scratch
+          (default: ``False``).
+
+        - ``commit`` - whether to commit after the cube is refreshed
+          (default: ``True``).
+        """
+        counts, members = self.tables()
+        q = self.db.quoteIdent
+        dims = ', '.join(q(d) for d in self.dims())
+        info = ZooInfo(self.cl)
+        if not (full or self.change is None or self.db.track):
+            return
+        cur = self.db.cursor()
+        self.db.flush(cur=cur)
+        if full or self.change is None:
+            change = self.last_change() if self.db.track else 0
+            sql, data = info.groups(db=self.db, groupby=self.groupby,
+                                    subquery=True, *self.largs,
+                                    **self.kargs)
+            cur.execute('DROP TABLE IF EXISTS %s' % q(counts))
+            cur.execute('DROP TABLE IF EXISTS %s' % q(members))
+            cur.execute('CREATE TABLE %s AS %s' % (q(members), sql), data)
+            cur.execute('CREATE INDEX %s ON %s(%s)' %
+                        (q("idx%s_zooid" % members), q(members), q("zooid")))
+            cur.execute('CREATE TABLE %s AS SELECT %s%sCOUNT(DISTINCT %s) '
+                        'AS %s FROM %s%s' %
+                        (q(counts), dims, ', ' if dims else '', q("zooid"),
+                         q("count"), q(members),
+                         ' GROUP BY %s' % dims if dims else ''))
+        else:
+            change = self.last_change()
+            if change == self.change:
+                cur.close()
+                return
+            ids = sorted(self.changed(self.change))
+            zooid = Column("zooid")
+            pk = Column(self.cl._spec["primary_key"], self.cl._spec["name"])
+            for i in range(0, len(ids), self.batch_size):
+                batch = ids[i:i+self.batch_size]
+                deltas = {}
+                self.db.query([zooid] + [Column(d) for d in self.dims()],
+                              Table(members),
+                              Or(*[zooid == Value(x) for x in batch]),
+                              cur=cur)
+                for r in cur.fetchall():
+                    values = tuple(r[1:])
+                    deltas[values] = deltas.get(values, 0) - 1
+                self.db.delete_rows(members,
+                                    Or(*[zooid == Value(x) for x in batch]),
+                                    cur=cur)
+                sql, data = info.groups(
+                    And(self.cond, Or(*[pk == Value(x) for x in batch])),
+                    db=self.db, groupby=self.groupby, subquery=True)
+                cur.execute('INSERT INTO %s (%s%s%s) %s' %
+                            (q(members), q("zooid"), ', ' if dims else '',
+                             dims, sql), data)
+                self.db.query([Column(d) for d in self.dims()],
+                              Table(members),
+                              Or(*[zooid == Value(x) for x in batch]),
+                              cur=cur)
+                for r in cur.fetchall():
+                    values = tuple(r)
+                    deltas[values] = deltas.get(values, 0) + 1
+                self.adjust(cur, deltas)
+        if self.db.update_rows("_cubes", {"change": change},
+                               Column("name") == Value(self.name),
+                               cur=cur).rowcount == 0:
+            self.db.insert_row("_cubes", {"name": self.name,
+                                          "change": change}, cur=cur)
+        cur.close()
+        self.db.invalidate(counts, members)
+        self.change = change
+        if commit:
+            self.db.commit()
+
+    def count(self, groupby=None, refresh=True):
+        r"""
+        Return the counts in the format of ``ZooInfo.count``.
+
+        INPUT:
+
+        - ``groupby`` - the grouping expressions in the desired order
+          (default: ``None``, meaning the order of declaration).
+
+        - ``refresh`` - whether to refresh the cube first (default: ``True``).
+          Refreshing writes to the tables of the cube, but does not commit,
+          so that counting does not commit the current transaction; the
+          changes are committed with it. The cube of a read-only database is
+          never refreshed.
+        """
+        if refresh and not self.db.readonly:
+            self.refresh(commit=False)
+        if groupby is None:
+            groupby = self.groupby
+        elif isinstance(groupby, set):
+            groupby = list(groupby)
+        elif not isinstance(groupby, list):
+            groupby = [groupby]
+        pos = {self.key(x): d for x, d in zip(self.groupby, self.dims())}
+        groupbycols = [Column(x, alias=True) for x in groupby]
+        counts, members = self.tables()
+        cur = self.db.query([Column("count")] +
+                            [Column(pos[self.key(x)], alias=c.colalias)
+                             for x, c in zip(groupby, groupbycols)],
+                            Table(counts))
+        n = cur.fetchall()
+        cur.close()
+        if len(groupby) == 0 and len(n) == 0:
+            n = [[0]]
+        return tomultidict(n, groupbycols)
+
+    def drop(self, commit=True):
+        r"""
+        Remove the cube and its tables.
+
+        INPUT:
+
+        - ``commit`` - whether to commit after the tables are removed
+          (default: ``True``).
+        """
+        q = self.db.quoteIdent
+        cur = self.db.cursor()
+        for t in self.tables():
+            cur.execute('DROP TABLE IF EXISTS %s' % q(t))
+        self.db.delete_rows("_cubes", Column("name") == Value(self.name),
+                            cur=cur)
+        cur.close()
+        self.db.invalidate(*self.tables())
+        ZooCube.cubes[self.cl].remove(self)
+        if commit:
+            self.db.commit()
+
+    def __repr__(self):
+        return "<%s at 0x%08x>" % (str(self), id(self))
+
+    def __str__(self):
+        return "Count cube %s for %s" % (self.name, self.cl)
@@ -7,8 +7,10 @@ This module provides a function to create dictionary-like classes.
 from .zooentity import ZooEntity
 from .zooproperty import ZooProperty
 from .zootypes import register_type
+from ..db.query import And
 from ..db.query import Column
 from ..db.query import ColumnSet
+from ..db.query import Not
 from ..db.query import Table
 from ..db.query import enlist
 from ..util.context import DBParams
@@ -197,14 +199,14 @@ class _ZooDict(dict, ZooProperty):
             ZooProperty._init_(self, kargs)
             self._objid = data
             if vals is not None and kargs["store"]:
-                for k, v in vals.items():
-                    self.__setitem__(k, v, store=True, cur=kargs["cur"])
+                self.update(vals, store=True, cur=kargs["cur"])
                 if kargs["commit"]:
                     self._db.commit()
             else:
                 t = Table(self._spec["name"])
-                cur = self._db.query([t], t, {self._foreign_key: data,
-                                              "deleted": False},
+                cur = self._db.query([t], t,
+                                     And(Not(Column("deleted")),
+                                         **{self._foreign_key: data}),
                                      cur=kargs["cur"])
                 for r in cur:
                     key = tuple([r[k] for k in self._key_ordering])
@@ -518,6 +520,8 @@ class _ZooDict(dict, ZooProperty):
         r"""
         Update the dictionary from a dictionary or collection.
 
+        Changed entries are written to the database in a batch.
+
         INPUT:
 
         - an unnamed parameter should be a dictionary or collection of
@@ -533,16 +537,35 @@ class _ZooDict(dict, ZooProperty):
           name as the key.
         """
         store, cur = DBParams.get(kargs, destroy=True)
+        items = []
         if len(largs) > 0:
+            other = largs[0]
             try:
-                other = largs[0]
-                for k in other:
-                    self.__setitem__(k, other[k], store=store, cur=cur)
-            except AttributeError:
-                for k, v in other:
-                    self.__setitem__(k, v, store=store, cur=cur)
-        for k, v in kargs.items():
-            self.__setitem__(k, v, store=store, cur=cur)
+                items += [(k, other[k]) for k in other]
+            except (AttributeError, TypeError):
+                items += list(other)
+        items += list(kargs.items())
+        new = {}
+        for k, v in items:
+            k, tk = self._normalize_key(k)
+            v, tv = self._normalize_val(v)
+            if k in self and self[k] == v:
+                new.pop(k, None)
+            else:
+                new[k] = (tk, v, tv)
+        if len(new) == 0:
+            return
+        ids = [None] * len(new)
+        if store:
+            rows = [dict([(self._foreign_key, self._objid)] +
+                         [(c, tk[i]) for i, c
+                          in enumerate(self._key_ordering)] +
+                         [(c, tv[i]) for i, c
+                          in enumerate(self._val_ordering)])
+                    for tk, v, tv in new.values()]
+            ids = self._insert_rows(self.__class__, rows, cur=cur)
+        for (k, (tk, v, tv)), id in zip(new.items(), ids):
+            dict.__setitem__(self, k, (id, v))
 
     def values(self):
         r"""
@@ -600,7 +623,10 @@ def ZooDict(parent, name, spec, use_key_tuples=None, use_val_tuples=None):
         "_spec": {
             "name": "%s_%s" % (parent._spec["name"], name),
             "primary_key": id,
-            "indices": [([fkey, *keys.keys()], {"unique"})],
+            "indices": [([fkey, *keys.keys()], {"unique"}),
+                        ([fkey], {"live"}),
+                        (sorted(keys.keys()), {"live"}),
+                        (sorted(values.keys()), {"live"})],
             "skip": {fkey, "deleted"},
             "fields": {
                 id: ZooEntity,
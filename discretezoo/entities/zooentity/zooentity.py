@@ -5,22 +5,31 @@ This module contains a class which all DiscreteZOO entities extend,
 and also a class for making queries about entities of a given class.
 """
 
+from random import randint
+from random import shuffle
 from sage.rings.integer import Integer
 import discretezoo
 from .. import zootypes
+from ...db.aio import AsyncCursor
 from ...db.query import A as All
 from ...db.query import And
 from ...db.query import Column
 from ...db.query import Count
 from ...db.query import In
+from ...db.query import Or
+from ...db.query import Order
 from ...db.query import R as Random
 from ...db.query import Subquery
 from ...db.query import Table
+from ...db.query import Value
 from ...util.context import DBParams
+from ...util.utility import decode_token
 from ...util.utility import default
+from ...util.utility import encode_token
 from ...util.utility import isinteger
 from ...util.utility import lookup
 from ...util.utility import parse
+from ...util.utility import reservoir
 from ...util.utility import todict
 from ...util.utility import tomultidict
 
@@ -69,6 +78,7 @@ class ZooEntity(object, metaclass=ZooMetaclass):
 
         - ``store`` - whether to store the entity to the database
           (must be a named parameter; default: ``discretezoo.WRITE_TO_DB``).
+          Ignored if the database is read-only.
 
         - ``cur`` - the cursor to use for database interaction
           (must be a named parameter; default: ``None``).
@@ -119,6 +129,9 @@ class ZooEntity(object, metaclass=ZooMetaclass):
         default(d, "commit")
         DBParams.get(d)
         self._initdb(d["db"])
+        if self._db.readonly:
+            d["store"] = False
+            d["commit"] = False
         if self.__class__ is cl:
             d["write"] = {}
         d["write"][cl] = d["store"]
@@ -255,7 +268,7 @@ class ZooEntity(object, metaclass=ZooMetaclass):
         pass
 
     @classmethod
-    def _derive(cl, name, exp, add_method=True):
+    def _derive(cl, name, exp, add_method=True, stored=None):
         r"""
         Add a derived field.
 
@@ -267,8 +280,16 @@ class ZooEntity(object, metaclass=ZooMetaclass):
 
         - ``add_method`` (default: ``True``) - whether to add a corresponding
           method.
+
+        - ``stored`` (default: ``None``) - if given, the type of the value.
+          In this case, if ``exp`` only references columns of the class'
+          table, the field is stored in an indexed generated column when the
+          table is initialized (see ``SQLDB.createGenerated``).
         """
         setattr(cl._fields, name, exp)
+        if stored is not None and \
+                exp.getTables() == {(cl._spec["name"], None, None)}:
+            cl._spec.setdefault("generated", {})[name] = (exp, stored)
         if add_method:
             def derived(self, **kargs):
                 return parse(self, exp, compute=True, **kargs)
@@ -503,12 +524,33 @@ class ZooEntity(object, metaclass=ZooMetaclass):
         """
         return False
 
+    def _getrow(self, cl):
+        r"""
+        Return the row of the table of class ``cl`` to be written to the
+        database.
+
+        INPUT:
+
+        - ``cl`` - the class to return the row for.
+        """
+        from ..zooproperty import ZooProperty
+        row = {**self._getprops(cl),
+               **{k: getattr(self, k)(store=False)
+                  for k in cl._spec["skip"]}}
+        row = {k: v for k, v in row.items()
+               if not issubclass(cl._spec['fields'][k], ZooProperty)}
+        if self._zooid is False and "zooid" in row:
+            del row["zooid"]
+        return row
+
     def _db_write(self, cl, cur):
         r"""
         Write properties to the database.
 
         The properties belonging to class ``cl`` are written to the database
-        using the cursor ``cur``.
+        using the cursor ``cur``. Rows not requiring an ID to be returned are
+        added to the database's insert buffer if one is active (see
+        ``SQLDB.buffered``).
 
         INPUT:
 
@@ -516,17 +558,10 @@ class ZooEntity(object, metaclass=ZooMetaclass):
 
         - ``cur`` - the cursor to use for database interaction.
         """
-        from ..zooproperty import ZooProperty
         id = None
         if cl._parent is None:
             id = cl._spec["primary_key"]
-        row = {**self._getprops(cl),
-               **{k: getattr(self, k)(store=False)
-                  for k in cl._spec["skip"]}}
-        row = {k: v for k, v in row.items()
-               if not issubclass(cl._spec['fields'][k], ZooProperty)}
-        if self._zooid is False and "zooid" in row:
-            del row["zooid"]
+        row = self._getrow(cl)
         if "zooid" not in row or \
                 not self._update_rows(cl, row,
                                       {cl._spec["primary_key"]: row["zooid"]},
@@ -699,6 +734,12 @@ class ZooInfo:
     """
     cl = None
 
+    # Number of IDs probed at once when sampling
+    sample_batch = 64
+
+    # Number of probing rounds before falling back to reservoir sampling
+    sample_rounds = 16
+
     def __init__(self, cl):
         r"""
         Object constructor.
@@ -765,12 +806,24 @@ class ZooInfo:
 
         - a named parameter specifies the condition that the property specified
           by the name takes the specified by the value.
+
+        If a count cube with the same grouping expressions and conditions has
+        been declared for the class (see ``zoocube.ZooCube``) and changes to
+        the database are tracked, it is refreshed and the counts are read
+        from it. Note that refreshing the cube writes to the database without
+        committing, so a transaction may be left open. Cubes are not used
+        with read-only databases.
         """
+        from ..zoocube import ZooCube
         db = lookup(kargs, "db", default=None, destroy=True)
         join = lookup(kargs, "join", default=None, destroy=True)
         by = lookup(kargs, "by", default=None, destroy=True)
         if db is None:
             db = self.getdb()
+        if join is None and db.track and not db.readonly:
+            cube = ZooCube.find(self.cl, db, *largs, **kargs)
+            if cube is not None:
+                return cube.count(lookup(kargs, "groupby", default=[]))
         t = Table(self.cl._spec["name"])
         if join is not None:
             t = join.join(t, by=by)
@@ -798,6 +851,72 @@ class ZooInfo:
                 db=db, join=t, by=frozenset([self.cl._spec["primary_key"]]),
                 *largs, **kargs)
 
+    def groups(self, *largs, **kargs):
+        r"""
+        Return the IDs of objects satisfying the conditions together with the
+        values of the grouping expressions.
+
+        Returns a cursor over the distinct rows containing the ID in the
+        column ``zooid`` and the values of the grouping expressions in the
+        columns ``_dim0``, ``_dim1``, ... If ``subquery`` is ``True``, a pair
+        containing the SQL string and the list of parameters is returned
+        instead.
+
+        INPUT:
+
+        - ``db`` - the database being used (must be a named parameter;
+          default: ``None``).
+
+        - ``join`` - a join of tables needed to determine the object
+          (must be a named parameter; default: ``None``).
+
+        - ``by`` - the criterion to join by (must be a named parameter;
+          default: ``None``). See ``db.query.Table.join`` for more information.
+
+        - ``groupby`` - an expression or list of expressions to group by
+          (must be a named parameter; default: ``[]``).
+
+        - ``subquery`` - whether to return the query instead of performing it
+          (must be a named parameter; default: ``False``).
+
+        - an unnamed attribute should be an expression representing a
+          condition.
+
+        - a named parameter specifies the condition that the property specified
+          by the name takes the specified by the value.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        join = lookup(kargs, "join", default=None, destroy=True)
+        by = lookup(kargs, "by", default=None, destroy=True)
+        if db is None:
+            db = self.getdb()
+        t = Table(self.cl._spec["name"])
+        if join is not None:
+            t = join.join(t, by=by)
+        if self.cl._parent is None:
+            groupby = lookup(kargs, "groupby", default=[], destroy=True)
+            subquery = lookup(kargs, "subquery", default=False, destroy=True)
+            if isinstance(groupby, set):
+                groupby = list(groupby)
+            elif not isinstance(groupby, list):
+                groupby = [groupby]
+            cond = And(*largs, **kargs)
+            cols = t.getTables()
+            for table, j, b in cond.getTables():
+                if table not in cols:
+                    t = t.join(table, by=b)
+            return db.query(columns=[Column(self.cl._spec["primary_key"],
+                                            self.cl._spec["name"],
+                                            alias="zooid")] +
+                            [Column(x, alias="_dim%d" % i)
+                             for i, x in enumerate(groupby)],
+                            table=t, cond=cond, distinct=True,
+                            subquery=subquery)
+        else:
+            return ZooInfo(self.cl._parent).groups(
+                db=db, join=t, by=frozenset([self.cl._spec["primary_key"]]),
+                *largs, **kargs)
+
     def query(self, *largs, **kargs):
         r"""
         Make a query for objects satisfying the conditions.
@@ -826,7 +945,21 @@ class ZooInfo:
           parameter; default: ``None``).
 
         - ``random`` - whether to randomly shuffle the results (must be a named
-          parameter; default: ``False``).
+          parameter; default: ``False``). If ``limit`` is given and
+          ``offset`` is not, the results are first sampled by probing random
+          IDs (see ``ZooInfo._sample``), so the whole result set is not
+          sorted.
+
+        - ``keyset`` - whether to order the results for keyset pagination
+          (must be a named parameter; default: ``False``). If ``True``, the
+          ID is appended to the expressions to order by as a tiebreaker, and
+          their values are returned in the columns ``_key0``, ``_key1``, ...
+          Cannot be used together with ``random``.
+
+        - ``after`` - a token specifying the values of the ordering
+          expressions for the last row of the previous page (must be a named
+          parameter; default: ``None``). Only the rows following it are
+          returned. Implies ``keyset``. See ``ZooInfo.page``.
 
         - an unnamed attribute should be an expression representing a
           condition.
@@ -848,15 +981,35 @@ class ZooInfo:
             limit = lookup(kargs, "limit", default=None, destroy=True)
             offset = lookup(kargs, "offset", default=None, destroy=True)
             random = lookup(kargs, "random", default=False, destroy=True)
+            after = lookup(kargs, "after", default=None, destroy=True)
+            keyset = lookup(kargs, "keyset", default=False, destroy=True) \
+                or after is not None
             cond = And(*largs, **kargs)
             ct = cond.getTables()
             cols = t.getTables()
             columns = [Table(table) for table in cols]
+            outer = []
             if random:
+                if keyset:
+                    raise ValueError("keyset pagination cannot be used "
+                                     "with random ordering")
+                if limit is not None and offset is None:
+                    c = Column(self.cl._spec["primary_key"],
+                               self.cl._spec["name"])
+                    cond = Or(*[c == Value(i) for i in
+                                self._sample(db, t, cond, limit)])
+                    ct = cond.getTables()
                 orderby = [Random]
                 columns.append(Column(Random, alias="_rand"))
+            elif keyset:
+                orderby, keycols, keycond = \
+                    self._keyset(orderby, after)
+                columns += keycols
+                if keycond is not None:
+                    outer.append(keycond)
             if cols.issuperset({tbl for tbl, j, b in ct}):
-                return db.query(columns=columns, table=t, cond=cond,
+                return db.query(columns=columns, table=t,
+                                cond=And(cond, *outer),
                                 orderby=orderby, limit=limit,
                                 offset=offset, distinct=True, cur=cur)
             else:
@@ -866,8 +1019,8 @@ class ZooInfo:
                         t = t.join(tbl, by=b)
                 c = Column(self.cl._spec["primary_key"], self.cl._spec["name"])
                 return db.query(columns=columns, table=tt,
-                                cond=In(c, Subquery(columns=[c], table=t,
-                                                    cond=cond)),
+                                cond=And(In(c, Subquery(columns=[c], table=t,
+                                                        cond=cond)), *outer),
                                 orderby=orderby, limit=limit,
                                 offset=offset, distinct=True, cur=cur)
         else:
@@ -875,30 +1028,230 @@ class ZooInfo:
                 db=db, join=t, by=frozenset([self.cl._spec["primary_key"]]),
                 *largs, **kargs)
 
+    def _sample(self, db, t, cond, k):
+        r"""
+        Return a list of IDs of at most ``k`` uniformly random objects
+        satisfying the condition.
+
+        Random IDs between the smallest and largest ID in the root table are
+        probed in batches of ``sample_batch``, and those belonging to objects
+        satisfying the condition are kept. If not enough IDs are found after
+        ``sample_rounds`` batches (or the range of IDs is small), the IDs of
+        all objects satisfying the condition are streamed from the database
+        and sampled using reservoir sampling.
+
+        INPUT:
+
+        - ``db`` - the database being used.
+
+        - ``t`` - the table to query.
+
+        - ``cond`` - the condition to be satisfied.
+
+        - ``k`` - the size of the sample.
+        """
+        name = self.cl._spec["name"]
+        c = Column(self.cl._spec["primary_key"], name)
+        cols = t.getTables()
+        t = Table(t)
+        for table, j, b in cond.getTables():
+            if table not in cols:
+                t = t.join(table, by=b)
+        bounds = []
+        for o in [c, (c, "D")]:
+            cur = db.query(columns=[c], table=Table(name), orderby=[o],
+                           limit=1)
+            r = cur.fetchone()
+            cur.close()
+            if r is None:
+                return []
+            bounds.append(r[0])
+        low, high = bounds
+        found = set()
+        if high - low + 1 > self.sample_batch * self.sample_rounds:
+            for i in range(self.sample_rounds):
+                probe = Or(*[c == Value(randint(low, high))
+                             for j in range(self.sample_batch)])
+                cur = db.query(columns=[c], table=t, cond=And(cond, probe),
+                               distinct=True)
+                hits = [r[0] for r in cur if r[0] not in found]
+                cur.close()
+                shuffle(hits)
+                found.update(hits[:k - len(found)])
+                if len(found) == k:
+                    return list(found)
+        cur = db.query(columns=[c], table=t, cond=cond, distinct=True,
+                       cur=db.streaming_cursor())
+        try:
+            return reservoir((r[0] for r in cur), k)
+        finally:
+            cur.close()
+
+    def _keyset(self, orderby, after=None):
+        r"""
+        Prepare a query for keyset pagination.
+
+        Returns a triple containing the list of orderings with the ID appended
+        as a tiebreaker, the list of columns containing the values of the
+        ordering expressions, and the condition selecting the rows following
+        the ones specified by ``after`` (or ``None`` if not given).
+
+        INPUT:
+
+        - ``orderby`` - an expression or list of expressions to order by.
+
+        - ``after`` - a token specifying the values of the ordering
+          expressions for the last row of the previous page
+          (default: ``None``).
+        """
+        if isinstance(orderby, dict):
+            orderby = list(orderby.items())
+        elif isinstance(orderby, set):
+            orderby = list(orderby)
+        elif not isinstance(orderby, list):
+            orderby = [orderby]
+        key = Column(self.cl._spec["primary_key"], self.cl._spec["name"])
+        orderby = [Order(x) for x in orderby] + [Order(key)]
+        keycols = [Column(o.exp, alias="_key%d" % i)
+                   for i, o in enumerate(orderby)]
+        if after is None:
+            return (orderby, keycols, None)
+        values = decode_token(after)
+        if len(values) != len(orderby):
+            raise ValueError("invalid token: %s" % after)
+        terms = []
+        for i, o in enumerate(orderby):
+            term = [orderby[j].exp == Value(values[j]) for j in range(i)]
+            if o.order:
+                term.append(o.exp > Value(values[i]))
+            else:
+                term.append(o.exp < Value(values[i]))
+            terms.append(And(*term))
+        return (orderby, keycols, Or(*terms))
+
+    def page(self, *largs, **kargs):
+        r"""
+        Return a page of objects satisfying the conditions.
+
+        Returns a pair containing a list of at most ``limit`` objects and a
+        token which can be passed as ``after`` to obtain the next page, or
+        ``None`` if there are no further objects. The objects are ordered by
+        the specified expressions with the ID as a tiebreaker, and the pages
+        are determined by the values of these expressions, so no rows need to
+        be skipped when fetching subsequent pages. Rows with ``NULL`` values
+        of the ordering expressions are not paginated correctly.
+
+        INPUT:
+
+        - ``limit`` - the maximal number of objects on the page (must be a
+          named parameter).
+
+        - ``after`` - the token returned with the previous page (must be a
+          named parameter; default: ``None``).
+
+        - ``props`` - whether to return dictionaries of properties instead of
+          objects (must be a named parameter; default: ``False``).
+
+        All other parameters are passed to ``ZooInfo.query``.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        limit = lookup(kargs, "limit", default=None, destroy=True)
+        props = lookup(kargs, "props", default=False, destroy=True)
+        if limit is None:
+            raise ValueError("the page size must be given as limit")
+        if db is None:
+            db = self.getdb()
+        kargs["keyset"] = True
+        cur = self.query(db=db, limit=limit, *largs, **kargs)
+        rows = cur.fetchall()
+        cur.close()
+        if len(rows) < limit or len(rows) == 0:
+            token = None
+        else:
+            r = rows[-1]
+            token = encode_token([r[k] for k in r.keys()
+                                  if k.startswith("_key")])
+        if props:
+            return ([todict(r, db) for r in rows], token)
+        else:
+            return ([self.cl(todict(r, db), db=db) for r in rows], token)
+
+    def _stream(self, cur, fun, close=True):
+        r"""
+        Return a generator applying a function to the rows of a cursor.
+
+        INPUT:
+
+        - ``cur`` - the cursor to iterate over.
+
+        - ``fun`` - the function to apply to each row.
+
+        - ``close`` - whether to close the cursor once the generator is
+          exhausted or closed (default: ``True``).
+        """
+        try:
+            for r in cur:
+                yield fun(r)
+        finally:
+            if close:
+                cur.close()
+
     def props(self, *largs, **kargs):
         r"""
         Return a generator yielding properties of objects satisfying the
         conditions.
 
-        All parameters are passed to ``ZooInfo.query``.
+        INPUT:
+
+        - ``itersize`` - the number of rows to fetch from the database at once
+          (must be a named parameter; default: ``None``). Unless ``cur`` is
+          given, a streaming cursor is used (see ``SQLDB.streaming_cursor``).
+
+        All other parameters are passed to ``ZooInfo.query``.
+
+        Graph data compressed by a codec (see ``SQLDB.use_codec``) is
+        decoded. Since the stored values are compressed, conditions comparing
+        the ``data`` column to strings do not match them.
         """
         db = lookup(kargs, "db", default=None, destroy=True)
+        itersize = lookup(kargs, "itersize", default=None, destroy=True)
         if db is None:
             db = self.getdb()
+        close = lookup(kargs, "cur", default=None) is None
+        if close:
+            kargs["cur"] = db.streaming_cursor(itersize=itersize)
         cur = self.query(db=db, *largs, **kargs)
-        return (todict(r, db) for r in cur)
+
+        def row(r):
+            d = todict(r, db)
+            if "data" in d:
+                d["data"] = db.decode_data(d["data"])
+            return d
+
+        return self._stream(cur, row, close=close)
 
     def all(self, *largs, **kargs):
         r"""
         Return a generator yielding objects satisfying the conditions.
 
-        All parameters are passed to ``ZooInfo.query``.
+        INPUT:
+
+        - ``itersize`` - the number of rows to fetch from the database at once
+          (must be a named parameter; default: ``None``). Unless ``cur`` is
+          given, a streaming cursor is used (see ``SQLDB.streaming_cursor``).
+
+        All other parameters are passed to ``ZooInfo.query``.
         """
         db = lookup(kargs, "db", default=None, destroy=True)
+        itersize = lookup(kargs, "itersize", default=None, destroy=True)
         if db is None:
             db = self.getdb()
+        close = lookup(kargs, "cur", default=None) is None
+        if close:
+            kargs["cur"] = db.streaming_cursor(itersize=itersize)
         cur = self.query(db=db, *largs, **kargs)
-        return (self.cl(todict(r, db), db=db) for r in cur)
+        return self._stream(cur, lambda r: self.cl(todict(r, db), db=db),
+                            close=close)
 
     def one(self, *largs, **kargs):
         r"""
@@ -916,6 +1269,82 @@ class ZooInfo:
             raise KeyError(largs, kargs)
         return self.cl(todict(r, db), db=db)
 
+    async def aquery(self, *largs, **kargs):
+        r"""
+        Make a query for objects satisfying the conditions without blocking
+        the event loop.
+
+        Returns an ``aio.AsyncCursor`` supporting asynchronous iteration. The
+        query is performed by the database's executor (see
+        ``SQLDB.run_async``).
+
+        INPUT:
+
+        - ``chunk`` - the number of rows to fetch at once when iterating
+          (must be a named parameter; default: ``None``, meaning that the
+          database's ``itersize`` is used).
+
+        All other parameters are passed to ``ZooInfo.query``.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        chunk = lookup(kargs, "chunk", default=None, destroy=True)
+        if db is None:
+            db = self.getdb()
+        cur = await db.run_async(self.query, db=db, *largs, **kargs)
+        return AsyncCursor(db, cur, chunk=chunk)
+
+    async def acount(self, *largs, **kargs):
+        r"""
+        Count objects satisfying the conditions without blocking the event
+        loop.
+
+        All parameters are passed to ``ZooInfo.count``.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        if db is None:
+            db = self.getdb()
+        return await db.run_async(self.count, db=db, *largs, **kargs)
+
+    async def aall(self, *largs, **kargs):
+        r"""
+        Return an ``aio.AsyncCursor`` yielding objects satisfying the
+        conditions without blocking the event loop.
+
+        The rows are fetched in chunks of ``itersize`` rows, and the objects
+        are constructed by the database's executor.
+
+        INPUT:
+
+        - ``itersize`` - the number of rows to fetch from the database at once
+          (must be a named parameter; default: ``None``). Unless ``cur`` is
+          given, a streaming cursor is used (see ``SQLDB.streaming_cursor``).
+
+        All other parameters are passed to ``ZooInfo.query``.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        itersize = lookup(kargs, "itersize", default=None, destroy=True)
+        if db is None:
+            db = self.getdb()
+        if lookup(kargs, "cur", default=None) is None:
+            kargs["cur"] = await db.run_async(db.streaming_cursor,
+                                              itersize=itersize)
+        cur = await db.run_async(self.query, db=db, *largs, **kargs)
+        return AsyncCursor(db, cur,
+                           fun=lambda r: self.cl(todict(r, db), db=db),
+                           chunk=itersize)
+
+    async def aone(self, *largs, **kargs):
+        r"""
+        Return an object satisfying the conditions without blocking the event
+        loop.
+
+        All parameters are passed to ``ZooInfo.query``.
+        """
+        db = lookup(kargs, "db", default=None, destroy=True)
+        if db is None:
+            db = self.getdb()
+        return await db.run_async(self.one, db=db, *largs, **kargs)
+
 
 def initdb(db=None, commit=True):
     r"""
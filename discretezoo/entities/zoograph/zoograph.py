@@ -13,11 +13,13 @@ from sage.graphs.graph_coloring import edge_coloring
 from sage.misc.package import is_package_installed
 from sage.rings.infinity import PlusInfinity
 from sage.rings.integer import Integer
+from sage.rings.real_mpfr import RealNumber
 from hashlib import sha256
 from inspect import getfullargspec
 from . import fields
 from ..zooentity import ZooInfo
 from ..zooobject import ZooObject
+from ...db.codec import isEncoded
 from ...db.query import Column
 from ...db.query import Value
 from ...util.context import DBParams
@@ -80,16 +82,19 @@ class ZooGraph(Graph, ZooObject):
         if cl._fields is fields:
             cl._derive("degree", fields.average_degree, add_method=False)
             cl._derive("density",
-                       2 * fields.size / (fields.order * (fields.order - 1)))
+                       2 * fields.size / (fields.order * (fields.order - 1)),
+                       stored=RealNumber)
             cl._derive("has_loops", fields.number_of_loops != 0)
-            cl._derive("is_connected", fields.connected_components_number <= 1)
+            cl._derive("is_connected", fields.connected_components_number <= 1,
+                       stored=bool)
             cl._derive("is_half_transitive",
                        fields.is_edge_transitive & fields.is_vertex_transitive
-                       & ~fields.is_arc_transitive)
+                       & ~fields.is_arc_transitive, stored=bool)
             cl._derive("is_semi_symmetric",
                        fields.is_regular & fields.is_edge_transitive
                        & ~fields.is_vertex_transitive)
-            cl._derive("is_triangle_free", fields.triangles_count == 0)
+            cl._derive("is_triangle_free", fields.triangles_count == 0,
+                       stored=bool)
             cl._derive("is_weakly_chordal",
                        fields.is_long_hole_free & fields.is_long_antihole_free)
 
@@ -272,6 +277,8 @@ class ZooGraph(Graph, ZooObject):
             except KeyError as ex:
                 if not d["store"]:
                     raise ex
+        if isEncoded(d["data"]):
+            d["data"] = self._db.decode_data(d["data"])
         propname = lookup(self._graphprops, "name", default=None)
         if d["name"]:
             self._graphprops["name"] = d["name"]
@@ -430,7 +437,8 @@ class ZooGraph(Graph, ZooObject):
             DBParams.get(kargs, destroy=True)
             if len(kargs) > 0:
                 raise NotImplementedError
-            return lookup(self._graphprops, "data")
+            val = lookup(self._graphprops, "data")
+            return self._db.decode_data(val) if isEncoded(val) else val
         except (KeyError, TypeError, NotImplementedError):
             return data(self, **kargs)
 
@@ -620,7 +628,11 @@ def import_graphs(file, cl=ZooGraph, db=None, format="sparse6",
 
     To properly import the graphs, all graphs of the same order must be
     together in the file, and no graph of this order must be present in the
-    database.
+    database. If the database provides a dedicated bulk loading mechanism
+    (e.g., COPY statements on PostgreSQL), the graphs are written using it
+    (see ``SQLDB.bulk_load``). In this case, the rows not written yet are not
+    visible to queries, so duplicate graphs in the file are not detected.
+    Otherwise, the inserted rows are only buffered (see ``SQLDB.buffered``).
 
     INPUT:
 
@@ -650,7 +662,8 @@ def import_graphs(file, cl=ZooGraph, db=None, format="sparse6",
     previous = 0
     i = 0
     cur = db.cursor()
-    with open(file) as f:
+    load = db.bulk_load() if db.bulk_copy else db.buffered()
+    with open(file) as f, load:
         for line in f:
             data = line.strip()
             if format not in ["graph6", "sparse6"]:
@@ -666,7 +679,6 @@ def import_graphs(file, cl=ZooGraph, db=None, format="sparse6",
             cl(graph=g, order=n, cur=cur, db=db, **{index: i})
         if verbose:
             print("Imported %d graphs of order %d" % (i, n))
-        f.close()
     cur.close()
     db.commit()
 
@@ -308,7 +308,7 @@ class ZooObject(ZooEntity):
                     upd, ats = True, attrs
                 else:
                     upd, ats = determiner(self, a, attrs, store=store, cur=cur)
-                if store:
+                if store and not self._db.readonly:
                     t = {}
                     if upd:
                         if isinstance(a, ZooObject):
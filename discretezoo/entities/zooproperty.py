@@ -8,7 +8,9 @@ objects.
 import discretezoo
 from .change import Change
 from .zooentity import ZooEntity
+from ..db.query import And
 from ..db.query import Column
+from ..db.query import Not
 from ..db.query import Or
 from ..db.query import Value
 
@@ -19,6 +21,7 @@ class ZooProperty(ZooEntity):
     """
 
     _init = False
+    _batch_size = 100
 
     def _init_(self, kargs):
         """
@@ -41,6 +44,7 @@ class ZooProperty(ZooEntity):
         A matching row (possibly marked as deleted) is first queried for. If
         none exists, a new row is inserted. Otherwise, the old one is updated
         with the changed values. Returns the ID of the inserted or updated row.
+        If the database supports upserts, ``_upsert_rows`` is used instead.
 
         INPUT:
 
@@ -54,6 +58,8 @@ class ZooProperty(ZooEntity):
         - ``commit`` - whether to commit after a new row is inserted. If
           ``None`` (default), commit only if ``cur`` is not specified.
         """
+        if self._db.upsert:
+            return self._upsert_rows(cl, [row], cur=cur, commit=commit)[0]
         if commit is None:
             commit = cur is None
         if cur is None:
@@ -84,6 +90,195 @@ class ZooProperty(ZooEntity):
                                  commit=commit)
         return id
 
+    def _insert_rows(self, cl, rows, cur=None, commit=None, upsert=None):
+        r"""
+        Insert multiple rows into the database or replace existing rows.
+
+        Behaves like ``_insert_row`` for each of the given rows, but matching
+        rows are queried for at once, and new rows are inserted in a batch.
+        Returns a list of IDs of the inserted or updated rows in the order of
+        ``rows``.
+
+        INPUT:
+
+        - ``cl`` - the class determining the table to insert the rows into.
+
+        - ``rows`` - a list of dictionaries specifying the rows to insert.
+
+        - ``cur`` - the cursor to use for database interaction
+          (default: ``None``).
+
+        - ``commit`` - whether to commit after the rows are inserted. If
+          ``None`` (default), commit only if ``cur`` is not specified.
+
+        - ``upsert`` - whether to use ``_upsert_rows`` (default: ``None``,
+          meaning that it is used if the database supports upserts).
+        """
+        if upsert is None:
+            upsert = self._db.upsert
+        if upsert:
+            return self._upsert_rows(cl, rows, cur=cur, commit=commit)
+        if commit is None:
+            commit = cur is None
+        if cur is None:
+            cur = self._db.cursor()
+        uidx = self._unique_index()
+        pkey = cl._spec["primary_key"]
+        rows = [dict(row) for row in rows]
+        keys = [tuple(row[k] for k in uidx) for row in rows]
+        cols = {k for row in rows for k in row if k not in uidx}
+        found = {}
+        for i in range(0, len(rows), self._batch_size):
+            self._db.query([Column(k) for k in
+                            cols.union(uidx, [pkey, "deleted"])],
+                           cl._spec["name"],
+                           Or([[Column(k) == Value(v)
+                                for k, v in zip(uidx, key)]
+                               for key in keys[i:i+self._batch_size]]),
+                           cur=cur)
+            for r in cur.fetchall():
+                found[tuple(r[k] for k in uidx)] = r
+        ids = {}
+        new = []
+        for key, row in zip(keys, rows):
+            r = found.get(key)
+            if key in ids:
+                if r is None:
+                    new[ids[key][1]].update(row)
+                    continue
+            elif r is None:
+                id = self._db_write(ZooEntity, cur)
+                Change(id, cl, cur=cur, db=self._db)
+                row[pkey] = id
+                row["deleted"] = False
+                ids[key] = (id, len(new))
+                new.append(row)
+                continue
+            id = r[pkey]
+            ids[key] = (id, None)
+            if r["deleted"]:
+                Change(id, cl, column="deleted", cur=cur, db=self._db)
+            for k, v in row.items():
+                if k not in uidx and v != r[k]:
+                    Change(id, cl, column=k, cur=cur, db=self._db)
+            row["deleted"] = False
+            self._db.update_rows(cl._spec["name"], row, {pkey: id}, cur=cur,
+                                 commit=False)
+        if len(new) > 0:
+            self._db.insert_rows(cl._spec["name"], new, cur=cur,
+                                 commit=False)
+        if commit:
+            self._db.commit()
+        return [ids[key][0] for key in keys]
+
+    def _allocate_ids(self, n, cur):
+        r"""
+        Write ``n`` new entities to the database and return their IDs.
+
+        The rows are the same as the ones written by ``_db_write`` for
+        ``ZooEntity``. If the database supports upserts, they are inserted
+        using a single statement returning the allocated IDs. Otherwise, or
+        in bulk loading mode (where the IDs are preallocated), the rows are
+        written one at a time.
+
+        INPUT:
+
+        - ``n`` - the number of entities to write.
+
+        - ``cur`` - the cursor to use for database interaction.
+        """
+        row = self._getrow(ZooEntity)
+        if n < 2 or not self._db.upsert or \
+                getattr(self._db, "idblocks", None) is not None or \
+                all(v is None for v in row.values()):
+            return [self._db_write(ZooEntity, cur) for _ in range(n)]
+        pkey = ZooEntity._spec["primary_key"]
+        return [r[0] for r in
+                self._db.upsert_rows(ZooEntity._spec["name"], [row] * n,
+                                     [pkey], id=pkey, cur=cur)]
+
+    def _upsert_rows(self, cl, rows, cur=None, commit=None):
+        r"""
+        Insert multiple rows into the database or replace existing rows using
+        upserts.
+
+        IDs are allocated for all rows of each batch at once (see
+        ``_allocate_ids``), and the rows are then written using an
+        ``INSERT ... ON CONFLICT`` statement for the batch. If changes
+        are not tracked, conflicting rows are updated by the same statement.
+        Otherwise, conflicting rows are left unchanged and then handled by
+        ``_insert_rows`` without upserts, so that the changed columns are
+        logged as before. IDs allocated for rows which were not inserted are
+        released. Returns a list of IDs of the inserted or updated rows in the
+        order of ``rows``.
+
+        INPUT:
+
+        - ``cl`` - the class determining the table to insert the rows into.
+
+        - ``rows`` - a list of dictionaries specifying the rows to insert.
+
+        - ``cur`` - the cursor to use for database interaction
+          (default: ``None``).
+
+        - ``commit`` - whether to commit after the rows are inserted. If
+          ``None`` (default), commit only if ``cur`` is not specified.
+        """
+        if commit is None:
+            commit = cur is None
+        if cur is None:
+            cur = self._db.cursor()
+        uidx = self._unique_index()
+        pkey = cl._spec["primary_key"]
+        track = self._db.track
+        keys = [tuple(self._db.to_db_type(row[k]) for k in uidx)
+                for row in rows]
+        merged = {}
+        for key, row in zip(keys, rows):
+            merged.setdefault(key, {}).update(row)
+        items = list(merged.items())
+        ids = {}
+        conflicts = []
+        unused = []
+        for i in range(0, len(items), self._batch_size):
+            batch = items[i:i+self._batch_size]
+            new = [{**row, pkey: id, "deleted": False}
+                   for (key, row), id
+                   in zip(batch, self._allocate_ids(len(batch), cur))]
+            found = {tuple(r[1:]): r[0] for r in
+                     self._db.upsert_rows(cl._spec["name"], new, uidx,
+                                          update=not track, id=pkey,
+                                          cur=cur)}
+            for (key, row), r in zip(batch, new):
+                id = found.get(key)
+                if id is None:
+                    conflicts.append(key)
+                    unused.append(r[pkey])
+                    continue
+                ids[key] = id
+                if id == r[pkey]:
+                    if track:
+                        Change(id, cl, cur=cur, db=self._db)
+                else:
+                    unused.append(r[pkey])
+        if len(conflicts) > 0:
+            for key, id in zip(conflicts,
+                               self._insert_rows(cl, [merged[key]
+                                                      for key in conflicts],
+                                                 cur=cur, commit=False,
+                                                 upsert=False)):
+                ids[key] = id
+        if len(unused) > 0:
+            col = Column(ZooEntity._spec["primary_key"])
+            for i in range(0, len(unused), self._batch_size):
+                self._db.delete_rows(ZooEntity._spec["name"],
+                                     Or([col == Value(id) for id
+                                         in unused[i:i+self._batch_size]]),
+                                     cur=cur, commit=False)
+        if commit:
+            self._db.commit()
+        return [ids[key] for key in keys]
+
     def _delete_rows(self, cl, cond, cur=None, commit=None):
         r"""
         Delete rows from the database.
@@ -113,7 +308,7 @@ class ZooProperty(ZooEntity):
         for (id,) in cur.fetchall():
             Change(id, cl, column="deleted", cur=cur, db=self._db)
         self._db.update_rows(cl._spec["name"], {"deleted": True}, cond,
-                             cur=cur, commit=True)
+                             cur=cur, commit=commit)
 
     def _update_rows(self, cl, row, cond, cur=None, commit=None):
         r"""
@@ -142,7 +337,7 @@ class ZooProperty(ZooEntity):
         if cur is None:
             cur = self._db.cursor()
         uidx = self._unique_index()
-        cond = cond & (~Column("deleted"))
+        cond = And(cond, Not(Column("deleted")))
         self._db.query(
             [Column(c) for c
              in {cl._spec["primary_key"]}.union(row.keys()).union(uidx)],
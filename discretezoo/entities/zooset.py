@@ -7,8 +7,10 @@ This module provides a function to create set-like classes.
 from .zooentity import ZooEntity
 from .zooproperty import ZooProperty
 from .zootypes import register_type
+from ..db.query import And
 from ..db.query import Column
 from ..db.query import ColumnSet
+from ..db.query import Not
 from ..db.query import Table
 from ..db.query import enlist
 from ..util.context import DBParams
@@ -60,14 +62,14 @@ class _ZooSet(dict, ZooProperty):
             ZooProperty._init_(self, kargs)
             self._objid = data
             if vals is not None and kargs["store"]:
-                for val in vals:
-                    self.add(val, store=True, cur=kargs["cur"])
+                self.update(vals, store=True, cur=kargs["cur"])
                 if kargs["commit"]:
                     self._db.commit()
             else:
                 t = Table(self._spec["name"])
-                cur = self._db.query([t], t, {self._foreign_key: data,
-                                              "deleted": False},
+                cur = self._db.query([t], t,
+                                     And(Not(Column("deleted")),
+                                         **{self._foreign_key: data}),
                                      cur=kargs["cur"])
                 for r in cur:
                     v = tuple([r[k] for k in self._ordering])
@@ -521,6 +523,8 @@ class _ZooSet(dict, ZooProperty):
         r"""
         Update a set with the union of itself and others.
 
+        New elements are written to the database in a batch.
+
         INPUT:
 
         - any number of collections as unnamed parameters.
@@ -532,12 +536,26 @@ class _ZooSet(dict, ZooProperty):
           (must be a named parameter; default: ``None``).
         """
         store, cur = DBParams.get(kargs)
-        if not isinstance(other, dict):
-            other = {x: None for x in other}
+        new = {}
         for other in largs:
+            if not isinstance(other, dict):
+                other = {x: None for x in other}
             for x in other:
-                if x not in self or self[x] is None:
-                    self.add(x, other[x], store=store, cur=cur)
+                x, tx, id = self._normalize(x, other[x])
+                if x not in self and x not in new:
+                    new[x] = (tx, id)
+        if len(new) == 0:
+            return
+        if store:
+            rows = []
+            for x, (tx, id) in new.items():
+                row = {c: tx[i] for i, c in enumerate(self._ordering)}
+                row[self._foreign_key] = self._objid
+                rows.append(row)
+            ids = self._insert_rows(self.__class__, rows, cur=cur)
+            new = {x: (tx, id) for (x, (tx, _)), id in zip(new.items(), ids)}
+        for x, (tx, id) in new.items():
+            self[x] = id
 
 
 def ZooSet(parent, name, spec, use_tuples=None):
@@ -576,7 +594,9 @@ def ZooSet(parent, name, spec, use_tuples=None):
         '_spec': {
             "name": "%s_%s" % (parent._spec["name"], name),
             "primary_key": id,
-            "indices": [([fkey, *fields.keys()], {"unique"})],
+            "indices": [([fkey, *fields.keys()], {"unique"}),
+                        ([fkey], {"live"}),
+                        (sorted(fields.keys()), {"live"})],
             "skip": {fkey, "deleted"},
             "fields": {
                 id: ZooEntity,
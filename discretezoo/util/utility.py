@@ -4,9 +4,13 @@ Utility functions
 This module contains utility functions used throughout the package.
 """
 
+import json
 import sys
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
 from functools import partial
 from inspect import getfullargspec
+from random import randint
 from sage.rings.integer import Integer
 from sage.rings.rational import Rational
 from sage.rings.real_mpfr import create_RealNumber
@@ -155,6 +159,61 @@ def todict(r, db):
             for k, v in dict(r).items() if v is not None}
 
 
+def reservoir(it, k):
+    r"""
+    Return a uniformly random sample of at most ``k`` elements of an iterable.
+
+    The iterable is traversed only once, keeping at most ``k`` elements in
+    memory.
+
+    INPUT:
+
+    - ``it`` - the iterable to sample from.
+
+    - ``k`` - the size of the sample.
+    """
+    sample = []
+    for i, x in enumerate(it):
+        if i < k:
+            sample.append(x)
+        else:
+            j = randint(0, i)
+            if j < k:
+                sample[j] = x
+    return sample
+
+
+def encode_token(values):
+    r"""
+    Encode a list of values into an opaque string token.
+
+    INPUT:
+
+    - ``values`` -- the list of values to encode.
+    """
+    return urlsafe_b64encode(json.dumps(values, default=str).encode()) \
+        .decode()
+
+
+def decode_token(token):
+    r"""
+    Decode a list of values from a string token.
+
+    Raises ``ValueError`` if the token is invalid.
+
+    INPUT:
+
+    - ``token`` -- the token produced by ``encode_token``.
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(token.encode()).decode())
+    except (TypeError, AttributeError, UnicodeError, ValueError):
+        raise ValueError("invalid token: %s" % token)
+    if not isinstance(values, list):
+        raise ValueError("invalid token: %s" % token)
+    return values
+
+
 def to_json(x, t=None):
     """
     Return an object suitable for conversion to JSON.